@@ -0,0 +1,256 @@
+"""Benchmark the matching pipeline on synthetic corpora of increasing size.
+
+Run as a script to print the throughput, latency percentiles and peak memory
+of each stage, optionally saving them as a baseline or comparing them with
+one saved earlier:
+
+    python benchmark.py --sizes 8 32 128 --save-baseline baseline.json
+    python benchmark.py --sizes 8 32 128 --baseline baseline.json
+"""
+__all__ = ['make_synthetic_corpus', 'run_benchmarks', 'compare_to_baseline',
+           'print_ratios']
+
+import json
+import argparse
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+import tabulate
+
+from music import (
+    make_shingles,
+    flatten_shingles,
+    pool_mean,
+    pool_median,
+    apply_embedding,
+    make_score_index,
+    compute_scores,
+    compute_batch_scores,
+    song_duration,
+)
+from projection import fit_projection, project
+from transposition import make_transposed_index, compute_transposed_scores
+
+
+def make_synthetic_corpus(
+    n_pieces, n_performances=4, duration=180, fps=22050 / 512, noise=0.3, seed=0
+):
+    """Make song data for `n_pieces` pieces, each with `n_performances` performances.
+
+    Each piece is a random sequence of chords, and each performance of it is
+    played at a slightly different tempo, with noise added to its chroma and
+    volume. The song data dictionaries have the same "song_file", "C",
+    "volume" and "rms" entries as those from `parse_song_data`.
+    """
+    rng = np.random.default_rng(seed)
+    n_frames = int(duration * fps) + 1
+    song_data = []
+    for p in range(n_pieces):
+        # Hold each random chord for about half a second, at the nominal tempo.
+        n_chords = int(duration * 2) + 2
+        chords = rng.random((12, n_chords)) ** 4
+        dynamics = rng.random(n_chords)
+        for q in range(n_performances):
+            tempo = rng.uniform(0.9, 1.1)
+            chord_idx = np.minimum(
+                (np.arange(n_frames) * 2 * tempo / fps).astype(int), n_chords - 1
+            )
+            C = chords[:, chord_idx] + noise * rng.random((12, n_frames))
+            C /= np.linalg.norm(C, axis=0)
+            volume = np.clip(
+                dynamics[chord_idx] + 0.1 * noise * rng.standard_normal(n_frames), 0, 1
+            )
+            song_data.append(
+                {
+                    "song_file": f"Composer{p % 7}_Piece{p}_Performer{q}.wav",
+                    "C": C.astype(np.float32),
+                    "volume": volume.astype(np.float32),
+                    "rms": (0.002 * 10 ** (volume / 0.4)).astype(np.float32),
+                }
+            )
+    return song_data
+
+
+def embed_mean(sd):
+    """The f7 embedding from experiments.py."""
+    F = np.block([[sd["volume"]], [sd["C"]]])
+    F_ds = pool_mean(F, 1.5, song_duration(sd), 1)
+    return flatten_shingles(make_shingles(F_ds, 19, F_ds.shape[1], view=True))
+
+
+def measure(fn, args_list):
+    """Time `fn` on each of `args_list`, and measure its peak memory on the first.
+
+    Returns a dictionary of the number of calls, the throughput in calls per
+    second, the 50th/95th/99th percentile latencies in milliseconds, and the
+    peak memory allocated by a single call in MiB.
+    """
+    times = []
+    for args in args_list:
+        start = perf_counter()
+        fn(*args)
+        times.append(perf_counter() - start)
+
+    # Trace memory separately, since tracing slows down the calls.
+    tracemalloc.start()
+    fn(*args_list[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1000
+    return {
+        "calls": len(times),
+        "throughput": len(times) / sum(times),
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "peak_mib": peak / 2**20,
+    }
+
+
+def run_benchmarks(
+    sizes=(8, 32, 128), n_performances=4, duration=180, n_queries=100, seed=0
+):
+    """Benchmark each stage of the pipeline on corpora of each of the `sizes`.
+
+    The sizes are numbers of pieces, each with `n_performances` performances
+    lasting `duration` seconds. Returns a dictionary mapping each number of
+    songs to the stats of each stage, as from `measure`.
+    """
+    rng = np.random.default_rng(seed)
+    results = {}
+    for size in sizes:
+        song_data = make_synthetic_corpus(size, n_performances, duration, seed=seed)
+        F = [np.block([[sd["volume"]], [sd["C"]]]) for sd in song_data]
+        F_ds = [pool_mean(F_i, 1.5, duration, 1) for F_i in F]
+
+        print(f"Benchmarking {len(song_data)} songs...")
+
+        stats = {}
+        stats["make_shingles"] = measure(
+            lambda F_i: flatten_shingles(
+                make_shingles(F_i, 19, F_i.shape[1], view=True)
+            ),
+            [(F_i,) for F_i in F_ds],
+        )
+        stats["pool_mean"] = measure(
+            lambda F_i: pool_mean(F_i, 1.5, duration, 1), [(F_i,) for F_i in F]
+        )
+        stats["pool_median"] = measure(
+            lambda F_i: pool_median(F_i, 1.5, duration, 1), [(F_i,) for F_i in F]
+        )
+        stats["apply_embedding"] = measure(
+            lambda: apply_embedding(song_data, embed_mean), [()]
+        )
+
+        data = apply_embedding(song_data, embed_mean)
+        index = make_score_index(data)
+        queries = [
+            (t_idx, int(rng.integers(len(data[t_idx]["D"]))))
+            for t_idx in rng.integers(len(data), size=n_queries)
+        ]
+        stats["compute_scores"] = measure(
+            lambda t_idx, s_idx: compute_scores(t_idx, s_idx, data, index), queries
+        )
+
+        # Score all of the queries at once, plainly and under every transposition.
+        X = index["D"][[index["offsets"][t_idx] + s_idx for t_idx, s_idx in queries]]
+        stats["compute_batch_scores"] = measure(
+            lambda: compute_batch_scores(X, index), [()] * 5
+        )
+        transposed = make_transposed_index(data)
+        stats["compute_transposed_scores"] = measure(
+            lambda: compute_transposed_scores(X, transposed), [()] * 5
+        )
+
+        stats["fit_projection"] = measure(
+            lambda: fit_projection(sd["D"] for sd in data), [()]
+        )
+        proj = fit_projection(sd["D"] for sd in data)
+        stats["project"] = measure(
+            lambda D: project(D, proj, 36), [(sd["D"],) for sd in data]
+        )
+        results[str(len(song_data))] = stats
+    return results
+
+
+def print_results(results):
+    """Print a table of the stats of each stage at each corpus size."""
+    rows = [
+        (n_songs, stage) + tuple(stat.values())
+        for n_songs, stats in results.items()
+        for stage, stat in stats.items()
+    ]
+    headers = [
+        "songs", "stage", "calls", "calls/s", "p50 ms", "p95 ms", "p99 ms", "peak MiB"
+    ]
+    print(tabulate.tabulate(rows, headers=headers, tablefmt="github", floatfmt=".4g"))
+
+
+# Stages which are alternatives to another stage, paired with that stage.
+RATIOS = [("compute_transposed_scores", "compute_batch_scores")]
+
+
+def print_ratios(results, ratios=RATIOS):
+    """Print how many times as long, and as much memory, each stage took as another."""
+    rows = [
+        (
+            n_songs,
+            stage,
+            base,
+            stats[stage]["p50_ms"] / stats[base]["p50_ms"],
+            stats[stage]["peak_mib"] / max(stats[base]["peak_mib"], 1e-9),
+        )
+        for n_songs, stats in results.items()
+        for stage, base in ratios
+        if stage in stats and base in stats
+    ]
+    headers = ["songs", "stage", "compared with", "p50 ratio", "peak memory ratio"]
+    print(tabulate.tabulate(rows, headers=headers, tablefmt="github", floatfmt=".3f"))
+
+
+def compare_to_baseline(results, baseline):
+    """Print the change in throughput, p95 latency and peak memory from a baseline."""
+    rows = []
+    for n_songs, stats in results.items():
+        for stage, stat in stats.items():
+            base = baseline.get(n_songs, {}).get(stage)
+            if base is None:
+                continue
+            rows.append(
+                (
+                    n_songs,
+                    stage,
+                    stat["throughput"] / base["throughput"],
+                    stat["p95_ms"] / base["p95_ms"],
+                    stat["peak_mib"] / max(base["peak_mib"], 1e-9),
+                )
+            )
+    headers = ["songs", "stage", "throughput ratio", "p95 ratio", "peak memory ratio"]
+    print(tabulate.tabulate(rows, headers=headers, tablefmt="github", floatfmt=".3f"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[8, 32, 128])
+    parser.add_argument("--performances", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=180)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--baseline", help="A saved baseline to compare against.")
+    parser.add_argument("--save-baseline", help="Save the results as a baseline.")
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        args.sizes, args.performances, args.duration, args.queries
+    )
+    print_results(results)
+    print()
+    print_ratios(results)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            print()
+            compare_to_baseline(results, json.load(fh))
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fh:
+            json.dump(results, fh, indent=2)
@@ -0,0 +1,131 @@
+__all__ = ['write_corpus', 'open_corpus', 'corpus_stages', 'iter_pickled_song_data',
+           'convert_pickles']
+
+import os
+import json
+import pickle
+
+import numpy as np
+
+from music import parse_song_file_name
+from instrument import profiler, span
+
+FEATURES = ["C", "volume", "rms"]
+
+
+def write_corpus(song_data, path):
+    """Write song data to a packed corpus in the directory `path`.
+
+    Each feature is appended to a single float32 file holding the frames of
+    every song end to end (the chroma "C" is stored frame-major), and a
+    "corpus.json" file records the offsets of each song along with its parsed
+    metadata. `song_data` may be any iterable of song data dictionaries, such
+    as the generator from `iter_song_data`, so the whole corpus never needs to
+    be in memory at once. The raw signal "Y" is not stored.
+
+    The time spent reading `song_data` and writing it is recorded as the
+    "ingest" span of the profiler, with any spans opened by `song_data`, such
+    as "ingest/parse", within it. Their breakdown is saved in the header, to
+    be read back by `corpus_stages`.
+    """
+    os.makedirs(path, exist_ok=True)
+    header_path = os.path.join(path, "corpus.json")
+    if os.path.exists(header_path):
+        os.remove(header_path)
+
+    songs = []
+    offsets = [0]
+    n_chroma = None
+    files = {feat: open(os.path.join(path, f"{feat}.f32"), "wb") for feat in FEATURES}
+    with span("ingest"):
+        try:
+            for sd in song_data:
+                C = np.asarray(sd["C"])
+                if n_chroma is None:
+                    n_chroma = C.shape[0]
+                np.ascontiguousarray(C.T, dtype="<f4").tofile(files["C"])
+                for feat in ["volume", "rms"]:
+                    np.asarray(sd[feat], dtype="<f4").tofile(files[feat])
+
+                songs.append(
+                    {
+                        "song_file": sd["song_file"],
+                        "song_id": parse_song_file_name(sd["song_file"]),
+                    }
+                )
+                offsets.append(offsets[-1] + C.shape[1])
+        finally:
+            for fh in files.values():
+                fh.close()
+
+    # The header is written last, so its presence marks a complete corpus.
+    with open(header_path, "w") as fh:
+        json.dump(
+            {
+                "n_chroma": n_chroma,
+                "offsets": offsets,
+                "songs": songs,
+                "stages": profiler.breakdown("ingest"),
+            },
+            fh,
+        )
+
+
+def corpus_stages(path):
+    """Get the breakdown of the stages that wrote the corpus at `path`.
+
+    Returns the list saved by `write_corpus`, as from `Profiler.breakdown`,
+    which is empty for corpora written before the stages were recorded.
+    """
+    with open(os.path.join(path, "corpus.json")) as fh:
+        return json.load(fh).get("stages", [])
+
+
+def open_corpus(path):
+    """Open a corpus written by `write_corpus` as a list of song data dictionaries.
+
+    The features are memory-mapped read-only views into the corpus files, so
+    nothing is read from disk until a song's features are used, and several
+    processes opening the same corpus share the same pages.
+    """
+    with open(os.path.join(path, "corpus.json")) as fh:
+        header = json.load(fh)
+    if not header["songs"]:
+        return []
+    offsets = header["offsets"]
+    n_frames = offsets[-1]
+
+    def open_feature(feat, shape):
+        if not n_frames:
+            return np.zeros(shape, dtype="<f4")
+        return np.memmap(
+            os.path.join(path, f"{feat}.f32"), dtype="<f4", mode="r", shape=shape
+        )
+
+    C = open_feature("C", (n_frames, header["n_chroma"]))
+    volume = open_feature("volume", (n_frames,))
+    rms = open_feature("rms", (n_frames,))
+
+    song_data = []
+    for song, start, end in zip(header["songs"], offsets[:-1], offsets[1:]):
+        song_data.append(
+            {
+                "song_file": song["song_file"],
+                "C": C[start:end].T,
+                "volume": volume[start:end],
+                "rms": rms[start:end],
+            }
+        )
+    return song_data
+
+
+def iter_pickled_song_data(pickle_dir="./data"):
+    """Load the song data pickled one song per file in `pickle_dir`, one at a time."""
+    for fname in os.listdir(pickle_dir):
+        with open(os.path.join(pickle_dir, fname), "rb") as pf:
+            yield pickle.load(pf)
+
+
+def convert_pickles(pickle_dir, path):
+    """Convert a folder of pickled song data into a corpus at `path`."""
+    write_corpus(iter_pickled_song_data(pickle_dir), path)
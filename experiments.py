@@ -1,27 +1,43 @@
 import os
+import functools
 import numpy as np
-from sklearn.decomposition import PCA
 
 from music import *
-
-
-# Load and get chromas from the song data.
-try:
-    import pickle
-    song_data = []
-    for fname in os.listdir('./data'):
-        with open(os.path.join('./data', fname), 'rb') as pf:
-            song_data.append(pickle.load(pf))
-except:
-    print("Did not find pickle with song data. Loading it manually from ./wavs folder.")
-    song_data = parse_song_data()
+from corpus import convert_pickles, open_corpus, write_corpus, corpus_stages
+from projection import get_projection, project
+
+
+# Load and get chromas from the song data, packing it into a corpus on first use.
+# This is only done when first asked for, so that processes which import this
+# module for its embedding functions, such as spawned workers, do not redo it.
+@functools.cache
+def get_song_data():
+    """Open the corpus of song data, packing it into ./corpus if it is not there."""
+    if not os.path.exists('./corpus/corpus.json'):
+        if os.path.isdir('./data'):
+            print("Packing the pickled song data into ./corpus.")
+            convert_pickles('./data', './corpus')
+        else:
+            print(
+                "Did not find pickle with song data. "
+                "Loading it manually from ./wavs folder."
+            )
+            write_corpus(iter_song_data(cache_dir="./feature_cache"), './corpus')
+    return open_corpus('./corpus')
+
+
+# Cache the embeddings, so each song is only embedded once per function. The
+# full resolution embeddings (f0, f1) are too large to be worth caching.
+embedding_cache = EmbeddingCache(cache_dir="./embedding_cache")
 
 
 # Define the functions that were attempted.
 def f0(sd):
     """Simply flatten the arrays, at full resolution."""
-    sh = sd["S_D"].shape
-    return sd["S_D"].reshape(sh[0], sh[1] * sh[2])
+
+    # The corpus does not store the shingles of the old pickles, so remake them.
+    S_D = make_shingles(sd["C"], 20, song_duration(sd), view=True)
+    return flatten_shingles(S_D)
 
 
 def f1(sd):
@@ -31,22 +47,22 @@ def f1(sd):
     F = np.block([[sd["volume"]], [sd["C"]]])
 
     # Re-partition it into documents
-    N = F.shape[1]
-    L = 20
-    LL = int(L * N / 180)
-    F_D = np.stack([F[:, i : (i + LL)] for i in range(N - LL + 1)])
-    sh = F_D.shape
-    return F_D.reshape(sh[0], sh[1] * sh[2])
+    F_D = make_shingles(F, 20, song_duration(sd), view=True)
+    return flatten_shingles(F_D)
 
 
+@embedding_cache.memoize
 def f2(sd):
     """Downsample and then flatten the standard arrays (no volume)."""
-    C_ds = sd["C"][:, ::43]
-    S_D = make_shingles(C_ds, 20, 180)
-    sh = S_D.shape
-    return S_D.reshape(sh[0], sh[1] * sh[2])
+    C_ds = decimate(sd["C"], 43)
+
+    # Shingle 20 of the decimated frames, about one per second, however long
+    # the song is, so that every song's shingles are the same width.
+    S_D = make_shingles(C_ds, 20, C_ds.shape[1], view=True)
+    return flatten_shingles(S_D)
 
 
+@embedding_cache.memoize
 def f3(sd):
     """Add volume as a channel, then simply flatten the arrays, downsampled to ~1 Hz."""
 
@@ -54,44 +70,54 @@ def f3(sd):
     F = np.block([[sd["volume"]], [sd["C"]]])
 
     # Downsample features.
-    F_ds = F[:, ::43]
+    F_ds = decimate(F, 43)
 
-    # Re-partition it into documents
-    F_D = make_shingles(F_ds, 20, 180)
-    sh = F_D.shape
-    return F_D.reshape(sh[0], sh[1] * sh[2])
+    # Re-partition it into documents of 20 decimated frames, as in f2.
+    F_D = make_shingles(F_ds, 20, F_ds.shape[1], view=True)
+    return flatten_shingles(F_D)
 
 
+@embedding_cache.memoize
 def f4(sd):
     """Add volume as a channel, then simply flatten the arrays, downsampled to ~1 Hz by median."""
 
     # Add the volume to the top of the chroma array.
     F = np.block([[sd["volume"]], [sd["C"]]])
 
-    # Downsample features.
-    F_ds = np.stack([np.median(F_bit, axis=1) for F_bit in make_shingles(F, 1, 180, 1)])
+    # Downsample features to 1 s windows (in the original, transposed,
+    # orientation).
+    F_ds = pool_median(F, 1, song_duration(sd), 1).T
 
-    # Re-partition it into documents
-    F_D = make_shingles(F_ds, 20, 180)
-    sh = F_D.shape
-    return F_D.reshape(sh[0], sh[1] * sh[2])
+    # Re-partition it into documents. The transposed features are shingled
+    # across their 13 channels rather than in time, as they originally were,
+    # so each shingle spans the whole song, and only songs of the same length
+    # give shingles of the same width. The fixed 180 keeps the original single
+    # channel shingles, which the song's duration would not.
+    F_D = make_shingles(F_ds, 20, 180, view=True)
+    return flatten_shingles(F_D)
 
 
+@embedding_cache.memoize
 def f5(sd):
     """Add volume as a channel, then simply flatten the arrays, downsampled to ~1 Hz by mean."""
 
     # Add the volume to the top of the chroma array.
     F = np.block([[sd["volume"]], [sd["C"]]])
 
-    # Downsample features.
-    F_ds = np.stack([np.mean(F_bit, axis=1) for F_bit in make_shingles(F, 1, 180, 1)])
+    # Downsample features to 1 s windows (in the original, transposed,
+    # orientation).
+    F_ds = pool_mean(F, 1, song_duration(sd), 1).T
 
-    # Re-partition it into documents
-    F_D = make_shingles(F_ds, 20, 180)
-    sh = F_D.shape
-    return F_D.reshape(sh[0], sh[1] * sh[2])
+    # Re-partition it into documents. The transposed features are shingled
+    # across their 13 channels rather than in time, as they originally were,
+    # so each shingle spans the whole song, and only songs of the same length
+    # give shingles of the same width. The fixed 180 keeps the original single
+    # channel shingles, which the song's duration would not.
+    F_D = make_shingles(F_ds, 20, 180, view=True)
+    return flatten_shingles(F_D)
 
 
+@embedding_cache.memoize
 def f6(sd):
     """Add volume as a channel, then simply flatten the arrays, downsampled to ~1 Hz by median (CORRECTED)."""
 
@@ -99,17 +125,16 @@ def f6(sd):
     F = np.block([[sd["volume"]], [sd["C"]]])
 
     # Downsample features.
-    F_ds = np.stack(
-        [np.median(F_bit, axis=1) for F_bit in make_shingles(F, 1.5, 180, 1)]
-    ).T
-
-    # Re-partition it into documents
-    F_D = make_shingles(F_ds, 20, 180)
+    F_ds = pool_median(F, 1.5, song_duration(sd), 1)
 
-    sh = F_D.shape
-    return F_D.reshape(sh[0], sh[1] * sh[2])
+    # Re-partition it into documents of 19 pooled windows, one per second,
+    # however long the song is. This is int(20 * 179 / 180) of the 179 windows
+    # of a 180 s recording, as the shingles were when every song was cut there.
+    F_D = make_shingles(F_ds, 19, F_ds.shape[1], view=True)
+    return flatten_shingles(F_D)
 
 
+@embedding_cache.memoize
 def f7(sd):
     """Add volume as a channel, then simply flatten the arrays, downsampled to ~1 Hz by mean (CORRECTED)."""
 
@@ -117,108 +142,93 @@ def f7(sd):
     F = np.block([[sd["volume"]], [sd["C"]]])
 
     # Downsample features.
-    F_ds = np.stack(
-        [np.mean(F_bit, axis=1) for F_bit in make_shingles(F, 1.5, 180, 1)]
-    ).T
+    F_ds = pool_mean(F, 1.5, song_duration(sd), 1)
+
+    # Re-partition it into documents of 19 pooled windows, one per second,
+    # however long the song is. This is int(20 * 179 / 180) of the 179 windows
+    # of a 180 s recording, as the shingles were when every song was cut there.
+    F_D = make_shingles(F_ds, 19, F_ds.shape[1], view=True)
+    return flatten_shingles(F_D)
 
-    # Re-partition it into documents
-    F_D = make_shingles(F_ds, 20, 180)
 
-    sh = F_D.shape
-    return F_D.reshape(sh[0], sh[1] * sh[2])
+# Fit a single PCA of the f7 shingles (or load it, if it was already fitted to
+# this data), which is truncated to a different number of components in f8-f11.
+@functools.cache
+def get_f7_projection():
+    """Get the PCA of the f7 shingles of the corpus, fitting it on first use."""
+    song_data = get_song_data()
+    return get_projection(
+        f"f7-{embedding_key(f7)}-{corpus_digest(song_data)}",
+        lambda: (f7(sd) for sd in song_data),
+    )
 
 
-shingles, _, _, _, _ = make_shingle_set(song_data, f7)
-pca_70pc = PCA(n_components=36).fit(shingles)
+def f7_projection_key():
+    """Identify the f7 projection, for the embedding cache of f8-f11."""
+    return array_digest(get_f7_projection()["components"])
 
 
+@embedding_cache.memoize(key=f7_projection_key)
 def f8(sd):
     """Apply PCA (36 components, 70% variance explained) transform to the volume-agumented chroma downsampled to ~1 Hz by mean."""
 
-    # Add the volume to the top of the chroma array.
-    F = np.block([[sd["volume"]], [sd["C"]]])
-
-    # Downsample features.
-    F_ds = np.stack(
-        [np.mean(F_bit, axis=1) for F_bit in make_shingles(F, 1.5, 180, 1)]
-    ).T
-
-    # Re-partition it into documents
-    F_D = make_shingles(F_ds, 20, 180)
-
-    sh = F_D.shape
-    return pca_70pc.transform([a for a in F_D.reshape(sh[0], sh[1] * sh[2])])
-
-
-pca_80pc = PCA(n_components=60).fit(shingles)
+    # Project the cached f7 embedding.
+    return project(f7(sd), get_f7_projection(), 36)
 
 
+@embedding_cache.memoize(key=f7_projection_key)
 def f9(sd):
     """Apply PCA (60 components, 80% variance explained) transform to the volume-agumented chroma downsampled to ~1 Hz by mean."""
 
-    # Add the volume to the top of the chroma array.
-    F = np.block([[sd["volume"]], [sd["C"]]])
-
-    # Downsample features.
-    F_ds = np.stack(
-        [np.mean(F_bit, axis=1) for F_bit in make_shingles(F, 1.5, 180, 1)]
-    ).T
-
-    # Re-partition it into documents
-    F_D = make_shingles(F_ds, 20, 180)
-
-    sh = F_D.shape
-    return pca_80pc.transform([a for a in F_D.reshape(sh[0], sh[1] * sh[2])])
-
-
-pca_90pc = PCA(n_components=101).fit(shingles)
+    # Project the cached f7 embedding.
+    return project(f7(sd), get_f7_projection(), 60)
 
 
+@embedding_cache.memoize(key=f7_projection_key)
 def f10(sd):
     """Apply PCA (101 components, 90% variance explained) transform to the volume-agumented chroma downsampled to ~1 Hz by mean."""
 
-    # Add the volume to the top of the chroma array.
-    F = np.block([[sd["volume"]], [sd["C"]]])
-
-    # Downsample features.
-    F_ds = np.stack(
-        [np.mean(F_bit, axis=1) for F_bit in make_shingles(F, 1.5, 180, 1)]
-    ).T
-
-    # Re-partition it into documents
-    F_D = make_shingles(F_ds, 20, 180)
-
-    sh = F_D.shape
-    return pca_90pc.transform([a for a in F_D.reshape(sh[0], sh[1] * sh[2])])
-
-
-pca_60pc = PCA(n_components=22).fit(shingles)
+    # Project the cached f7 embedding.
+    return project(f7(sd), get_f7_projection(), 101)
 
 
+@embedding_cache.memoize(key=f7_projection_key)
 def f11(sd):
     """Apply PCA (22 components, 60% variance explained) transform to the volume-agumented chroma downsampled to ~1 Hz by mean."""
 
-    # Add the volume to the top of the chroma array.
-    F = np.block([[sd["volume"]], [sd["C"]]])
-
-    # Downsample features.
-    F_ds = np.stack(
-        [np.mean(F_bit, axis=1) for F_bit in make_shingles(F, 1.5, 180, 1)]
-    ).T
-
-    # Re-partition it into documents
-    F_D = make_shingles(F_ds, 20, 180)
-
-    sh = F_D.shape
-    return pca_60pc.transform([a for a in F_D.reshape(sh[0], sh[1] * sh[2])])
-
-
-# Run the experiments.
-funcs = [f0, f1, f2, f3, f4, f5, f6, f7, f8, f9, f10, f11]
-sample_sizes = [10, 10] + [500] * (len(funcs) - 2)
-for f, sample_size in zip(funcs, sample_sizes):
-    print(f.__doc__)
-    run_experiment(sample_size, song_data, f)
-
-# Print the summary report
-print_report()
+    # Project the cached f7 embedding.
+    return project(f7(sd), get_f7_projection(), 22)
+
+
+# Run the experiments, spreading the trials across all the CPUs. The guard keeps
+# worker processes that re-import this script from running them too.
+if __name__ == "__main__":
+    funcs = [f0, f1, f2, f3, f4, f5, f6, f7, f8, f9, f10, f11]
+    # The full resolution embeddings are only sampled. The others score every
+    # 19th shingle of every song, one per window of f7, so that no two queries
+    # overlap. On a synthetic corpus of 160 three minute songs (25760 shingles)
+    # on one CPU this took 0.86 s, against 0.58 s for 500 random queries and
+    # 14.9 s for every shingle, with 95% intervals at most 1.25 times as wide as
+    # those of every shingle. The cost of every shingle grows with the square of
+    # the corpus: 88 s for 400 songs. Pass query_stride=1 for the exact metrics.
+    sample_sizes = [10, 10] + [None] * (len(funcs) - 2)
+    song_data = get_song_data()
+    # Save the time spent packing the corpus alongside each run's own stages.
+    ingest_stages = corpus_stages('./corpus')
+    umap_workers = []
+    for f, sample_size in zip(funcs, sample_sizes):
+        print(f.__doc__)
+        results = run_experiment(
+            sample_size,
+            song_data,
+            f,
+            n_workers=None,
+            ingest_stages=ingest_stages,
+            query_stride=19,
+        )
+        umap_workers.append(results["umap_worker"])
+
+    # Wait for the UMAP plots to finish before printing the summary report.
+    for worker in umap_workers:
+        worker.join()
+    print_report()
@@ -0,0 +1,164 @@
+__all__ = ['Profiler', 'profiler', 'span', 'current_rss']
+
+import os
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+
+
+def current_rss():
+    """Get the resident memory of this process in bytes, or its peak if unavailable."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if os.uname().sysname == "Darwin" else max_rss * 1024
+
+
+class Profiler:
+    """Record the time, call count and peak memory of nested spans of code.
+
+    Spans are named, and nest into paths such as "score/compute". While any
+    span is open, a background thread samples the resident memory of the
+    process every `sample_interval` seconds, and each span records the
+    highest sample taken while it was open.
+
+    Hooks added with `add_hook` are called as `hook("enter", path)` when a span
+    opens and `hook("exit", path, elapsed)` when it closes, so the spans can
+    also be exported to another profiler.
+    """
+
+    def __init__(self, sample_interval=0.01):
+        self.sample_interval = sample_interval
+        self.hooks = []
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open = []
+        self._stop = None
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Only the forking thread survives in the child, so start it afresh,
+        # with a new lock in case another thread held the old one.
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open = []
+        self._stop = None
+
+    def add_hook(self, hook):
+        """Add a hook to be called as each span opens and closes."""
+        self.hooks.append(hook)
+
+    def reset(self):
+        """Forget all the recorded stats, except those of any open spans."""
+        with self._lock:
+            self.stats = {
+                entry["path"]: {"calls": 0, "total": 0.0, "peak": 0}
+                for entry in self._open
+            }
+
+    @contextmanager
+    def span(self, name):
+        """Record the time and memory used within this context as the span `name`."""
+        stack = self._local.__dict__.setdefault("stack", [])
+        path = "/".join([entry["path"] for entry in stack[-1:]] + [name])
+        entry = {"path": path, "peak": current_rss()}
+        stack.append(entry)
+        with self._lock:
+            self.stats.setdefault(path, {"calls": 0, "total": 0.0, "peak": 0})
+            self._open.append(entry)
+            if self._stop is None:
+                self._stop = threading.Event()
+                sampler = threading.Thread(
+                    target=self._sample, args=(self._stop,), daemon=True
+                )
+                sampler.start()
+        for hook in self.hooks:
+            hook("enter", path)
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            stack.pop()
+            with self._lock:
+                self._open.remove(entry)
+                if not self._open:
+                    self._stop.set()
+                    self._stop = None
+                peak = max(entry["peak"], current_rss())
+                stat = self.stats[path]
+                stat["calls"] += 1
+                stat["total"] += elapsed
+                stat["peak"] = max(stat["peak"], peak)
+            for hook in self.hooks:
+                hook("exit", path, elapsed)
+
+    def merge(self, breakdown, prefix=None):
+        """Add the stats of spans recorded by another profiler, such as a worker's.
+
+        `breakdown` is a list as from `breakdown`. Each of its spans is added
+        within the span path `prefix`, or by default within the innermost span
+        open in this thread, summing the calls and times of spans of the same
+        path and keeping the highest peak memory.
+        """
+        if prefix is None:
+            stack = self._local.__dict__.get("stack")
+            prefix = stack[-1]["path"] if stack else None
+        with self._lock:
+            for entry in breakdown:
+                path = entry["stage"]
+                if prefix is not None:
+                    path = f"{prefix}/{path}"
+                stat = self.stats.setdefault(
+                    path, {"calls": 0, "total": 0.0, "peak": 0}
+                )
+                stat["calls"] += entry["calls"]
+                stat["total"] += entry["total_time"]
+                stat["peak"] = max(stat["peak"], int(entry["peak_mib"] * 2**20))
+
+    def _sample(self, stop):
+        while not stop.wait(self.sample_interval):
+            rss = current_rss()
+            with self._lock:
+                for entry in self._open:
+                    entry["peak"] = max(entry["peak"], rss)
+
+    def breakdown(self, prefix=None):
+        """List the stats of each span, in the order they were first opened.
+
+        Each is a dictionary of the span's "stage" path, its number of "calls",
+        the "total_time" spent in it in seconds, and its "peak_mib" memory. If
+        `prefix` is given, only the span of that path and those within it are
+        listed.
+        """
+        with self._lock:
+            return [
+                {
+                    "stage": path,
+                    "calls": stat["calls"],
+                    "total_time": stat["total"],
+                    "peak_mib": stat["peak"] / 2**20,
+                }
+                for path, stat in self.stats.items()
+                if prefix is None or path == prefix or path.startswith(prefix + "/")
+            ]
+
+
+# The profiler used by the instrumented functions in this package.
+profiler = Profiler()
+
+
+def span(name):
+    """Record a span of code with the package's profiler. See `Profiler.span`."""
+    return profiler.span(name)
@@ -0,0 +1,184 @@
+__all__ = ['build_ivf_index', 'save_ivf_index', 'load_ivf_index', 'query_ivf_index']
+
+import json
+
+import numpy as np
+
+from music import make_score_index
+
+
+def kmeans(X, n_clusters, n_iter=20, seed=0):
+    """Cluster the rows of X with Lloyd's algorithm, returning the centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = X[rng.choice(len(X), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = nearest_centroids(X, centroids, 1)[:, 0]
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, X)
+
+        # Re-seed any empty clusters with random points.
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = X[rng.choice(len(X), empty.sum(), replace=False)]
+    return centroids
+
+
+def nearest_centroids(X, centroids, n, batch_size=4096):
+    """Find the indices of the `n` nearest centroids to each row of X."""
+    c_norms = np.einsum("ij,ij->i", centroids, centroids)
+    nearest = []
+    for b in range(0, len(X), batch_size):
+        # The ||x||^2 term is the same for every centroid, so it can be dropped.
+        sq_dists = c_norms[None, :] - 2 * (X[b : b + batch_size] @ centroids.T)
+        if n == 1:
+            nearest.append(np.argmin(sq_dists, axis=1)[:, None])
+            continue
+        if n < len(centroids):
+            part = np.argpartition(sq_dists, n - 1, axis=1)[:, :n]
+        else:
+            part = np.tile(np.arange(len(centroids)), (len(sq_dists), 1))
+        order = np.argsort(np.take_along_axis(sq_dists, part, axis=1), axis=1)
+        nearest.append(np.take_along_axis(part, order, axis=1))
+    return np.concatenate(nearest)
+
+
+def build_ivf_index(data, n_lists=None, n_train=None, n_iter=20, seed=0):
+    """Build an inverted file (IVF) index over the shingles of every song.
+
+    The shingles are clustered with k-means, and each cluster keeps a list of
+    the shingles nearest to its centroid. A query then only scans the lists of
+    the few centroids nearest to it.
+
+    Parameters
+    ----------
+    data : list
+        The embedded song data, as returned by `apply_embedding`. Any embedding
+        works, though the low-dimensional PCA embeddings index best.
+    n_lists : int
+        (Optional) The number of clusters. Defaults to the square root of the
+        number of shingles.
+    n_train : int
+        (Optional) The number of shingles sampled to fit the clusters. Defaults
+        to 64 per cluster.
+    n_iter : int
+        (Default 20) The number of k-means iterations.
+    seed : int
+        (Default 0) The seed used to sample training shingles and centroids.
+
+    Returns
+    -------
+    dict
+        The index, which extends the dictionary from `make_score_index` with
+        the "centroids", the "list_offsets" of each cluster in "list_items",
+        and the "shingle_songs" mapping each shingle to its song.
+    """
+    index = make_score_index(data)
+    D = index["D"]
+    if n_lists is None:
+        n_lists = max(1, int(np.sqrt(len(D))))
+    if n_train is None:
+        n_train = 64 * n_lists
+    n_train = max(n_lists, min(n_train, len(D)))
+
+    rng = np.random.default_rng(seed)
+    train = D[rng.choice(len(D), n_train, replace=False)]
+    centroids = kmeans(train, n_lists, n_iter=n_iter, seed=seed)
+
+    # Sort the shingles by their cluster to form the inverted lists.
+    labels = nearest_centroids(D, centroids, 1)[:, 0]
+    list_items = np.argsort(labels, kind="stable")
+    list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    list_offsets[1:] = np.cumsum(np.bincount(labels, minlength=n_lists))
+
+    index.update(
+        {
+            "centroids": centroids,
+            "list_items": list_items,
+            "list_offsets": list_offsets,
+            "shingle_songs": np.repeat(
+                np.arange(len(data)), np.diff(index["offsets"])
+            ),
+        }
+    )
+    return index
+
+
+def save_ivf_index(index, path):
+    """Save an index from `build_ivf_index` to the .npz file at `path`."""
+    arrays = {k: v for k, v in index.items() if k != "song_ids"}
+    np.savez(path, song_ids=json.dumps(index["song_ids"]), **arrays)
+
+
+def load_ivf_index(path):
+    """Load an index saved by `save_ivf_index`."""
+    with np.load(path) as npz:
+        index = {k: npz[k] for k in npz.files if k != "song_ids"}
+        index["song_ids"] = json.loads(str(npz["song_ids"]))
+    return index
+
+
+def query_ivf_index(X, index, k=10, n_probe=8, exclude=None):
+    """Find the best matching songs for each query in `X` using the index.
+
+    Only the shingles in the `n_probe` clusters nearest each query are scored,
+    so increasing `n_probe` trades speed for recall; with `n_probe` equal to
+    the number of clusters the search is exhaustive.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        A (n_queries, n_features) array of query shingles.
+    index : dict
+        An index from `build_ivf_index` or `load_ivf_index`.
+    k : int
+        (Default 10) The maximum number of songs to return for each query.
+    n_probe : int
+        (Default 8) The number of clusters to scan for each query.
+    exclude : list
+        (Optional) For each query, the index of a song to leave out.
+
+    Returns
+    -------
+    list
+        For each query, a sorted list of up to `k` (score, song_id, idx,
+        shingle_idx) tuples, as returned by `compute_scores`.
+    """
+    X = np.atleast_2d(X)
+    D = index["D"]
+    offsets = index["offsets"]
+    list_items = index["list_items"]
+    list_offsets = index["list_offsets"]
+    n_probe = min(n_probe, len(index["centroids"]))
+
+    all_scores = []
+    probes = nearest_centroids(X, index["centroids"], n_probe)
+    for i, (x, probe) in enumerate(zip(X, probes)):
+        rows = np.concatenate(
+            [list_items[list_offsets[c] : list_offsets[c + 1]] for c in probe]
+        )
+        songs = index["shingle_songs"][rows]
+        if exclude is not None:
+            keep = songs != exclude[i]
+            rows, songs = rows[keep], songs[keep]
+
+        # Keep only the best scoring shingle of each song.
+        diff = D[rows] - x
+        dists = np.sqrt(np.einsum("ij,ij->i", diff, diff))
+        order = np.lexsort((rows, dists, songs))
+        _, first = np.unique(songs[order], return_index=True)
+        best = order[first]
+        best = best[np.argsort(dists[best], kind="stable")[:k]]
+
+        all_scores.append(
+            [
+                (
+                    dists[b],
+                    index["song_ids"][songs[b]],
+                    int(songs[b]),
+                    int(rows[b] - offsets[songs[b]]),
+                )
+                for b in best
+            ]
+        )
+    return all_scores
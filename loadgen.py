@@ -0,0 +1,109 @@
+"""Generate concurrent query load against a running query service.
+
+Each of `--concurrency` clients sends requests of `--shingles` random corpus
+shingles, one after another, until `--requests` have been sent in all. The
+throughput and latency percentiles seen by the clients are printed, followed
+by the service's own metrics:
+
+    python service.py --socket /tmp/music.sock &
+    python loadgen.py --socket /tmp/music.sock --concurrency 1 8 32
+"""
+__all__ = ['run_load']
+
+import asyncio
+import argparse
+from time import perf_counter
+
+import numpy as np
+import tabulate
+
+from service import QueryClient
+
+
+async def run_load(client_kwargs, concurrency, n_requests, n_shingles=1, k=10):
+    """Send `n_requests` queries from `concurrency` clients at once.
+
+    Returns a dictionary of the number of "requests", the "throughput" in
+    requests per second, the "p50_ms", "p95_ms" and "p99_ms" latencies, and
+    the fraction of queries whose top match is their own song, "self_found".
+    """
+    async with QueryClient(**client_kwargs) as client:
+        sample = await client.sample(min(n_requests * n_shingles, 10000))
+    shingles = np.asarray(sample["shingles"])
+    idxs = sample["idxs"]
+
+    latencies = []
+    found = []
+    next_request = iter(range(n_requests))
+
+    async def worker():
+        async with QueryClient(**client_kwargs) as client:
+            for r in next_request:
+                rows = np.arange(r * n_shingles, (r + 1) * n_shingles) % len(shingles)
+                start = perf_counter()
+                matches = await client.query(shingles[rows], k)
+                latencies.append(perf_counter() - start)
+                found.extend(m[0]["idx"] == idxs[row] for m, row in zip(matches, rows))
+
+    start = perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = perf_counter() - start
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "self_found": np.mean(found),
+    }
+
+
+async def main(args):
+    client_kwargs = {"host": args.host, "port": args.port, "path": args.socket}
+    rows = []
+    for concurrency in args.concurrency:
+        print(f"Running {args.requests} requests from {concurrency} clients...")
+        stats = await run_load(
+            client_kwargs, concurrency, args.requests, args.shingles, args.k
+        )
+        rows.append((concurrency,) + tuple(stats.values()))
+    headers = [
+        "clients", "requests", "requests/s", "p50 ms", "p95 ms", "p99 ms", "self found"
+    ]
+    print(tabulate.tabulate(rows, headers=headers, tablefmt="github", floatfmt=".4g"))
+
+    async with QueryClient(**client_kwargs) as client:
+        metrics = await client.metrics()
+    print()
+    print(
+        tabulate.tabulate(
+            [
+                (name, value)
+                for name, value in metrics.items()
+                if not isinstance(value, dict)
+            ]
+            + [
+                (f"{name} {p}", value)
+                for name, values in metrics.items()
+                if isinstance(values, dict)
+                for p, value in values.items()
+            ],
+            headers=["service metric", "value"],
+            tablefmt="github",
+            floatfmt=".4g",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", help="Connect to this Unix socket instead.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--shingles", type=int, default=1, help="Shingles per request.")
+    parser.add_argument("--k", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
@@ -1,8 +1,21 @@
-__all__ = ['parse_song_data', 'run_experiment', 'make_shingles', 'make_shingle_set', 'print_report']
+__all__ = ['parse_song_data', 'iter_song_data', 'plot_song_data', 'run_experiment',
+           'make_shingles', 'flatten_shingles', 'make_shingle_set', 'print_report',
+           'pool_mean', 'pool_median', 'pool_max', 'decimate', 'EmbeddingCache',
+           'array_digest', 'corpus_digest', 'embedding_key', 'iter_results',
+           'load_run_scores', 'read_audio_blocks', 'stream_song_features',
+           'song_duration', 'SONG_FIELDS', 'make_song_table', 'song_codes',
+           'song_mask', 'group_songs', 'song_labels']
 
 import os
 import json
+import hashlib
 import inspect
+import functools
+import pickle
+import tempfile
+import warnings
+import threading
+import multiprocessing
 from datetime import datetime
 
 import tabulate
@@ -10,66 +23,379 @@ import random
 import numpy as np
 import librosa
 import librosa.display
+import soundfile
+import soxr
 
 from umap import UMAP
+from umap.umap_ import nearest_neighbors
 from matplotlib import pyplot as plt
 from seaborn import scatterplot
-from collections import Counter
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from instrument import profiler, span
 
-def parse_song_data():
-    """Calculate and plot L2 normed CENS chromagram, alongside the Volume of the signal."""
-    song_files = [fname for fname in os.listdir("./wavs") if fname.endswith(".wav")]
+
+def file_digest(path, chunk_size=1 << 20):
+    """Compute the SHA-256 hash of the contents of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def atomic_write(path):
+    """Open `path` to write in binary, replacing any old file only when done.
+
+    The file is written under a temporary name first, so readers, including
+    other processes sharing a cache, never see a partial file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as fh:
+            yield fh
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def feature_cache_key(song_file_path, **params):
+    """Make a cache key from the contents of a file and the extraction parameters."""
+    key = hashlib.sha256(file_digest(song_file_path).encode())
+    key.update(json.dumps(params, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+def signal_features(x, sr=22050, hop_length=512, tuning=None):
+    """Calculate the L2 normed CENS chromagram and the Volume of the signal `x`.
+
+    Returns a dictionary with the chroma "C", and the "rms" and "volume" of
+    each frame. The `tuning` deviation (in fractions of a chroma bin) is
+    estimated from the signal if not given. The squared signal the chroma is
+    calculated from is not kept, as it is as large as the signal itself.
+    """
+    Y = np.abs(x) ** 2
+    C = librosa.feature.chroma_cens(y=Y, sr=sr, hop_length=hop_length, tuning=tuning)
+    rms = librosa.feature.rms(y=x, hop_length=hop_length)[0]
+    volume = np.clip(0.4 * np.log10(rms / 0.002), 0, 1)
+    return {"C": C, "rms": rms, "volume": volume}
+
+
+class FeatureStream:
+    """Calculate the features of `signal_features` incrementally from audio chunks.
+
+    Each frame's features are calculated from a window of audio reaching
+    `context` seconds before it and `lookahead` seconds after it, so the audio
+    held in memory and the work done per chunk are bounded however long the
+    stream runs. The tuning is estimated once, from the first `context`
+    seconds, rather than from the whole signal as `signal_features` does;
+    given the same tuning, the features match those of the whole signal.
+
+    Parameters
+    ----------
+    sr : int
+        (Default 22050) The sample rate of the audio.
+    hop_length : int
+        (Default 512) The number of samples between frames.
+    context : float
+        (Default 5) The seconds of audio before the new frames used to
+        calculate them.
+    lookahead : float
+        (Default 1) The seconds of audio after a frame that must arrive before
+        the frame is calculated.
+    step : float
+        (Default 1) The minimum seconds of new frames to calculate at once.
+    tuning : float
+        (Optional) The tuning deviation of the audio, see `signal_features`.
+    """
+
+    def __init__(
+        self, sr=22050, hop_length=512, context=5, lookahead=1, step=1, tuning=None
+    ):
+        self.sr = sr
+        self.hop_length = hop_length
+        self.tuning = tuning
+        self.context = int(context * sr)
+        self.context_frames = int(np.ceil(context * sr / hop_length))
+        self.lookahead = int(lookahead * sr)
+        self.step_frames = max(1, int(step * sr / hop_length))
+        self.audio = np.zeros(0, dtype=np.float32)
+        self.audio_start = 0
+        self.n_frames = 0
+
+    def feed(self, chunk):
+        """Add a chunk of audio, returning the features of any newly completed frames.
+
+        Returns None if there are no new frames yet, otherwise a dictionary of
+        the "C", "rms" and "volume" of the new frames.
+        """
+        self.audio = np.concatenate([self.audio, np.asarray(chunk, dtype=np.float32)])
+        end = self.audio_start + len(self.audio)
+        if self.tuning is None and end < self.context + self.lookahead:
+            return None
+        last = max(0, (end - self.lookahead) // self.hop_length)
+        if last - self.n_frames < self.step_frames:
+            return None
+        return self._calculate(last)
+
+    def flush(self):
+        """Calculate the features of all remaining frames, at the end of the stream."""
+        end = self.audio_start + len(self.audio)
+        last = 1 + end // self.hop_length
+        if last <= self.n_frames:
+            return None
+        return self._calculate(last)
+
+    def _calculate(self, last):
+        # Calculate the features over the context before the new frames. The
+        # start is kept on a frame boundary so frames line up with the stream.
+        first = max(0, self.n_frames - self.context_frames)
+        start = first * self.hop_length - self.audio_start
+        if self.tuning is None:
+            self.tuning = librosa.estimate_tuning(
+                y=np.abs(self.audio) ** 2, sr=self.sr, bins_per_octave=36
+            )
+        features = signal_features(
+            self.audio[start:], self.sr, self.hop_length, self.tuning
+        )
+        new = slice(self.n_frames - first, last - first)
+        features = {feat: features[feat][..., new] for feat in ["C", "rms", "volume"]}
+        self.n_frames = last
+
+        # Drop the audio that will no longer be needed for context.
+        keep_from = max(0, last - self.context_frames) * self.hop_length
+        self.audio = self.audio[keep_from - self.audio_start :]
+        self.audio_start = keep_from
+        return features
+
+
+def read_audio_blocks(path, block_duration=0.5, sr=22050, dur=None):
+    """Read an audio file in blocks of `block_duration` seconds, as mono at `sr`.
+
+    If `dur` is given, only the first `dur` seconds of the file are read.
+    """
+    with soundfile.SoundFile(path) as fh:
+        if fh.samplerate != sr:
+            resampler = soxr.ResampleStream(fh.samplerate, sr, 1, dtype="float32")
+        else:
+            resampler = None
+
+        block_size = int(block_duration * fh.samplerate)
+        frames = -1 if dur is None else int(dur * fh.samplerate)
+        for block in fh.blocks(
+            blocksize=block_size, frames=frames, dtype="float32", always_2d=True
+        ):
+            block = block.mean(axis=1)
+            if resampler is not None:
+                block = resampler.resample_chunk(block)
+            yield block
+        if resampler is not None:
+            yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+
+def stream_song_features(
+    song_file_path, dur=None, sr=22050, hop_length=512, block_duration=30, tuning=None
+):
+    """Calculate the features of `signal_features` from a file, a block at a time.
+
+    The file is decoded `block_duration` seconds at a time and fed through a
+    `FeatureStream`, so only a block of audio and its context are ever held,
+    however long the recording. The tuning is estimated from the first
+    `block_duration` seconds unless given. Returns float32 arrays of the "C",
+    "rms" and "volume" of each frame of the first `dur` seconds, or of the
+    whole file if `dur` is None.
+
+    Given the same tuning, the features match those of `signal_features` on
+    the whole signal, other than where rounding tips the chroma over one of
+    the CENS quantization steps.
+    """
+    if tuning is None:
+        x = np.concatenate(
+            list(read_audio_blocks(song_file_path, sr=sr, dur=block_duration))
+        )
+        tuning = librosa.estimate_tuning(y=np.abs(x) ** 2, sr=sr, bins_per_octave=36)
+        del x
+
+    # The lowest chroma filters and the CENS smoothing reach over a second
+    # past each frame, so wait for two seconds of audio beyond it.
+    stream = FeatureStream(
+        sr, hop_length, lookahead=2, step=block_duration, tuning=tuning
+    )
+    parts = []
+    for block in read_audio_blocks(song_file_path, block_duration, sr, dur):
+        parts.append(stream.feed(block))
+    parts.append(stream.flush())
+    parts = [part for part in parts if part is not None]
+    return {
+        feat: np.concatenate(
+            [part[feat].astype(np.float32) for part in parts], axis=-1
+        )
+        for feat in ["C", "rms", "volume"]
+    }
+
+
+def extract_song_features(
+    song_file_path, dur=180, sr=22050, hop_length=512, cache_dir=None, stream=False
+):
+    """Calculate the L2 normed CENS chromagram and the Volume of a single wav file.
+
+    Only the first `dur` seconds are used, or the whole recording if `dur` is
+    None. With `stream=True` the file is decoded a block at a time by
+    `stream_song_features`, so that long recordings, such as operas and
+    symphonies, can be parsed in full without holding the whole signal.
+
+    If `cache_dir` is given, the features are stored there as float32 arrays,
+    keyed by the file's contents and the extraction parameters, and are loaded
+    from there rather than recomputed when neither has changed.
+    """
+    song_file = os.path.basename(song_file_path)
+    if cache_dir is not None:
+        params = {"dur": dur, "sr": sr, "hop_length": hop_length, "chroma": "cens"}
+        if stream:
+            params["stream"] = True
+        key = feature_cache_key(song_file_path, **params)
+        cache_path = os.path.join(cache_dir, f"{key}.npz")
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                return {"song_file": song_file, **{k: cached[k] for k in cached.files}}
+
+    with span("extract"):
+        if stream:
+            features = stream_song_features(song_file_path, dur, sr, hop_length)
+        else:
+            x, sr = librosa.load(song_file_path, sr=sr, duration=dur)
+            features = signal_features(x, sr, hop_length)
+            del x
+    if cache_dir is None:
+        return {"song_file": song_file, **features}
+
+    features = {feat: values.astype(np.float32) for feat, values in features.items()}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with atomic_write(cache_path) as fh:
+        np.savez(fh, **features)
+    return {"song_file": song_file, **features}
+
+
+def profiled_call(func, *args, **kwargs):
+    """Call `func` in a worker process, returning its result and the spans it opened.
+
+    The spans are listed as from `Profiler.breakdown`, to be added to the
+    parent's profiler with `Profiler.merge`.
+    """
+    profiler.reset()
+    return func(*args, **kwargs), profiler.breakdown()
+
+
+def iter_song_data(
+    wav_dir="./wavs", n_workers=None, cache_dir=None, dur=180, stream=False
+):
+    """Extract the features of each wav file in `wav_dir` using a pool of processes.
+
+    The song data dictionaries are yielded as each file finishes, so they will
+    not necessarily be in directory order. Files that fail to parse are
+    reported and skipped. See `extract_song_features` for `cache_dir`, `dur`
+    and `stream`.
+
+    The time from the first song being requested until the last is yielded,
+    including any spent by the caller in between, is recorded as the "parse"
+    span of the profiler. The spans recorded by the workers, such as the
+    "extract" span of each song not already cached, are added within it, so
+    their times are summed over the workers rather than taken from the clock.
+    """
+    song_files = [fname for fname in os.listdir(wav_dir) if fname.endswith(".wav")]
+    with span("parse"), ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {
+            pool.submit(
+                profiled_call,
+                extract_song_features,
+                os.path.join(wav_dir, song_file),
+                dur=dur,
+                cache_dir=cache_dir,
+                stream=stream,
+            ): song_file
+            for song_file in song_files
+        }
+        for future in as_completed(futures):
+            song_file = futures[future]
+            try:
+                sd, stages = future.result()
+            except Exception as err:
+                print(f"Failed to parse {song_file}: {err!r}")
+                continue
+            profiler.merge(stages)
+            print(f"Parsed {song_file}")
+            yield sd
+
+
+def parse_song_data(
+    wav_dir="./wavs", n_workers=None, plot=False, cache_dir=None, dur=180, stream=False
+):
+    """Calculate L2 normed CENS chromagrams, alongside the Volume of the signals.
+
+    Parameters
+    ----------
+    wav_dir : str
+        (Default "./wavs") The directory containing the wav files.
+    n_workers : int
+        (Optional) The number of processes used to parse files, by default the
+        number of CPUs.
+    plot : bool
+        (Default False) If True, also plot the features with `plot_song_data`.
+    cache_dir : str
+        (Optional) A directory in which to cache the extracted features, so
+        unchanged files are not parsed again. See `extract_song_features`.
+    dur : float
+        (Default 180) The seconds parsed from the start of each file, or None
+        to parse each recording in full.
+    stream : bool
+        (Default False) If True, decode each file a block at a time, so that
+        memory use does not grow with the length of the recordings.
+    """
+    song_data = list(iter_song_data(wav_dir, n_workers, cache_dir, dur, stream))
+
+    # Restore the directory order, which the pool does not preserve.
+    order = {song_file: i for i, song_file in enumerate(os.listdir(wav_dir))}
+    song_data.sort(key=lambda sd: order[sd["song_file"]])
+
+    if plot:
+        plot_song_data(song_data)
+    return song_data
+
+
+def plot_song_data(song_data):
+    """Plot the chromagram and Volume of each song."""
     fig, axes = plt.subplots(
-        len(song_files), 2, sharex=True, figsize=(16, len(song_files) * 1.1)
+        len(song_data),
+        2,
+        sharex=True,
+        figsize=(16, len(song_data) * 1.1),
+        squeeze=False,
     )
-    song_data = []
-    L = 20  # seconds
-    dur = 180  # seconds
-    for i, song_file in enumerate(song_files):
-        song_file_path = os.path.join("./wavs", song_file)
-        print(song_file_path)
-        print("=" * len(song_file_path))
-
-        print("Loading...")
-        x, sr = librosa.load(song_file_path, duration=dur)
-        Y = np.abs(x) ** 2
-
-        print("Generating chroma...")
-        C = librosa.feature.chroma_cens(y=Y, sr=sr)
+    for i, sd in enumerate(song_data):
         ax1 = axes[i][0]
         spec_plt = librosa.display.specshow(
-            C, x_axis="time", y_axis="chroma", cmap="gray_r", ax=ax1
+            sd["C"], x_axis="time", y_axis="chroma", cmap="gray_r", ax=ax1
         )
         fig.colorbar(spec_plt, ax=ax1)
-        if i != len(song_files) - 1:
+        if i != len(song_data) - 1:
             ax1.set_xlabel("")
             ax1.set_xticklabels([])
 
-        print("Calculating Volume...")
         ax2 = axes[i][1]
-        rms = librosa.feature.rms(x)
-        volume = np.clip(0.4 * np.log10(rms[0] / 0.002), 0, 1)
-        ax2.plot(librosa.times_like(rms), volume)
+        ax2.plot(librosa.times_like(sd["volume"]), sd["volume"])
         ax2.set_ylim([0, 1])
         ax2.set_ylabel("dB")
-        if i != len(song_files) - 1:
+        if i != len(song_data) - 1:
             ax2.set_xlabel("")
             ax2.set_xticklabels([])
         else:
             ax2.set_xlabel("Time")
 
-        song_data.append(
-            {
-                "song_file": song_file,
-                "Y": Y,
-                "C": C,
-                "rms": rms[0],
-                "volume": volume,
-            }
-        )
-        print()
-
     pad = 5
     for ax, col in zip(axes[0], ["Chromagram", "Volume"]):
         ax.annotate(
@@ -83,9 +409,9 @@ def parse_song_data():
             va="baseline",
         )
 
-    for ax, row in zip(axes[:, 0], song_files):
+    for ax, sd in zip(axes[:, 0], song_data):
         ax.annotate(
-            row.split(".")[0],
+            sd["song_file"].split(".")[0],
             xy=(0, 0.5),
             xytext=(-ax.yaxis.labelpad - pad, 0),
             xycoords=ax.yaxis.label,
@@ -98,8 +424,7 @@ def parse_song_data():
     fig.subplots_adjust(
         left=0.2, right=0.98, wspace=0.1, hspace=0.3, bottom=0.07, top=0.93
     )
-
-    return song_data
+    return fig
 
 
 def parse_song_file_name(file_name):
@@ -107,194 +432,1300 @@ def parse_song_file_name(file_name):
     return file_name.split(".")[0].split("_")
 
 
-def make_shingles(D, L, dur, hop=None):
-    """Make shingles of the array D."""
-    N = D.shape[1]
+SONG_FIELDS = ["composer", "piece", "performer"]
+
+
+def make_song_table(song_ids, fields=SONG_FIELDS):
+    """Intern the metadata of each song as integer codes.
+
+    Parameters
+    ----------
+    song_ids : list
+        The song id of each song, as from `parse_song_file_name`.
+    fields : list
+        (Default SONG_FIELDS) The names of the parts of the song ids. Songs
+        missing any of the parts are given empty strings.
+
+    Returns
+    -------
+    dict
+        The table, with the "fields", the sorted distinct values of each field
+        as "categories", and the (n_songs, n_fields) int32 "codes" of each
+        song's values in them.
+    """
+    values = np.array(
+        [
+            [str(song_id[j]) if j < len(song_id) else "" for j in range(len(fields))]
+            for song_id in song_ids
+        ],
+        dtype=str,
+    ).reshape(len(song_ids), len(fields))
+    categories = {}
+    codes = np.empty((len(values), len(fields)), dtype=np.int32)
+    for j, field in enumerate(fields):
+        categories[field], codes[:, j] = np.unique(values[:, j], return_inverse=True)
+    return {"fields": list(fields), "categories": categories, "codes": codes}
+
+
+def song_codes(table, field):
+    """Get the integer code of each song's value of `field`."""
+    return table["codes"][:, table["fields"].index(field)]
+
+
+def song_mask(table, **values):
+    """Select the songs whose fields have the given values, as a boolean mask.
+
+    Each value may be a single string or a list of strings, any of which
+    match. For example, `song_mask(table, composer="Chopin")`.
+    """
+    mask = np.ones(len(table["codes"]), dtype=bool)
+    for field, value in values.items():
+        categories = table["categories"][field]
+        wanted = np.flatnonzero(np.isin(categories, np.atleast_1d(value)))
+        mask &= np.isin(song_codes(table, field), wanted)
+    return mask
+
+
+def group_songs(table, fields):
+    """Group the songs by the combined values of `fields`, such as composer and piece.
+
+    Returns the (n_groups, len(fields)) codes of each group, and the index of
+    each song's group.
+    """
+    columns = [table["fields"].index(field) for field in fields]
+    groups, inverse = np.unique(
+        table["codes"][:, columns], axis=0, return_inverse=True
+    )
+    return groups, inverse.reshape(-1)
+
+
+def song_labels(table, fields, sep=" "):
+    """Join the values of `fields` of each song into a string label."""
+    parts = [table["categories"][field][song_codes(table, field)] for field in fields]
+    labels = parts[0]
+    for part in parts[1:]:
+        labels = np.char.add(np.char.add(labels, sep), part)
+    return labels
+
+
+def song_duration(sd, sr=22050, hop_length=512):
+    """Get the duration in seconds spanned by the frames of a song's features.
+
+    Pass this as the `dur` of `make_shingles` and the pooling functions, so
+    that shingles span the same time in every song, however long it is.
+    """
+    return len(sd["volume"]) * hop_length / sr
+
+
+def shingle_params(N, L, dur, hop=None):
+    """Convert a shingle length `L` and `hop` in seconds into numbers of frames.
+
+    `N` is the number of frames spanning the duration `dur`, in seconds.
+    """
     LL = int(L * N / dur)
 
     if hop is None:
         H = 1
     else:
         H = int(hop * N / dur)
+    return LL, H
+
+
+def make_shingles(D, L, dur, hop=None, view=False):
+    """Make shingles of the array D.
+
+    With `view=True` the shingles are returned as a read-only strided view
+    into D rather than a copy, so no memory is used beyond that of D itself.
+    Use `flatten_shingles` to materialize a view when a flat copy is needed.
+    """
+    LL, H = shingle_params(D.shape[1], L, dur, hop)
+
+    # Windows are taken along the time axis, giving (channels, windows, LL),
+    # which is then re-ordered to (windows, channels, LL).
+    windows = np.lib.stride_tricks.sliding_window_view(D, LL, axis=1)[:, ::H]
+    shingles = windows.transpose(1, 0, 2)
+    if view:
+        return shingles
+    return np.ascontiguousarray(shingles)
+
+
+def flatten_shingles(S):
+    """Materialize shingles as a contiguous (n_shingles, n_features) array."""
+    sh = S.shape
+    return np.ascontiguousarray(S).reshape(sh[0], sh[1] * sh[2])
 
-    return np.stack(
-        [D[:, (i * H) : (i * H + LL)] for i in range(0, int((N - LL) / H) + 1)]
-    )
 
+def pool_mean(F, L, dur, hop=None):
+    """Downsample F to the mean of each window of `make_shingles(F, L, dur, hop)`.
 
-def compute_scores(test_idx, shingle_idx, data):
-    """Compute the scores between a query and the available data."""
-    x = data[test_idx]["D"][shingle_idx]
+    The means are taken over a strided view of the windows, so they are the
+    same, bit for bit, as the mean of each window taken one at a time.
+    Returns an array of shape (channels, windows).
+    """
+    return np.mean(make_shingles(F, L, dur, hop, view=True), axis=2).T
+
+
+def pool_median(F, L, dur, hop=None):
+    """Downsample F to the median of each window of `make_shingles(F, L, dur, hop)`.
+
+    Returns an array of shape (channels, windows).
+    """
+    return np.median(make_shingles(F, L, dur, hop, view=True), axis=2).T
+
+
+def pool_max(F, L, dur, hop=None):
+    """Downsample F to the maximum of each window of `make_shingles(F, L, dur, hop)`.
+
+    Returns an array of shape (channels, windows).
+    """
+    return np.max(make_shingles(F, L, dur, hop, view=True), axis=2).T
+
+
+def decimate(F, step):
+    """Downsample F by keeping every `step`-th frame, as a view into F."""
+    return F[:, ::step]
+
+
+def make_score_index(data, dtype=None):
+    """Pack the shingles of every song in `data` into one contiguous matrix.
+
+    The returned dictionary holds the stacked shingles "D", their squared
+    norms "norms", the "offsets" of each song's first shingle (with the total
+    number of shingles appended), and the "song_ids" of each song.
+
+    If `dtype` is given, such as np.float32 or np.float16, the shingles are
+    stored as that type instead, to fit a larger corpus in memory.
+    """
+    lengths = [len(sd["D"]) for sd in data]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    D = np.ascontiguousarray(np.concatenate([sd["D"] for sd in data], dtype=dtype))
+    return {
+        "D": D,
+        "norms": np.einsum(
+            "ij,ij->i", D, D, dtype=np.result_type(D.dtype, np.float32)
+        ),
+        "offsets": offsets,
+        "song_ids": [sd["song_id"] for sd in data],
+    }
+
+
+def segment_min(values, offsets):
+    """Find the minimum of each song's segment along the last axis of `values`.
+
+    Returns the minima and the position of the first minimum within each
+    segment, both of shape (n_rows, n_songs).
+    """
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    mins = np.minimum.reduceat(values, starts, axis=1)
+    at_min = values == np.repeat(mins, lengths, axis=1)
+
+    # Weight each position by how far it is from the end of its segment, so
+    # the first minimum has the largest weight. Small weights are quicker.
+    dtype = np.int16 if lengths.max(initial=0) < 2**15 else np.int64
+    weights = (np.repeat(offsets[1:], lengths) - np.arange(offsets[-1])).astype(dtype)
+    return mins, lengths - np.maximum.reduceat(at_min * weights, starts, axis=1)
+
+
+def song_blocks(offsets, block_size):
+    """Split the songs at `offsets` into runs of at most `block_size` shingles.
+
+    Returns a list of (start, end) song indices. Each run holds as many whole
+    songs as fit in `block_size` shingles, or a single song that is longer.
+    """
+    blocks = []
+    start = 0
+    n_songs = len(offsets) - 1
+    while start < n_songs:
+        end = np.searchsorted(offsets, offsets[start] + block_size, side="right") - 1
+        end = min(max(int(end), start + 1), n_songs)
+        blocks.append((start, end))
+        start = end
+    return blocks
+
+
+def score_batch_size(index, max_memory=2**28, block_size=65536):
+    """Get the number of queries to score at once within `max_memory` bytes.
+
+    This counts the arrays that `batch_song_scores` builds for the distances
+    between a batch of queries and a block of songs, including those of
+    `segment_min`, since these grow with both the batch and the block.
+    """
+    offsets = index["offsets"]
+    lengths = np.diff(offsets)
+    blocks = song_blocks(offsets, block_size)
+    width = max((offsets[end] - offsets[start] for start, end in blocks), default=0)
+    itemsize = np.result_type(index["D"].dtype, np.float32).itemsize
+    weight_size = 2 if lengths.max(initial=0) < 2**15 else 8
+
+    # The distances, their product term and the repeated minima, along with
+    # the mask of the minima and its weights.
+    per_query = int(width) * (3 * itemsize + 1 + weight_size)
+    return max(1, max_memory // max(per_query, 1))
+
+
+def compute_batch_scores(
+    X, index, exclude=None, batch_size=None, block_size=65536, max_memory=2**28
+):
+    """Compute the scores between each query in `X` and every song in `index`.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        A (n_queries, n_features) array of query shingles.
+    index : dict
+        The packed song shingles, as returned by `make_score_index`.
+    exclude : list
+        (Optional) For each query, the index of a song to leave out of its
+        scores, usually the song the query was taken from.
+    batch_size : int
+        (Optional) The number of queries to score at once. By default, as many
+        as fit in `max_memory`, from `score_batch_size`.
+    block_size : int
+        (Default 65536) The number of shingles each batch is scored against at
+        once, in runs of whole songs, as by `song_blocks`.
+    max_memory : int
+        (Default 2**28) The bytes of intermediate arrays to size the batches
+        for, when `batch_size` is not given.
+
+    Returns
+    -------
+    list
+        For each query, a sorted list of (score, song_id, idx, shingle_idx)
+        tuples, one per song, as returned by `compute_scores`.
+    """
+    X = np.atleast_2d(X)
+    song_ids = index["song_ids"]
+    if batch_size is None:
+        batch_size = score_batch_size(index, max_memory, block_size)
+
+    all_scores = []
+    for b in range(0, len(X), batch_size):
+        best_scores, min_idxs = batch_song_scores(
+            X[b : b + batch_size], index, block_size
+        )
+        skip = None if exclude is None else exclude[b : b + batch_size]
+        all_scores += rank_songs(best_scores, song_ids, min_idxs, skip)
+    return all_scores
+
+
+def rank_songs(best_scores, song_ids, min_idxs, exclude=None, *extra):
+    """Sort the best score of every song for each query of a batch.
+
+    Parameters
+    ----------
+    best_scores : np.ndarray
+        The (n_queries, n_songs) best score of each query against each song.
+    song_ids : list
+        The song id of each song.
+    min_idxs : np.ndarray
+        The (n_queries, n_songs) index of the best shingle of each song.
+    exclude : list
+        (Optional) For each query, the index of a song to leave out.
+    *extra : np.ndarray
+        (Optional) Any other (n_queries, n_songs) integer arrays, whose values
+        are appended to each tuple, such as the best transposition.
+
+    Returns
+    -------
+    list
+        For each query, a sorted list of (score, song_id, idx, shingle_idx)
+        tuples, one per song, followed by the values of any `extra` arrays.
+    """
+    all_scores = []
+    for i in range(len(best_scores)):
+        skip = None if exclude is None else exclude[i]
+        rows = zip(
+            best_scores[i],
+            song_ids,
+            range(len(song_ids)),
+            min_idxs[i].tolist(),
+            *(values[i].tolist() for values in extra),
+        )
+        scores = [row for row in rows if row[2] != skip]
+        scores.sort()
+        all_scores.append(scores)
+    return all_scores
+
+
+def batch_song_scores(Q, index, block_size=65536):
+    """Score a batch of queries `Q` against every song in `index`, as arrays.
+
+    Returns the (n_queries, n_songs) arrays of each song's score and the
+    position of its nearest shingle, as used by `compute_batch_scores`. The
+    songs are scored in blocks of about `block_size` shingles, from
+    `song_blocks`, so the distances are never held for the whole index.
+    """
+    D = index["D"]
+    offsets = index["offsets"]
+    norms = index["norms"]
+
+    # Score in the precision of the shingles, but no less than single.
+    dtype = np.result_type(D.dtype, np.float32)
+    Q = Q.astype(dtype, copy=False)
+    q_norms = np.einsum("ij,ij->i", Q, Q)
+
+    min_idxs = np.empty((len(Q), len(offsets) - 1), dtype=np.int64)
+    for start, end in song_blocks(offsets, block_size):
+        lo, hi = offsets[start], offsets[end]
+        block = D[lo:hi].astype(dtype, copy=False)
+
+        # Expand ||q - d||^2 = ||q||^2 + ||d||^2 - 2 q.d to avoid differences.
+        sq_dists = q_norms[:, None] + norms[None, lo:hi]
+        products = Q @ block.T
+        products *= 2
+        sq_dists -= products
+        del products
+        _, min_idxs[:, start:end] = segment_min(sq_dists, offsets[start : end + 1] - lo)
+
+    # Recompute the winning distances directly to avoid cancellation error.
+    best = D[offsets[:-1] + min_idxs] - Q[:, None, :]
+    best_scores = np.sqrt(np.einsum("ijk,ijk->ij", best, best))
+    return best_scores, min_idxs
+
+
+def compute_scores(test_idx, shingle_idx, data, index=None):
+    """Compute the scores between a query and the available data.
+
+    If `index` (from `make_score_index`) is not given it is built from `data`;
+    pass it in when scoring many queries against the same data.
+    """
+    if index is None:
+        index = make_score_index(data)
+    x = index["D"][index["offsets"][test_idx] + shingle_idx]
+    return compute_batch_scores(x, index, exclude=[test_idx])[0]
+
+
+def array_digest(*arrays):
+    """Compute a hash of the contents of the given arrays."""
+    digest = hashlib.blake2b(digest_size=16)
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        digest.update(str((arr.dtype, arr.shape)).encode())
+        digest.update(arr.data)
+    return digest.hexdigest()
+
+
+def corpus_digest(song_data):
+    """Compute a hash identifying the contents of a corpus of song data."""
+    digest = hashlib.blake2b(digest_size=16)
+    for sd in song_data:
+        digest.update(sd["song_file"].encode())
+        digest.update(array_digest(sd["C"], sd["volume"]).encode())
+    return digest.hexdigest()
+
+
+def embedding_key(f):
+    """Make a key identifying the embedding function `f` by its source code."""
+    try:
+        source = inspect.getsource(f)
+    except (OSError, TypeError):
+        source = ""
+    ident = f"{f.__module__}.{f.__qualname__}\n{source}"
+    return hashlib.blake2b(ident.encode(), digest_size=16).hexdigest()
 
-    scores = []
-    for j, sd in enumerate(data):
-        if j == test_idx:
-            continue
-        score_arr = np.linalg.norm(sd["D"] - x, axis=1)
-        min_idx = int(np.where(score_arr == score_arr.min())[0][0])
-        scores.append((score_arr[min_idx], sd["song_id"], j, min_idx))
-    scores.sort()
-    return scores
+
+class EmbeddingCache:
+    """Cache the embeddings of songs, so each is only computed once per embedding.
+
+    Embeddings are kept in memory in least-recently-used order, and optionally
+    also saved in `cache_dir` so they survive between runs. Each tier evicts
+    its least recently used entries once it grows beyond its size limit. The
+    entries on disk are tracked in memory, from a single scan of `cache_dir`
+    when the cache is made, so entries added since by other processes are
+    only counted once they are read.
+
+    Parameters
+    ----------
+    max_memory : int
+        (Default 1 GiB) The maximum number of bytes of embeddings held in memory.
+    cache_dir : str
+        (Optional) A directory in which to also store embeddings on disk.
+    max_disk : int
+        (Default 10 GiB) The maximum number of bytes stored in `cache_dir`.
+    """
+
+    def __init__(self, max_memory=2**30, cache_dir=None, max_disk=10 * 2**30):
+        self.max_memory = max_memory
+        self.cache_dir = cache_dir
+        self.max_disk = max_disk
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            entries = [e for e in os.scandir(cache_dir) if e.name.endswith(".npy")]
+            for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+                self._put_disk(entry.name[: -len(".npy")], entry.stat().st_size)
+
+    def memoize(self, f=None, key=""):
+        """Wrap the embedding function `f` so its results are cached.
+
+        The cache is keyed by the source of `f` and the contents of each song,
+        so editing the function or the data invalidates old entries. Functions
+        that depend on other state, such as a fitted PCA, should pass a `key`
+        identifying that state, or a callable returning it, which is only called
+        when the function is first used, so the state can be made lazily. May
+        be used as a decorator, with or without arguments.
+        """
+        if f is None:
+            return lambda f: self.memoize(f, key)
+
+        @functools.cache
+        def f_key():
+            return embedding_key(f) + (key() if callable(key) else key)
+
+        @functools.wraps(f)
+        def memoized(sd):
+            song_key = array_digest(sd["C"], sd["volume"])
+            entry_key = hashlib.blake2b(
+                f"{f_key()}-{sd['song_file']}-{song_key}".encode(), digest_size=16
+            ).hexdigest()
+            D = self.get(entry_key)
+            if D is None:
+                D = np.asarray(f(sd))
+                self.put(entry_key, D)
+            return D
+
+        return memoized
+
+    def get(self, key):
+        """Get a cached embedding, or None if it is not cached."""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if self.cache_dir is None:
+            return None
+
+        path = os.path.join(self.cache_dir, f"{key}.npy")
+        try:
+            D = np.load(path)
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        self._put_disk(key, os.path.getsize(path))
+        self._put_memory(key, D)
+        return D
+
+    def put(self, key, D):
+        """Add an embedding to the cache."""
+        self._put_memory(key, D)
+        if self.cache_dir is None:
+            return
+
+        path = os.path.join(self.cache_dir, f"{key}.npy")
+        with atomic_write(path) as fh:
+            np.save(fh, D)
+        self._put_disk(key, os.path.getsize(path))
+        self._evict_disk()
+
+    def _put_memory(self, key, D):
+        D.flags.writeable = False
+        if key in self._memory:
+            self._memory_size -= self._memory.pop(key).nbytes
+        self._memory[key] = D
+        self._memory_size += D.nbytes
+        while self._memory_size > self.max_memory and len(self._memory) > 1:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= old.nbytes
+
+    def _put_disk(self, key, size):
+        self._disk_size += size - self._disk.pop(key, 0)
+        self._disk[key] = size
+
+    def _evict_disk(self):
+        while self._disk_size > self.max_disk and len(self._disk) > 1:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, f"{key}.npy"))
+            except FileNotFoundError:
+                pass
 
 
 def apply_embedding(song_data, f):
     """Apply the embedding function to the raw data."""
     data = []
-    for sd in song_data:
-        new_D = f(sd)
-        data.append({"song_id": parse_song_file_name(sd["song_file"]), "D": new_D})
+    with span("embed"):
+        for sd in song_data:
+            new_D = f(sd)
+            data.append({"song_id": parse_song_file_name(sd["song_file"]), "D": new_D})
     return data
 
 
-def run_experiment(n_samples, song_data, f, quiet=True):
+def save_score_index(index, path):
+    """Save a score index to the directory `path`, for `load_score_index`."""
+    os.makedirs(path, exist_ok=True)
+    for key in ["D", "norms", "offsets"]:
+        np.save(os.path.join(path, f"{key}.npy"), index[key])
+    with open(os.path.join(path, "song_ids.json"), "w") as fh:
+        json.dump(index["song_ids"], fh)
+
+
+def write_score_index(data, path, dtype=None):
+    """Pack the shingles of every song in `data` straight into a saved score index.
+
+    The same as saving `make_score_index(data, dtype)` with `save_score_index`,
+    but each song's shingles are copied directly into the memory-mapped file,
+    so the packed matrix is never held in memory as well. Returns the index
+    loaded from `path`, as by `load_score_index`.
+    """
+    os.makedirs(path, exist_ok=True)
+    lengths = [len(sd["D"]) for sd in data]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    if dtype is None:
+        dtype = np.result_type(*[sd["D"].dtype for sd in data])
+    D = np.lib.format.open_memmap(
+        os.path.join(path, "D.npy"),
+        mode="w+",
+        dtype=dtype,
+        shape=(int(offsets[-1]), data[0]["D"].shape[1]),
+    )
+    for sd, start, end in zip(data, offsets[:-1], offsets[1:]):
+        D[start:end] = sd["D"]
+    D.flush()
+
+    norms = np.einsum("ij,ij->i", D, D, dtype=np.result_type(D.dtype, np.float32))
+    np.save(os.path.join(path, "norms.npy"), norms)
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    with open(os.path.join(path, "song_ids.json"), "w") as fh:
+        json.dump([sd["song_id"] for sd in data], fh)
+    del D
+    return load_score_index(path)
+
+
+def load_score_index(path):
+    """Load a score index saved by `save_score_index`, with its arrays memory-mapped.
+
+    The index also records the "path" it was loaded from, so that worker
+    processes can map the same files rather than a copy of them.
+    """
+    index = {
+        key: np.load(os.path.join(path, f"{key}.npy"), mmap_mode="r")
+        for key in ["D", "norms", "offsets"]
+    }
+    with open(os.path.join(path, "song_ids.json")) as fh:
+        index["song_ids"] = json.load(fh)
+    index["path"] = path
+    return index
+
+
+def score_index_songs(index):
+    """Get the song data of `index`, with each song's shingles as a view into it."""
+    offsets = index["offsets"]
+    return [
+        {"song_id": song_id, "D": index["D"][offsets[j] : offsets[j + 1]]}
+        for j, song_id in enumerate(index["song_ids"])
+    ]
+
+
+def shared_memory_dir():
+    """Get the directory for temporary files shared between processes.
+
+    This is /dev/shm where there is one, so the files are held in memory, and
+    otherwise None, for the system's default temporary directory.
+    """
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+@contextmanager
+def shared_score_index(index):
+    """Get a directory holding `index`, for worker processes to memory-map.
+
+    An index loaded from disk is shared from where it is. Otherwise it is
+    saved to a temporary directory, in shared memory where available, which
+    is removed on exit.
+    """
+    if "path" in index:
+        yield index["path"]
+        return
+    with tempfile.TemporaryDirectory(dir=shared_memory_dir()) as tmp_dir:
+        save_score_index(index, tmp_dir)
+        yield tmp_dir
+
+
+# The score index loaded by each worker process of `compute_parallel_scores`.
+worker_index = None
+
+
+def init_score_worker(path):
+    """Load the score index shared with a worker process."""
+    global worker_index
+    worker_index = load_score_index(path)
+
+
+def score_worker_rows(rows, exclude):
+    """Score the shingles at `rows` of the worker's score index."""
+    return compute_batch_scores(worker_index["D"][rows], worker_index, exclude)
+
+
+def compute_parallel_scores(rows, exclude, index, n_workers=None, chunk_size=32):
+    """Score the shingles at `rows` of `index` using a pool of processes.
+
+    The index is shared with the workers by `shared_score_index`, which each
+    worker memory-maps, so it is never pickled. No more than one chunk of
+    rows is scored in this process, without starting a pool. Returns the
+    same scores, in the same order, as `compute_batch_scores`.
+    """
+    if n_workers == 1 or len(rows) <= chunk_size:
+        return compute_batch_scores(index["D"][rows], index, exclude)
+    with shared_score_index(index) as path:
+        with ProcessPoolExecutor(
+            n_workers, initializer=init_score_worker, initargs=(path,)
+        ) as pool:
+            chunks = pool.map(
+                score_worker_rows,
+                [rows[b : b + chunk_size] for b in range(0, len(rows), chunk_size)],
+                [exclude[b : b + chunk_size] for b in range(0, len(rows), chunk_size)],
+            )
+            return [scores for chunk in chunks for scores in chunk]
+
+
+def match(s_id_1, s_id_2):
+    """Check if two song ids are of the same piece."""
+    return s_id_1[:1] == s_id_2[:1]
+
+
+def sample_queries(data, n_samples, seed):
+    """Choose a random song, and a random shingle from it, for `n_samples` trials.
+
+    Each trial is seeded separately from `seed`, so the same trials are drawn
+    however they are later split up. Returns a list of [song_id, test_idx,
+    shingle_idx] queries.
+    """
+    queries = []
+    for i in range(n_samples):
+        rng = np.random.default_rng([seed, i])
+        test_idx = int(rng.integers(len(data)))
+        shingle_idx = int(rng.integers(len(data[test_idx]["D"])))
+        queries.append([data[test_idx]["song_id"], test_idx, shingle_idx])
+    return queries
+
+
+def score_metrics(song_id, scores):
+    """Measure how well the sorted `scores` for a query from `song_id` did.
+
+    Returns whether the top song is a match, the fraction of the matching
+    songs that rank above every other song, and the average rank of the
+    matching songs.
+    """
+    # Check if the top is a match
+    all_matches = [match(other[1], song_id) for other in scores]
+    tf = all_matches[0]
+
+    # Check what fraction of the matches are in the top.
+    num_matches = sum(all_matches)
+    num_top_matches = all_matches.index(False)
+    nit = num_top_matches / num_matches
+
+    # Calculate the average distance of matches from the top.
+    ave = sum(i for i, m in enumerate(all_matches) if m) / num_matches
+    return tf, nit, ave
+
+
+def song_tie_order(song_ids):
+    """Get the order in which `score_metrics` ranks songs with equal scores."""
+    return np.array(
+        sorted(range(len(song_ids)), key=lambda j: (song_ids[j], j)), dtype=np.int64
+    )
+
+
+def rank_metrics(scores, matches, tie_order=None):
+    """Measure `score_metrics` for many queries at once, from arrays of scores.
+
+    Parameters
+    ----------
+    scores : np.ndarray
+        A (n_queries, n_songs) array of each song's score for each query, where
+        the songs left out of a query's ranking are scored as infinite.
+    matches : np.ndarray
+        A (n_queries, n_songs) boolean array of whether each song matches the
+        query, as by `match`.
+    tie_order : np.ndarray
+        (Optional) The order in which songs with equal scores are ranked, such
+        as from `song_tie_order`. By default they are ranked by index.
+
+    Returns
+    -------
+    dict
+        Arrays of the "top_found", "num_in_top" and "ave_dist" of each query,
+        as from `score_metrics`, and the index of the "top_song". The last two
+        metrics are NaN for queries without any matching songs.
+    """
+    if tie_order is not None:
+        scores = scores[:, tie_order]
+        matches = matches[:, tie_order]
+    order = np.argsort(scores, axis=1, kind="stable")
+    ranked = np.take_along_axis(matches, order, axis=1)
+    ranked &= np.isfinite(np.take_along_axis(scores, order, axis=1))
+
+    # Count the matches ranked above every other song, and the ranks of all.
+    n_matches = ranked.sum(axis=1)
+    n_top = np.where(ranked.all(axis=1), n_matches, np.argmin(ranked, axis=1))
+    rank_sums = ranked @ np.arange(ranked.shape[1])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        num_in_top = n_top / n_matches
+        ave_dist = rank_sums / n_matches
+
+    top_song = order[:, 0] if tie_order is None else tie_order[order[:, 0]]
+    return {
+        "top_found": ranked[:, 0],
+        "num_in_top": num_in_top,
+        "ave_dist": ave_dist,
+        "top_song": top_song,
+    }
+
+
+def evaluate_shingles(rows, index, tie_order, groups, block_size=65536):
+    """Score the shingles at `rows` of `index` as queries, leaving out their songs.
+
+    `tie_order` is from `song_tie_order`, and `groups` gives the group of each
+    song from `group_songs`, by the parts of the song ids compared by `match`,
+    since songs match when these are equal. Returns the per-query arrays from
+    `rank_metrics`.
+    """
+    own = np.searchsorted(index["offsets"], rows, side="right") - 1
+    scores, _ = batch_song_scores(index["D"][rows], index, block_size)
+    scores[np.arange(len(rows)), own] = np.inf
+    matches = groups[None, :] == groups[own][:, None]
+    return rank_metrics(scores, matches, tie_order)
+
+
+def evaluate_worker_rows(rows, tie_order, groups, block_size=65536):
+    """Evaluate the shingles at `rows` of the worker's score index."""
+    return evaluate_shingles(rows, worker_index, tie_order, groups, block_size)
+
+
+def evaluate_all_shingles(
+    index, batch_size=None, block_size=65536, n_workers=1, max_memory=2**28, stride=1
+):
+    """Score every shingle in `index` as a query, leaving out its own song.
+
+    Each batch of queries is scored against the whole index as by
+    `compute_batch_scores`, and its rankings are reduced straight to the
+    metrics of `score_metrics` by `rank_metrics`, so no lists of scores are
+    built. By default the batches are sized to `max_memory` bytes in each
+    process, by `score_batch_size`. If `n_workers` is not 1, the batches are
+    spread over a pool of processes as in `compute_parallel_scores` (None
+    uses every CPU).
+
+    With a `stride` above 1, only every `stride`-th shingle of each song is
+    a query, which costs that many times less. A stride of the shingle
+    length leaves no two queries of a song overlapping.
+
+    Returns the per-query arrays from `rank_metrics`, along with the
+    "song_idxs" and "shingle_idxs" of each query.
+    """
+    offsets = index["offsets"]
+    song_ids = index["song_ids"]
+    n_shingles = int(offsets[-1])
+    tie_order = song_tie_order(song_ids)
+    # Songs match when the first part of their ids, the composer, is the same.
+    _, groups = group_songs(make_song_table(song_ids), SONG_FIELDS[:1])
+    song_idxs = np.repeat(np.arange(len(song_ids)), np.diff(offsets))
+    shingle_idxs = np.arange(n_shingles) - offsets[song_idxs]
+    queries = np.flatnonzero(shingle_idxs % stride == 0)
+    if batch_size is None:
+        batch_size = score_batch_size(index, max_memory, block_size)
+    batches = [queries[b : b + batch_size] for b in range(0, len(queries), batch_size)]
+
+    if n_workers == 1 or len(batches) <= 1:
+        parts = [
+            evaluate_shingles(rows, index, tie_order, groups, block_size)
+            for rows in batches
+        ]
+    else:
+        with shared_score_index(index) as path:
+            with ProcessPoolExecutor(
+                n_workers, initializer=init_score_worker, initargs=(path,)
+            ) as pool:
+                parts = list(
+                    pool.map(
+                        evaluate_worker_rows,
+                        batches,
+                        [tie_order] * len(batches),
+                        [groups] * len(batches),
+                        [block_size] * len(batches),
+                    )
+                )
+
+    keys = ["top_found", "num_in_top", "ave_dist", "top_song"]
+    metrics = {key: np.concatenate([part[key] for part in parts]) for key in keys}
+    metrics["song_idxs"] = song_idxs[queries]
+    metrics["shingle_idxs"] = shingle_idxs[queries]
+    return metrics
+
+
+def clustered_interval(values, clusters, z=1.96):
+    """Estimate the mean of `values` and a confidence interval, grouped in `clusters`.
+
+    The shingles of a song overlap, so queries from the same song are far
+    from independent. The standard error is therefore estimated from the
+    total deviation of each cluster, such as each song, rather than of each
+    value. NaN values are left out. Returns the mean, and the half-width of
+    the interval of `z` standard errors (1.96 for 95%).
+
+    For an exhaustive run the mean is exact, and the interval shows how much
+    it would vary over another corpus of similar songs. The interval is a
+    normal approximation, so it is too narrow when almost every value is the
+    same, such as a `P_f` of 1 over a small sample.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    values = values[valid]
+    if not len(values):
+        return np.nan, np.nan
+    mean = values.mean()
+    _, inverse = np.unique(np.asarray(clusters)[valid], return_inverse=True)
+    deviations = np.bincount(inverse.reshape(-1), values - mean)
+    n = len(deviations)
+    if n < 2:
+        return mean, np.nan
+    se = np.sqrt(n / (n - 1) * np.sum(deviations**2)) / len(values)
+    return mean, z * se
+
+
+# The summary metrics of a run, in the order of the report's columns.
+SUMMARY_KEYS = [
+    "fraction_found",
+    "average_first_match",
+    "average_average_distance",
+    "average_time",
+    "amortized_time",
+]
+
+
+def run_experiment(
+    n_samples,
+    song_data,
+    f,
+    quiet=True,
+    n_workers=1,
+    seed=None,
+    plot="background",
+    umap_sample=20000,
+    ingest_stages=None,
+    query_stride=1,
+):
     """Run an experiment with an encoding function `f`.
 
     Parameters
     ----------
     n_samples : int
-        The number of trials to run in the experiment.
+        The number of trials to run in the experiment. If None, every shingle
+        of every song is used as a query once, with `evaluate_all_shingles`,
+        giving the exact metrics of the whole corpus. Only the metrics of each
+        query are then saved, rather than its full ranking of the songs.
     song_data : list
         The list of data dictionaries for each piece of music.
     f : callable
         A function or callable that takes in a song_data dictionary, and outputs a 1-D array.
     quiet : bool
         (Default True) Indicate how much detail to give in the printouts.
+    n_workers : int
+        (Default 1) The number of processes to spread the trials across. If
+        None, use the number of CPUs.
+    seed : int
+        (Optional) The seed from which each trial's query is chosen. Each trial
+        is seeded separately, so the results do not depend on `n_workers`. If
+        not given, a seed is drawn from `random`.
+    plot : str
+        (Default "background") When to plot the UMAP of the embedding: in the
+        "background" while the trials run, in the "foreground" before them,
+        or not at all if None. In the background, only the launch of the plot
+        is profiled, as the "umap_launch" stage.
+    umap_sample : int
+        (Default 20000) The number of shingles the UMAP is fitted to. The
+        fitted UMAP is cached, so it is only fitted once per embedding.
+    ingest_stages : list
+        (Optional) The breakdown of the stages that ingested `song_data`, such
+        as from `corpus_stages`, to be saved with those of this run. Spans
+        recorded before the run are otherwise not saved.
+    query_stride : int
+        (Default 1) When `n_samples` is None, use only every `query_stride`-th
+        shingle of each song as a query, as the `stride` of
+        `evaluate_all_shingles`.
     """
 
-    # Define a shortcut function for checking if two pieces are the same.
-    def match(s_id_1, s_id_2):
-        return s_id_1[:1] == s_id_2[:1]
-
-    print("Plotting umap....")
-    umap, fig_name = plot_umap(song_data, f)
+    # Only record the stages of this run.
+    profiler.reset()
 
     # Compute the encodings for each shingle
     print("Applying embedding...")
     data = apply_embedding(song_data, f)
-    N_s = len(data)
-
-    # Set up the lists of values to track
-    top_found = []
-    num_in_top = []
-    ave_dist = []
-    score_orders = []
-    queries = []
-    times = []
-
-    # Run the experiment n_samples times.
-    print("Running experiments...")
-    for i in range(n_samples):
 
-        # Choose a random song
-        test_idx = random.randrange(N_s)
-        search = data[test_idx]
-
-        # Choose a random shingle.
-        shingle_idx = random.randrange(len(search["D"]))
-        song_id = data[test_idx]["song_id"]
-        queries.append([song_id, test_idx, shingle_idx])
-
-        # Calculate the score for each other song.
-        print(f"\n{i+1}/{n_samples}", song_id, shingle_idx)
+    # Pack the encodings for fast scoring, straight into shared memory if they
+    # are to be scored by a pool of processes. Each song's encodings are then
+    # replaced by a view into the index, so only one copy of them is kept.
+    index_dir = None
+    with span("index"):
+        if n_workers == 1:
+            index = make_score_index(data)
+        else:
+            index_dir = tempfile.TemporaryDirectory(
+                dir=shared_memory_dir(), ignore_cleanup_errors=True
+            )
+            index = write_score_index(data, index_dir.name)
+        data = score_index_songs(index)
+
+    # Plot the UMAP, reusing the encodings, so that the trials need not wait.
+    fig_name = None
+    umap_worker = None
+    if plot is not None:
+        print("Plotting umap....")
+        umap_kwargs = {"n_fit": umap_sample, "data": data}
+        # A background plot is only launched here, so its span is labelled as
+        # such; the plot itself is made alongside the trials.
+        with span("umap_launch" if plot == "background" else "umap"):
+            if plot == "background":
+                umap_worker = start_plot_umap(song_data, f, **umap_kwargs)
+                fig_name = f"{f.__name__}_umaps.jpg"
+            else:
+                _, fig_name = plot_umap(song_data, f, **umap_kwargs)
+
+    if n_samples is None:
+        # Score every shingle of every song, reducing the rankings to arrays.
+        print("Evaluating every shingle...")
         start = datetime.now()
-        scores = compute_scores(test_idx, shingle_idx, data)
-        time = (datetime.now() - start).total_seconds()
-        times.append(time)
-        score_orders.append(scores)
-
-        # Optionally print out a table of the scores.
-        if not quiet:
-            print()
-            print(
-                tabulate.tabulate(
-                    [
-                        (score,) + song_id + (shingle_idx,)
-                        for score, song_id, _, shingle_idx in scores
-                    ],
-                    headers=["score", "composer", "piece", "performer", "shingle idx"],
-                )
+        with span("score"):
+            metrics = evaluate_all_shingles(
+                index, n_workers=n_workers, stride=query_stride
             )
+        n_queries = len(metrics["song_idxs"])
+        batch_time = (datetime.now() - start).total_seconds()
+        top_found = metrics["top_found"]
+        num_in_top = metrics["num_in_top"]
+        ave_dist = metrics["ave_dist"]
+        top_songs = metrics["top_song"]
+        query_songs = metrics["song_idxs"]
+        score_orders = None
+        queries = None
+    else:
+        # Set up the lists of values to track
+        top_found = []
+        num_in_top = []
+        ave_dist = []
+
+        # Choose a random song and a random shingle from it for each trial.
+        if seed is None:
+            seed = random.getrandbits(32)
+        queries = sample_queries(data, n_samples, seed)
+
+        # Calculate the score for each other song, for all the trials at once.
+        print("Running experiments...")
+        test_idxs = [t_idx for _, t_idx, _ in queries]
+        rows = [index["offsets"][t_idx] + s_idx for _, t_idx, s_idx in queries]
+        start = datetime.now()
+        with span("score"):
+            if n_workers == 1:
+                score_orders = compute_batch_scores(
+                    index["D"][rows], index, exclude=test_idxs
+                )
+            else:
+                score_orders = compute_parallel_scores(
+                    rows, test_idxs, index, n_workers
+                )
+        n_queries = n_samples
+        batch_time = (datetime.now() - start).total_seconds()
+
+        for i, ((song_id, test_idx, shingle_idx), scores) in enumerate(
+            zip(queries, score_orders)
+        ):
+            # Optionally print out a table of the scores.
+            if not quiet:
+                print(f"\n{i+1}/{n_samples}", song_id, shingle_idx)
+                print()
+                print(
+                    tabulate.tabulate(
+                        [
+                            (score,) + song_id + (shingle_idx,)
+                            for score, song_id, _, shingle_idx in scores
+                        ],
+                        headers=[
+                            "score", "composer", "piece", "performer", "shingle idx"
+                        ],
+                    )
+                )
 
-        # Check if the top is a match
-        all_matches = [match(other_id, song_id) for _, other_id, _, _ in scores]
-        tf = all_matches[0]
-        top_found.append(tf)
-
-        # Check what fraction of the matches are in the top.
-        num_matches = sum(all_matches)
-        num_top_matches = all_matches.index(False)
-        nit = num_top_matches / num_matches
-        num_in_top.append(nit)
-
-        # Calculate the average distance of matches from the top.
-        ave = sum(i for i, m in enumerate(all_matches) if m) / num_matches
-        ave_dist.append(ave)
-
-        print(tf, nit, ave)
-
-    # Print the results from this experiment.
-    results = [
-        np.mean(top_found),
-        np.mean(num_in_top),
-        np.mean(ave_dist),
-        np.mean(times),
+            tf, nit, ave = score_metrics(song_id, scores)
+            top_found.append(tf)
+            num_in_top.append(nit)
+            ave_dist.append(ave)
+
+            if not quiet:
+                print(tf, nit, ave)
+        top_songs = [scores[0][2] for scores in score_orders]
+        query_songs = test_idxs
+
+    # Print the results from this experiment, with the 95% confidence interval
+    # of each metric, allowing for the queries from each song being related.
+    names = ["P_f", "<n>", "<<d>>"]
+    estimates = [
+        clustered_interval(values, query_songs)
+        for values in [top_found, num_in_top, ave_dist]
     ]
+    # The queries are scored together, so each is given an equal share of the
+    # batch's wall time, rather than a latency of its own.
+    amortized_time = batch_time / max(n_queries, 1)
+    results = [mean for mean, _ in estimates] + [amortized_time]
+    intervals = [ci for _, ci in estimates]
     print()
-    print(tabulate.tabulate([results], headers=["P_f", "<n>", "<<d>>", "<t>"]))
+    print(
+        tabulate.tabulate(
+            [results, intervals + [None]],
+            headers=names + ["<t> amortized"],
+            showindex=["mean", "95% CI ±"],
+        )
+    )
+
+    if index_dir is not None:
+        index_dir.cleanup()
 
-    # Save the results.
-    with open("RESULTS.json", "r") as res_fh:
-        res_j = json.load(res_fh)
-    res_j.append(
+    # Save the results, including the time spent in each stage.
+    print("Saving results...")
+    with span("persist"):
+        if score_orders is None:
+            run_id = save_run_metrics(metrics, index["song_ids"])
+        else:
+            run_id = save_run_scores(score_orders, index["song_ids"])
+    misses = Counter(
+        tuple(index["song_ids"][j])
+        for j, tf in zip(top_songs, top_found)
+        if not tf
+    )
+    summary_keys = [key for key in SUMMARY_KEYS if key != "average_time"]
+    record = {
+        "method": f.__doc__,
+        "method_func": inspect.getsource(f),
+        "sample_size": n_queries,
+        "seed": seed,
+        "fig_name": fig_name,
+        "batch_time": batch_time,
+    }
+    if queries is None:
+        record["exhaustive"] = True
+        record["query_stride"] = query_stride
+    else:
+        record["results"] = [
+            {
+                "query": q,
+                "top_found": tf,
+                "fraction_in_top": fit,
+                "ave_dist": ad,
+            }
+            for q, tf, fit, ad in zip(queries, top_found, num_in_top, ave_dist)
+        ]
+    record.update(
         {
-            "method": f.__doc__,
-            "method_func": inspect.getsource(f),
-            "sample_size": n_samples,
-            "fig_name": fig_name,
-            "results": [
-                {
-                    "query": q,
-                    "scores": scr,
-                    "top_found": tf,
-                    "fraction_in_top": fit,
-                    "ave_dist": ad,
-                    "time": t,
-                }
-                for q, scr, tf, fit, ad, t in zip(
-                    queries, score_orders, top_found, num_in_top, ave_dist, times
-                )
-            ],
-            "summary": dict(
-                zip(
-                    [
-                        "fraction_found",
-                        "average_first_match",
-                        "average_average_distance",
-                        "average_time"
-                    ],
-                    results,
-                )
-            ),
+            "misses": [list(k) + [v] for k, v in misses.most_common()],
+            "summary": dict(zip(summary_keys, map(float, results))),
+            "intervals": dict(zip(summary_keys, map(float, intervals))),
+            "stages": profiler.breakdown(),
+            "ingest_stages": ingest_stages or [],
         }
     )
-    with open("RESULTS.json", "w") as res_fh:
-        json.dump(res_j, res_fh, indent=2)
+    append_run_record(run_id, record)
 
     return {
         "top_found": top_found,
         "num_in_top": num_in_top,
         "ave_dist": ave_dist,
+        "intervals": dict(zip(names, intervals)),
         "score_orders": score_orders,
         "queries": queries,
+        "umap_worker": umap_worker,
     }
 
 
-def print_report():
-    """Print a readable MarkDown report from the RESULTS.json file."""
-    doc_lines = []
-    with open("RESULTS.json", "r") as f:
-        results = json.load(f)
+def append_results(record, score_orders, song_ids, store_dir="./results"):
+    """Append the record of an experiment run to the results store in `store_dir`.
+
+    The score rankings of the run's trials are saved as compact arrays in a
+    file of their own, with songs referred to by their index in `song_ids`,
+    and the rest of the record is appended as a line of "runs.jsonl". Only the
+    new run is written, however many runs the store already holds.
+    """
+    run_id = save_run_scores(score_orders, song_ids, store_dir)
+    append_run_record(run_id, record, store_dir)
+
+
+def save_run_scores(score_orders, song_ids, store_dir="./results"):
+    """Save the score rankings of a run to the results store, returning its run id."""
+    os.makedirs(store_dir, exist_ok=True)
+    run_id = f"{datetime.now():%Y%m%d-%H%M%S-%f}"
+    np.savez(
+        os.path.join(store_dir, f"{run_id}.npz"),
+        scores=np.array(
+            [[s[0] for s in scores] for scores in score_orders], dtype=np.float32
+        ),
+        song_idxs=np.array(
+            [[s[2] for s in scores] for scores in score_orders], dtype=np.int32
+        ),
+        shingle_idxs=np.array(
+            [[s[3] for s in scores] for scores in score_orders], dtype=np.int32
+        ),
+        song_ids=json.dumps(song_ids),
+    )
+    return run_id
+
+
+def save_run_metrics(metrics, song_ids, store_dir="./results"):
+    """Save the per-query metrics of an exhaustive run, returning its run id."""
+    os.makedirs(store_dir, exist_ok=True)
+    run_id = f"{datetime.now():%Y%m%d-%H%M%S-%f}"
+    np.savez(
+        os.path.join(store_dir, f"{run_id}.npz"),
+        **{key: np.asarray(values) for key, values in metrics.items()},
+        song_ids=json.dumps(song_ids),
+    )
+    return run_id
+
 
+def append_run_record(run_id, record, store_dir="./results"):
+    """Append the record of a run to the results store, after its scores are saved."""
+    with open(os.path.join(store_dir, "runs.jsonl"), "a") as fh:
+        fh.write(json.dumps({"run_id": run_id, **record}) + "\n")
+
+
+def iter_results(store_dir="./results"):
+    """Iterate over the records of the runs in the results store, one at a time."""
+    with open(os.path.join(store_dir, "runs.jsonl")) as fh:
+        for line in fh:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_run_scores(run_id, store_dir="./results"):
+    """Load the score rankings of a run as (score, song_id, idx, shingle_idx) lists."""
+    with np.load(os.path.join(store_dir, f"{run_id}.npz")) as npz:
+        song_ids = json.loads(str(npz["song_ids"]))
+        return [
+            [
+                (float(score), song_ids[j], int(j), int(shingle_idx))
+                for score, j, shingle_idx in zip(*row)
+            ]
+            for row in zip(npz["scores"], npz["song_idxs"], npz["shingle_idxs"])
+        ]
+
+
+def convert_results_json(json_path="RESULTS.json", store_dir="./results"):
+    """Move the runs of an old RESULTS.json file into the results store."""
+    with open(json_path) as fh:
+        runs = json.load(fh)
+    for run_info in runs:
+        score_orders = [res.pop("scores") for res in run_info["results"]]
+
+        # Rebuild the song table from the first trial, which lists every song
+        # except the one queried.
+        query_id, query_idx, _ = run_info["results"][0]["query"]
+        song_ids = [s[1] for s in sorted(score_orders[0], key=lambda s: s[2])]
+        song_ids.insert(query_idx, query_id)
+
+        misses = Counter(
+            tuple(scores[0][1])
+            for scores, res in zip(score_orders, run_info["results"])
+            if not res["top_found"]
+        )
+        run_info["misses"] = [list(k) + [v] for k, v in misses.most_common()]
+        append_results(run_info, score_orders, song_ids, store_dir)
+
+
+def print_report(store_dir="./results"):
+    """Print a readable MarkDown report from the results store.
+
+    The runs are read one at a time, so only what goes in the report is kept.
+    """
+    summary_rows = []
+    method_lines = []
+    run_lines = []
+    methods_done = set()
+    for run_info in iter_results(store_dir):
+        # Give each metric with its confidence interval, where one was recorded.
+        intervals = run_info.get("intervals", {})
+        summary = {
+            key: (
+                f"{value:0.4g} ± {intervals[key]:0.2g}"
+                if intervals.get(key) is not None and not np.isnan(intervals[key])
+                else value
+            )
+            for key, value in run_info["summary"].items()
+        }
+        sample_size = run_info["sample_size"]
+        if run_info.get("exhaustive"):
+            stride = run_info.get("query_stride", 1)
+            every = "all" if stride == 1 else f"every {stride}th"
+            sample_size = f"{sample_size} ({every})"
+        # Runs before queries were scored in batches recorded the latency of
+        # each query, and later runs the amortized batch time, so each has a
+        # column of its own.
+        summary_rows.append(
+            (run_info["method"], sample_size)
+            + tuple(summary.get(key, "") for key in SUMMARY_KEYS)
+        )
+
+        if run_info["method"] not in methods_done:
+            method_lines.append(f"### {run_info['method']}")
+            method_lines.append(f"```python\n{run_info['method_func']}\n```")
+            methods_done.add(run_info["method"])
+
+        run_lines.append(f"### {run_info['method']} ({sample_size})")
+        run_lines.append(
+            "\t".join(
+                f"{key.replace('_', ' ')}: **{value}**"
+                if isinstance(value, str)
+                else f"{key.replace('_', ' ')}: **{value:0.3}**"
+                for key, value in summary.items()
+            )
+        )
+        if "batch_time" in run_info:
+            run_lines.append(
+                f"The queries were scored in batches, in "
+                f"{run_info['batch_time']:0.3g} s of wall time."
+            )
+        # Break down the time spent in each stage of the run, and of ingesting
+        # its corpus, where that was recorded.
+        for key in ["stages", "ingest_stages"]:
+            stages = run_info.get(key)
+            if not stages:
+                continue
+            if key == "ingest_stages":
+                run_lines.append("The time spent ingesting the corpus.")
+            total = sum(st["total_time"] for st in stages if "/" not in st["stage"])
+            run_lines.append(
+                tabulate.tabulate(
+                    [
+                        (
+                            st["stage"],
+                            st["calls"],
+                            st["total_time"],
+                            st["total_time"] / total,
+                            st["peak_mib"],
+                        )
+                        for st in stages
+                    ],
+                    ["stage", "calls", "time (s)", "fraction of time", "peak MiB"],
+                    tablefmt="github",
+                )
+            )
+
+        run_lines.append(
+            "The number of misses caused by each entry. In other words, "
+            "how often did each entry score best but was an incorrect match."
+        )
+
+        # List the pieces of music that are most often the targets of confusion.
+        run_lines.append(
+            tabulate.tabulate(
+                run_info["misses"],
+                ["composer", "piece", "performer", "count"],
+                tablefmt="github",
+            )
+        )
+
+    doc_lines = []
     doc_lines.append("# Results")
 
     doc_lines.append("## Summary")
@@ -305,15 +1736,18 @@ def print_report():
         "the fraction of possible matches at the top of the list "
         "(the larger the better), and last but not least, `[[d]]` is an "
         "average over the average distances of matching results from "
-        "the top of the list, and `[t]` is the average time taken to "
-        "calculate the score ranking."
+        "the top of the list. `[t]` is the average time taken to "
+        "calculate the score ranking of one query on its own, as recorded "
+        "by earlier runs, and `[t_a]` is the wall time of scoring all the "
+        "queries together in batches, divided by their number. Where "
+        "given, the ± is the 95% "
+        "confidence interval of each metric, estimated from the spread "
+        "between songs, since the queries from one song are related. Runs "
+        "marked (all) use every shingle of every song as a query."
     )
     doc_lines.append(
         tabulate.tabulate(
-            [
-                (r["method"], r["sample_size"]) + tuple(r["summary"].values())
-                for r in results
-            ],
+            summary_rows,
             headers=[
                 "Method Description",
                 "Sample Size",
@@ -321,56 +1755,39 @@ def print_report():
                 "`[n]`",
                 "`[[d]]`",
                 "`[t]`",
+                "`[t_a]`",
             ],
             tablefmt="github",
         )
     )
 
     doc_lines.append("## Method Details")
-
-    methods_done = set()
-    for run_info in results:
-        if run_info["method"] in methods_done:
-            continue
-        doc_lines.append(f"### {run_info['method']}")
-        doc_lines.append(f"```python\n{run_info['method_func']}\n```")
-        methods_done.add(run_info["method"])
+    doc_lines.extend(method_lines)
 
     doc_lines.append("## Run Details")
-
-    for run_info in results:
-        doc_lines.append(f"### {run_info['method']} ({run_info['sample_size']})")
-        doc_lines.append(
-            "\t".join(
-                f"{key.replace('_', ' ')}: **{value:0.3}**"
-                for key, value in run_info["summary"].items()
-            )
-        )
-        doc_lines.append(
-            "The number of misses caused by each entry. In other words, "
-            "how often did each entry score best but was an incorrect match."
-        )
-
-        # Find the pieces of music that are most often the targets of confusion.
-        gangers = [
-            tuple(res["scores"][0][1]) for res in run_info["results"] if not res["top_found"]
-        ]
-        c = Counter(gangers)
-
-        doc_lines.append(
-            tabulate.tabulate(
-                [k + (v,) for k, v in c.most_common()],
-                ["composer", "piece", "performer", "count"],
-                tablefmt="github",
-            )
-        )
+    doc_lines.extend(run_lines)
 
     with open("RESULTS.md", "w") as f:
         f.write("\n\n".join(doc_lines))
 
 
-def explore_umap_params(shingles, labels, param_list, n_trials):
-    """Test each of the n_neighbor params in param_list n_trials times."""
+def explore_umap_params(shingles, labels, param_list, n_trials, n_fit=None, seed=0):
+    """Test each of the n_neighbor params in param_list n_trials times.
+
+    The nearest neighbours are found once, for the largest of the params, and
+    shared by every fit. If `n_fit` is given, only a random sample of that
+    many shingles is used. The `labels` of each shingle may be an array, such
+    as the composers `song_labels(table, ["composer"])[song_idxs]` of the
+    shingles from `make_shingle_set`.
+    """
+    shingles = np.asarray(shingles)
+    sample = stratified_sample([len(shingles)], n_fit, seed)
+    X = shingles[sample]
+    sample_labels = np.asarray(labels)[sample]
+    knn_idxs, knn_dists, _ = nearest_neighbors(
+        X, max(param_list), "euclidean", {}, False, np.random.RandomState(seed)
+    )
+
     fig, axes = plt.subplots(
         len(param_list), n_trials, figsize=(6 * n_trials, 4 * len(param_list))
     )
@@ -378,53 +1795,157 @@ def explore_umap_params(shingles, labels, param_list, n_trials):
     for i, n in enumerate(param_list):
         print(f"Running n_neighbors={n}...")
         for j in range(n_trials):
-            umaps[(n, j)] = UMAP(n_neighbors=n).fit(shingles)
-            x, y = umaps[(n, j)].transform(shingles).T
-            scatterplot(x=x, y=y, hue=labels, ax=axes[i][j], alpha=0.6)
+            # Without a search index the UMAP cannot transform new data, which
+            # is not needed here.
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)
+                umaps[(n, j)] = UMAP(
+                    n_neighbors=n,
+                    precomputed_knn=(knn_idxs[:, :n], knn_dists[:, :n], None),
+                ).fit(X)
+            x, y = umaps[(n, j)].embedding_.T
+            scatterplot(x=x, y=y, hue=sample_labels, ax=axes[i][j], alpha=0.6)
             axes[i][j].set_title(f"n_neighbors={n}, trial {j}")
     return umaps
 
 
+def stratified_sample(lengths, n, seed=0):
+    """Choose about `n` items from groups of the given `lengths`, in proportion.
+
+    Every non-empty group keeps at least one item. Returns the sorted indices
+    of the chosen items, counting through the groups in order. If `n` is None
+    or covers every item, all of them are chosen.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = lengths.sum()
+    if n is None or n >= total:
+        return np.arange(total)
+    rng = np.random.default_rng(seed)
+    counts = np.minimum(np.maximum(1, np.round(lengths * n / total)), lengths)
+    starts = np.cumsum(lengths) - lengths
+    return np.concatenate(
+        [
+            start + np.sort(rng.choice(length, int(count), replace=False))
+            for start, length, count in zip(starts, lengths, counts)
+        ]
+    )
+
+
+def fit_umap(X, lengths, n_fit=None, seed=0, **umap_kwargs):
+    """Fit a UMAP to a stratified sample of the rows of X, and project every row.
+
+    `lengths` gives the number of rows from each song, so that each song is
+    sampled in proportion. Returns the fitted UMAP and the coordinates of
+    every row.
+    """
+    sample = stratified_sample(lengths, n_fit, seed)
+    with span("fit"):
+        umap = UMAP(**umap_kwargs).fit(X[sample])
+    coords = np.empty((len(X), 2), dtype=np.float32)
+    coords[sample] = umap.embedding_
+    rest = np.ones(len(X), dtype=bool)
+    rest[sample] = False
+    if rest.any():
+        with span("transform"):
+            coords[rest] = umap.transform(X[rest])
+    return umap, coords
+
+
+def get_umap(song_data, f, n_fit=20000, seed=0, cache_dir="./umap_cache", data=None):
+    """Get the UMAP of the embedding `f` of `song_data`, fitting it if needed.
+
+    The fitted model and the coordinates of every shingle are cached in
+    `cache_dir`, keyed by the embedding, the corpus and the sample, so they
+    are only computed once. `data` may be the already embedded song data, to
+    avoid embedding it again. If `cache_dir` is None, nothing is cached.
+
+    Returns the UMAP, the (n_shingles, 2) coordinates, the index of the song
+    of each shingle, and the list of song ids.
+    """
+    if cache_dir is not None:
+        key = "-".join(
+            [f.__name__, embedding_key(f), corpus_digest(song_data)]
+            + [str(n_fit), str(seed)]
+        )
+        path = os.path.join(cache_dir, key)
+        if os.path.exists(f"{path}.npz"):
+            with open(f"{path}.pkl", "rb") as fh:
+                umap = pickle.load(fh)
+            with np.load(f"{path}.npz") as npz:
+                coords = npz["coords"]
+                song_idxs = npz["song_idxs"]
+                song_ids = json.loads(str(npz["song_ids"]))
+            return umap, coords, song_idxs, song_ids
+
+    if data is None:
+        data = apply_embedding(song_data, f)
+    lengths = [len(sd["D"]) for sd in data]
+    X = np.concatenate([sd["D"] for sd in data])
+    umap, coords = fit_umap(X, lengths, n_fit, seed, n_neighbors=10)
+    song_idxs = np.repeat(np.arange(len(data)), lengths)
+    song_ids = [sd["song_id"] for sd in data]
+
+    if cache_dir is not None:
+        # Write the coordinates last, so their presence marks a complete entry.
+        os.makedirs(cache_dir, exist_ok=True)
+        with atomic_write(f"{path}.pkl") as fh:
+            pickle.dump(umap, fh)
+        with atomic_write(f"{path}.npz") as fh:
+            np.savez(
+                fh, coords=coords, song_idxs=song_idxs, song_ids=json.dumps(song_ids)
+            )
+    return umap, coords, song_idxs, song_ids
+
+
 def make_shingle_set(song_data, f):
-    """Calculate all the shingles, corresponding with relevant metadata."""
-    shingles = []
-    composers = []
-    pieces = []
-    performers = []
-    indexes = []
-    for sd in song_data:
-        new_data = [a for a in f(sd)]
-        shingles.extend(new_data)
-        indexes.extend(range(len(new_data)))
+    """Calculate all the shingles, with the song and offset of each.
+
+    Returns the (n_shingles, n_features) array of every shingle, the index of
+    each shingle's song and its index within that song as int32 arrays, and
+    the song table from `make_song_table`. Select shingles by their song's
+    metadata with a mask over the songs, such as
+    `song_mask(table, composer=...)[song_idxs]`.
+    """
+    with span("embed"):
+        shingles = [f(sd) for sd in song_data]
+    lengths = [len(D) for D in shingles]
+    song_idxs = np.repeat(np.arange(len(song_data), dtype=np.int32), lengths)
+    starts = np.cumsum(lengths) - lengths
+    shingle_idxs = (np.arange(len(song_idxs)) - np.repeat(starts, lengths)).astype(
+        np.int32
+    )
+    table = make_song_table(
+        [parse_song_file_name(sd["song_file"]) for sd in song_data]
+    )
+    return np.concatenate(shingles), song_idxs, shingle_idxs, table
 
-        song_id = parse_song_file_name(sd["song_file"])
-        composers.extend([song_id[0]] * len(new_data))
-        pieces.extend([song_id[1]] * len(new_data))
-        performers.extend([song_id[2]] * len(new_data))
-    return shingles, composers, pieces, performers, indexes
 
+def plot_umap(song_data, f, n_fit=20000, seed=0, cache_dir="./umap_cache", data=None):
+    """Plot the umap projection for the given embedding function `f`.
 
-def plot_umap(song_data, f):
-    """Plot the umap projection for the given embedding function `f`."""
-    shingles, composers, pieces, performers, indexes = make_shingle_set(song_data, f)
-    umap = UMAP(n_neighbors=10).fit(shingles)
+    The UMAP is fitted to a stratified sample of `n_fit` shingles, and cached
+    along with the coordinates of every shingle, as in `get_umap`.
+    """
+    umap, coords, song_idxs, song_ids = get_umap(
+        song_data, f, n_fit, seed, cache_dir, data
+    )
+    table = make_song_table(song_ids)
+    composer_codes = song_codes(table, "composer")[song_idxs]
+    composers = table["categories"]["composer"]
+    labels = song_labels(table, ["piece", "performer"])
 
     # Plot the global UMAP.
-    fig, axes = plt.subplots(len(set(composers)) + 1, 1)
-    x, y = umap.transform(shingles).T
-    scatterplot(x=x, y=y, hue=composers, ax=axes[0])
+    present = np.unique(composer_codes)
+    fig, axes = plt.subplots(len(present) + 1, 1)
+    x, y = coords.T
+    scatterplot(x=x, y=y, hue=composers[composer_codes], ax=axes[0])
     axes[0].set_title("Global UMAP")
 
     # Print a separate map for each of the composers.
-    for i, composer in enumerate(set(composers)):
-        some_shingles = [s for s, c in zip(shingles, composers) if c == composer]
-        some_labels = [
-            (pc, pr)
-            for c, pc, pr in zip(composers, pieces, performers)
-            if c == composer
-        ]
-        x, y = umap.transform(some_shingles).T
-        scatterplot(x=x, y=y, hue=some_labels, ax=axes[i + 1])
+    for i, composer in enumerate(composers[present]):
+        mask = song_mask(table, composer=composer)[song_idxs]
+        x, y = coords[mask].T
+        scatterplot(x=x, y=y, hue=labels[song_idxs[mask]], ax=axes[i + 1])
         axes[i + 1].set_xlim(axes[0].get_xlim())
         axes[i + 1].set_ylim(axes[0].get_ylim())
         axes[i + 1].set_title(f"UMAP for {composer}")
@@ -432,4 +1953,22 @@ def plot_umap(song_data, f):
     fig.suptitle(f"UMAPs for {f.__name__}")
     fig_name = f"{f.__name__}_umaps.jpg"
     fig.savefig(fig_name)
+    plt.close(fig)
     return umap, fig_name
+
+
+def start_plot_umap(song_data, f, **kwargs):
+    """Run `plot_umap` in the background, returning the process or thread running it.
+
+    Where processes can be forked, the plot is made in a child process, which
+    shares the song data without copying it and does not compete with the
+    caller for the GIL. Otherwise it is made in a thread.
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        worker = multiprocessing.get_context("fork").Process(
+            target=plot_umap, args=(song_data, f), kwargs=kwargs
+        )
+    else:
+        worker = threading.Thread(target=plot_umap, args=(song_data, f), kwargs=kwargs)
+    worker.start()
+    return worker
@@ -0,0 +1,103 @@
+__all__ = ['fit_projection', 'save_projection', 'load_projection', 'get_projection',
+           'project', 'explained_variance_ratio']
+
+import os
+
+import numpy as np
+
+from music import atomic_write
+
+
+def fit_projection(batches):
+    """Fit a PCA projection in a single streaming pass over batches of shingles.
+
+    Only the running sum and scatter matrix of the shingles are kept, so the
+    full shingle set never needs to be in memory. The full decomposition is
+    kept, with components sorted by decreasing variance, so it can be
+    truncated to any number of components with `project`.
+
+    Parameters
+    ----------
+    batches : iterable
+        An iterable of (n_shingles, n_features) arrays, for example the
+        embedding of each song.
+
+    Returns
+    -------
+    dict
+        The projection, with the shingle "mean", the principal "components" as
+        rows, and the "explained_variance" of each component.
+    """
+    n = 0
+    shift = None
+    for X in batches:
+        X = np.asarray(X, dtype=np.float64)
+        if not len(X):
+            continue
+
+        # Accumulate relative to the first batch's mean for numerical stability.
+        if shift is None:
+            shift = X.mean(axis=0)
+            total = np.zeros_like(shift)
+            scatter = np.zeros((len(shift), len(shift)))
+        X = X - shift
+        n += len(X)
+        total += X.sum(axis=0)
+        scatter += X.T @ X
+
+    mean = total / n
+    cov = (scatter - n * np.outer(mean, mean)) / (n - 1)
+    variances, vectors = np.linalg.eigh(cov)
+    order = np.argsort(variances)[::-1]
+    return {
+        "mean": shift + mean,
+        "components": np.ascontiguousarray(vectors[:, order].T),
+        "explained_variance": np.clip(variances[order], 0, None),
+    }
+
+
+def save_projection(proj, path):
+    """Save a projection from `fit_projection` to the .npz file at `path`."""
+    np.savez(path, **proj)
+
+
+def load_projection(path):
+    """Load a projection saved by `save_projection`."""
+    with np.load(path) as npz:
+        return {k: npz[k] for k in npz.files}
+
+
+def get_projection(name, batches, registry_dir="./projections"):
+    """Load the projection called `name` from the registry, fitting it if needed.
+
+    `batches` is a callable returning the batches passed to `fit_projection`;
+    it is only called if the projection has not already been saved. The name
+    should identify both the embedding and the data it was fitted on.
+    """
+    path = os.path.join(registry_dir, f"{name}.npz")
+    if os.path.exists(path):
+        return load_projection(path)
+
+    proj = fit_projection(batches())
+    os.makedirs(registry_dir, exist_ok=True)
+    with atomic_write(path) as fh:
+        np.savez(fh, **proj)
+    return proj
+
+
+def explained_variance_ratio(proj, n_components):
+    """Get the fraction of the variance explained by the first `n_components`."""
+    variance = proj["explained_variance"]
+    return variance[:n_components].sum() / variance.sum()
+
+
+def project(X, proj, n_components, batch_size=4096):
+    """Project the shingles in X onto the first `n_components` components, as float32."""
+    X = np.asarray(X)
+    mean = proj["mean"].astype(np.float32)
+    components = proj["components"][:n_components].astype(np.float32)
+    out = np.empty((len(X), len(components)), dtype=np.float32)
+    for b in range(0, len(X), batch_size):
+        batch = X[b : b + batch_size].astype(np.float32) - mean
+        np.matmul(batch, components.T, out=out[b : b + batch_size])
+    return out
@@ -0,0 +1,287 @@
+"""Compact storage of embedded shingles, with product-quantized scoring.
+
+The packed index from `make_score_index` can be stored in single or half
+precision, or its shingles can be product quantized: each shingle is split
+into sub-vectors, and each sub-vector is replaced by the one byte index of
+its nearest centroid in a small codebook. A query is then scored against the
+codes with asymmetric distance tables, without decoding the shingles.
+
+`evaluate_compression` compares the accuracy of each compact representation
+with exact float64 scoring on the same trials as `run_experiment`.
+"""
+__all__ = ['build_pq_index', 'save_pq_index', 'load_pq_index', 'query_pq_index',
+           'index_nbytes', 'evaluate_compression']
+
+import json
+import random
+
+import numpy as np
+import tabulate
+
+from music import (
+    make_score_index,
+    segment_min,
+    compute_batch_scores,
+    sample_queries,
+    score_metrics,
+    rank_songs,
+)
+from ivf import kmeans, nearest_centroids
+
+
+def split_subspaces(X, n_subspaces):
+    """Split the rows of X into `n_subspaces` equal sub-vectors, padding with zeros.
+
+    Returns an (n_rows, n_subspaces, sub_dim) array.
+    """
+    X = np.atleast_2d(X)
+    sub_dim = -(-X.shape[1] // n_subspaces)
+    padded = np.zeros((len(X), n_subspaces * sub_dim), dtype=np.float32)
+    padded[:, : X.shape[1]] = X
+    return padded.reshape(len(X), n_subspaces, sub_dim)
+
+
+def build_pq_index(
+    data, n_subspaces=16, n_centroids=256, n_train=None, n_iter=20, seed=0
+):
+    """Build a product-quantized index over the shingles of every song.
+
+    Parameters
+    ----------
+    data : list
+        The embedded song data, as returned by `apply_embedding`.
+    n_subspaces : int
+        (Default 16) The number of sub-vectors each shingle is split into,
+        which is also the number of bytes each shingle is stored in.
+    n_centroids : int
+        (Default 256) The number of centroids in each sub-vector's codebook, at
+        most 256 so that each code fits in a byte.
+    n_train : int
+        (Optional) The number of shingles sampled to fit the codebooks.
+        Defaults to 64 per centroid.
+    n_iter : int
+        (Default 20) The number of k-means iterations.
+    seed : int
+        (Default 0) The seed used to sample training shingles and centroids.
+
+    Returns
+    -------
+    dict
+        The index, with the (n_subspaces, n_centroids, sub_dim) "codebooks",
+        the (n_shingles, n_subspaces) uint8 "codes", and the "offsets" and
+        "song_ids" as from `make_score_index`.
+    """
+    lengths = [len(sd["D"]) for sd in data]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    n_shingles = offsets[-1]
+    if n_train is None:
+        n_train = 64 * n_centroids
+    n_train = min(n_train, n_shingles)
+    n_centroids = min(n_centroids, n_train, 256)
+
+    # Fit the codebooks on a sample of the shingles.
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(n_shingles, n_train, replace=False))
+    song_idx = np.searchsorted(offsets, sample, side="right") - 1
+    train = split_subspaces(
+        np.stack(
+            [data[s]["D"][i - offsets[s]] for s, i in zip(song_idx, sample)]
+        ),
+        n_subspaces,
+    )
+    codebooks = np.stack(
+        [
+            kmeans(train[:, m], n_centroids, n_iter=n_iter, seed=seed)
+            for m in range(n_subspaces)
+        ]
+    )
+
+    # Encode the shingles one song at a time, so they are never all unpacked.
+    codes = np.empty((n_shingles, n_subspaces), dtype=np.uint8)
+    for sd, start, end in zip(data, offsets[:-1], offsets[1:]):
+        sub = split_subspaces(sd["D"], n_subspaces)
+        for m in range(n_subspaces):
+            codes[start:end, m] = nearest_centroids(sub[:, m], codebooks[m], 1)[:, 0]
+
+    return {
+        "codebooks": codebooks,
+        "codes": codes,
+        "offsets": offsets,
+        "song_ids": [sd["song_id"] for sd in data],
+    }
+
+
+def save_pq_index(index, path):
+    """Save an index from `build_pq_index` to the .npz file at `path`."""
+    arrays = {k: v for k, v in index.items() if k != "song_ids"}
+    np.savez(path, song_ids=json.dumps(index["song_ids"]), **arrays)
+
+
+def load_pq_index(path):
+    """Load an index saved by `save_pq_index`."""
+    with np.load(path) as npz:
+        index = {k: npz[k] for k in npz.files if k != "song_ids"}
+        index["song_ids"] = json.loads(str(npz["song_ids"]))
+    return index
+
+
+def query_pq_index(X, index, exclude=None, batch_size=256):
+    """Compute the approximate scores between each query in `X` and every song.
+
+    Each query is compared with every codebook centroid once, giving a table
+    of squared sub-vector distances, and the distance to each shingle is then
+    the sum of the table entries picked out by its codes.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        A (n_queries, n_features) array of query shingles.
+    index : dict
+        An index from `build_pq_index` or `load_pq_index`.
+    exclude : list
+        (Optional) For each query, the index of a song to leave out.
+    batch_size : int
+        (Default 256) The number of queries to score at once.
+
+    Returns
+    -------
+    list
+        For each query, a sorted list of (score, song_id, idx, shingle_idx)
+        tuples, one per song, as returned by `compute_scores`.
+    """
+    codebooks = index["codebooks"]
+    codes = index["codes"]
+    offsets = index["offsets"]
+    song_ids = index["song_ids"]
+    n_subspaces = len(codebooks)
+    c_norms = np.einsum("mkd,mkd->mk", codebooks, codebooks)
+
+    all_scores = []
+    for b in range(0, len(X), batch_size):
+        Q = split_subspaces(X[b : b + batch_size], n_subspaces)
+
+        # The (n_queries, n_subspaces, n_centroids) distance tables.
+        tables = (
+            np.einsum("bmd,bmd->bm", Q, Q)[:, :, None]
+            + c_norms[None, :, :]
+            - 2 * np.einsum("bmd,mkd->bmk", Q, codebooks)
+        )
+        sq_dists = np.zeros((len(Q), len(codes)), dtype=np.float32)
+        for m in range(n_subspaces):
+            sq_dists += tables[:, m, codes[:, m]]
+        mins, min_idxs = segment_min(sq_dists, offsets)
+        best_scores = np.sqrt(np.maximum(mins, 0))
+        skip = None if exclude is None else exclude[b : b + batch_size]
+        all_scores += rank_songs(best_scores, song_ids, min_idxs, skip)
+    return all_scores
+
+
+def index_nbytes(index):
+    """Get the number of bytes held by the arrays of an index."""
+    return sum(v.nbytes for v in index.values() if isinstance(v, np.ndarray))
+
+
+def evaluate_compression(
+    data, n_samples=1000, seed=None, dtypes=(np.float32, np.float16), pq_params=({},)
+):
+    """Compare the accuracy of compact indices with exact float64 scoring.
+
+    The same trials are scored against a float64 index, an index stored as
+    each of `dtypes`, and a product-quantized index built with each of the
+    keyword arguments in `pq_params`. A table of the `P_f`, `<n>` and `<<d>>`
+    of each, as in `run_experiment`, is printed along with the size of each
+    index and how often its top match agrees with the exact top match.
+
+    Parameters
+    ----------
+    data : list
+        The embedded song data, as returned by `apply_embedding`.
+    n_samples : int
+        (Default 1000) The number of trials.
+    seed : int
+        (Optional) The seed from which the trials are drawn.
+    dtypes : tuple
+        (Default (np.float32, np.float16)) The storage types to compare.
+    pq_params : tuple
+        (Default ({},)) The arguments to `build_pq_index` of each product
+        quantization to compare.
+
+    Returns
+    -------
+    list
+        A dictionary for each representation, with its "name", "bytes", and
+        the summary "P_f", "<n>", "<<d>>" and "agreement".
+    """
+    if seed is None:
+        seed = random.getrandbits(32)
+    queries = sample_queries(data, n_samples, seed)
+    test_idxs = [t_idx for _, t_idx, _ in queries]
+
+    exact_index = make_score_index(data, dtype=np.float64)
+    X = exact_index["D"][
+        [exact_index["offsets"][t_idx] + s_idx for _, t_idx, s_idx in queries]
+    ]
+
+    candidates = [
+        ("float64", lambda: exact_index, compute_batch_scores),
+    ]
+    for dtype in dtypes:
+        candidates.append(
+            (
+                np.dtype(dtype).name,
+                lambda dtype=dtype: make_score_index(data, dtype=dtype),
+                compute_batch_scores,
+            )
+        )
+    for params in pq_params:
+        name = "pq " + ", ".join(f"{k}={v}" for k, v in params.items())
+        candidates.append(
+            (
+                name.strip(),
+                lambda params=params: build_pq_index(data, **params),
+                query_pq_index,
+            )
+        )
+
+    exact_top = None
+    summaries = []
+    for name, build, query in candidates:
+        index = build()
+        score_orders = query(X, index, exclude=test_idxs)
+        metrics = np.array(
+            [
+                score_metrics(song_id, scores)
+                for (song_id, _, _), scores in zip(queries, score_orders)
+            ],
+            dtype=float,
+        )
+        top = [scores[0][2] for scores in score_orders]
+        if exact_top is None:
+            exact_top = top
+        summaries.append(
+            dict(
+                zip(["P_f", "<n>", "<<d>>"], metrics.mean(axis=0)),
+                name=name,
+                bytes=index_nbytes(index),
+                agreement=np.mean(np.equal(top, exact_top)),
+            )
+        )
+
+    print(
+        tabulate.tabulate(
+            [
+                [
+                    s["name"],
+                    s["bytes"] / 2**20,
+                    s["P_f"],
+                    s["<n>"],
+                    s["<<d>>"],
+                    s["agreement"],
+                ]
+                for s in summaries
+            ],
+            headers=["storage", "MiB", "P_f", "<n>", "<<d>>", "top agreement"],
+        )
+    )
+    return summaries
@@ -0,0 +1,204 @@
+"""Rerank the top matching songs with dynamic time warping (DTW).
+
+Euclidean distance compares the windows of two shingles in lock step, so a
+performance at a different tempo scores poorly even when it is the same
+piece. `rerank_scores` takes the top songs found by a cheap first stage, such
+as `compute_batch_scores` or an index, and rescores every shingle of those
+songs with DTW constrained to a band around the diagonal.
+
+Most of the DTW computations are skipped: each shingle is first given the
+LB_Keogh lower bound, and is only aligned if that bound could improve on the
+best score of its song or enter the top `k`. Alignments are abandoned early
+once every path is worse than that, and a budget caps the number of
+alignments made per query.
+"""
+__all__ = ['to_sequences', 'lb_envelope', 'lb_keogh', 'dtw_distances', 'rerank_scores']
+
+import numpy as np
+
+from music import compute_batch_scores
+
+
+def to_sequences(X, n_channels):
+    """Reshape flattened shingles into (n_shingles, length, n_channels) sequences."""
+    X = np.atleast_2d(X)
+    return X.reshape(len(X), n_channels, -1).transpose(0, 2, 1)
+
+
+def lb_envelope(q, window):
+    """Get the lower and upper envelope of the sequence `q` within `window` steps."""
+    padded = np.pad(q, ((window, window), (0, 0)), mode="edge")
+    views = np.lib.stride_tricks.sliding_window_view(padded, 2 * window + 1, axis=0)
+    return views.min(axis=2), views.max(axis=2)
+
+
+def lb_keogh(C, lower, upper):
+    """Get the squared LB_Keogh lower bound on the DTW distance of each sequence in C.
+
+    `lower` and `upper` are the envelope of the query, from `lb_envelope`.
+    """
+    above = np.maximum(C - upper, 0)
+    below = np.maximum(lower - C, 0)
+    return np.einsum("ijk,ijk->i", above, above) + np.einsum("ijk,ijk->i", below, below)
+
+
+def dtw_distances(q, C, window, thresholds=None):
+    """Get the squared DTW distances between the sequence `q` and each sequence in C.
+
+    The alignments may only pair steps at most `window` steps apart. If
+    `thresholds` are given, an alignment is abandoned, with a distance of
+    infinity, as soon as every path is already worse than its threshold.
+    """
+    n, length = len(C), len(q)
+    diffs = q[None, :, None, :] - C[:, None, :, :]
+    dists = np.einsum("nijc,nijc->nij", diffs, diffs)
+
+    acc = np.full((n, length + 1, length + 1), np.inf)
+    acc[:, 0, 0] = 0
+    for i in range(length):
+        lo, hi = max(0, i - window), min(length, i + window + 1)
+        for j in range(lo, hi):
+            acc[:, i + 1, j + 1] = dists[:, i, j] + np.minimum(
+                np.minimum(acc[:, i, j], acc[:, i, j + 1]), acc[:, i + 1, j]
+            )
+        if thresholds is not None:
+            abandoned = acc[:, i + 1, lo + 1 : hi + 1].min(axis=1) >= thresholds
+            if abandoned.all():
+                return np.full(n, np.inf)
+    result = acc[:, length, length]
+    if thresholds is not None:
+        result[result >= thresholds] = np.inf
+    return result
+
+
+def rerank_scores(
+    X,
+    index,
+    n_channels=13,
+    k=10,
+    n_candidates=20,
+    window=3,
+    max_dtw=500,
+    batch_size=32,
+    exclude=None,
+    candidates=None,
+    stats=None,
+):
+    """Rerank the top candidate songs for each query in `X` by their DTW distances.
+
+    Each song's score is the smallest DTW distance between the query and any
+    of its shingles. The Euclidean score of each candidate from the first
+    stage is an upper bound on that, since the diagonal is one of the allowed
+    alignments, so it is kept unless a shingle aligns better.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        A (n_queries, n_features) array of query shingles.
+    index : dict
+        The packed song shingles, as returned by `make_score_index`.
+    n_channels : int
+        (Default 13) The number of channels each shingle was flattened from,
+        such as the volume and 12 chroma of f1 and f3-f7, or the 12 chroma
+        alone of f0 and f2. The embedding must keep the time axis, so the PCA
+        embeddings of f8-f11 cannot be reranked.
+    k : int
+        (Default 10) The number of top songs to return for each query.
+    n_candidates : int
+        (Default 20) The number of top songs from the first stage to rerank.
+    window : int
+        (Default 3) The largest number of steps an alignment may stray from
+        the diagonal.
+    max_dtw : int
+        (Default 500) The most DTW alignments to compute for each query, the
+        most promising first. If None, there is no limit.
+    batch_size : int
+        (Default 32) The number of alignments computed at once.
+    exclude : list
+        (Optional) For each query, the index of a song to leave out.
+    candidates : list
+        (Optional) The sorted first stage scores of each query, as from
+        `compute_batch_scores`. By default they are computed from `index`.
+    stats : dict
+        (Optional) A dictionary in which to count the "shingles" considered,
+        those "lb_pruned" by their lower bound, the "dtw" alignments computed,
+        those "abandoned" early, and those "skipped" once out of budget.
+
+    Returns
+    -------
+    list
+        For each query, a sorted list of up to `k` (score, song_id, idx,
+        shingle_idx) tuples, as returned by `compute_scores`.
+    """
+    X = np.atleast_2d(X)
+    D = index["D"]
+    offsets = index["offsets"]
+    if candidates is None:
+        candidates = compute_batch_scores(X, index, exclude=exclude)
+    if stats is None:
+        stats = {}
+    for key in ["shingles", "lb_pruned", "dtw", "abandoned", "skipped"]:
+        stats.setdefault(key, 0)
+
+    all_scores = []
+    for x, first_stage in zip(X, candidates):
+        q = to_sequences(x, n_channels)[0]
+        lower, upper = lb_envelope(q, window)
+
+        # Start each candidate song from its squared first stage score.
+        top = first_stage[:n_candidates]
+        songs = np.array([j for _, _, j, _ in top], dtype=np.int64)
+        best = np.array([score**2 for score, _, _, _ in top], dtype=np.float64)
+        best_idx = np.array([s_idx for _, _, _, s_idx in top], dtype=np.int64)
+
+        # Bound every shingle of the candidate songs, most promising first.
+        rows = np.concatenate([np.arange(offsets[j], offsets[j + 1]) for j in songs])
+        owners = np.repeat(np.arange(len(songs)), np.diff(offsets)[songs])
+        bounds = lb_keogh(to_sequences(D[rows], n_channels), lower, upper)
+        order = np.argsort(bounds, kind="stable")
+        stats["shingles"] += len(rows)
+
+        n_dtw = 0
+        pos = 0
+        while pos < len(order):
+            # A shingle can only matter if it beats its song and the k-th best.
+            kth = np.sort(best)[min(k, len(best)) - 1]
+            thresholds = np.minimum(best, kth)[owners]
+            if bounds[order[pos]] >= kth:
+                stats["lb_pruned"] += len(order) - pos
+                break
+            batch = order[pos : pos + batch_size]
+            pos += len(batch)
+            keep = bounds[batch] < thresholds[batch]
+            stats["lb_pruned"] += int((~keep).sum())
+            batch = batch[keep]
+            if max_dtw is not None and n_dtw + len(batch) > max_dtw:
+                n_skipped = len(batch) - (max_dtw - n_dtw) + len(order) - pos
+                stats["skipped"] += n_skipped
+                batch = batch[: max_dtw - n_dtw]
+                pos = len(order)
+            if not len(batch):
+                continue
+            n_dtw += len(batch)
+
+            dists = dtw_distances(
+                q,
+                to_sequences(D[rows[batch]], n_channels),
+                window,
+                thresholds[batch],
+            )
+            stats["dtw"] += len(batch)
+            stats["abandoned"] += int(np.isinf(dists).sum())
+            for b, dist in zip(batch, dists):
+                s = owners[b]
+                if dist < best[s]:
+                    best[s] = dist
+                    best_idx[s] = rows[b] - offsets[songs[s]]
+
+        scores = [
+            (np.sqrt(best[s]), index["song_ids"][j], int(j), int(best_idx[s]))
+            for s, j in enumerate(songs)
+        ]
+        scores.sort()
+        all_scores.append(scores[:k])
+    return all_scores
@@ -0,0 +1,199 @@
+"""Search whole feature sequences without materializing their shingles.
+
+The embeddings f2-f7 flatten every hop-1 window of a song's downsampled
+features into a shingle, so each step is stored, and compared with a query,
+once per window it falls in. A sequence index instead keeps each song's
+downsampled sequence once, along with its Fourier transform. The distance
+between a query and every window of every song then comes from an FFT
+cross-correlation and running sums of the squared norms of each step.
+
+Songs are grouped into buckets of similar lengths, and each bucket is
+transformed at its own FFT length, so a catalogue of songs of very different
+lengths is not padded to its longest song. The memory and the transform work
+of each song are at most `bucket_ratio` times its own length, rounded up to a
+length the FFT is quick for.
+
+The windows closest to the query under the FFT are checked against their
+directly computed distances, so the scores are the same as those of
+`compute_batch_scores` on the equivalent shingles.
+"""
+__all__ = ['make_sequence_index', 'compute_sequence_scores']
+
+import numpy as np
+
+from music import rank_songs
+
+
+def fft_length(n):
+    """Get the smallest length of at least `n` with no prime factors above 5."""
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def make_sequence_index(data, length, bucket_ratio=1.25):
+    """Pack the downsampled feature sequences of every song for sequence search.
+
+    Parameters
+    ----------
+    data : list
+        Song data dictionaries with a "song_id" and the (n_channels, n_steps)
+        sequence "D", such as from `apply_embedding` with an embedding that
+        stops before shingling, for example `pool_mean(F, 1.5, dur, 1)` for f7.
+    length : int
+        The number of steps in each window, which is the shingle length of the
+        equivalent embedding, such as the 19 pooled windows of f7.
+    bucket_ratio : float
+        (Default 1.25) The most by which a song is padded, as a multiple of its
+        number of steps, before the FFT length is rounded up.
+
+    Returns
+    -------
+    dict
+        The index, with the sequences concatenated along time as "F", their
+        "offsets", the "song_ids" and "length", and the "buckets" of songs.
+        Each bucket holds the indices of its "songs", its FFT length "n_fft",
+        the "spectra" of the songs' sequences padded to that length, and the
+        squared norm of each window as "window_norms" (infinite past each
+        song's last window), and the largest of each song as "max_norms".
+    """
+    sequences = [np.asarray(sd["D"]) for sd in data]
+    n_steps = np.array([seq.shape[1] for seq in sequences], dtype=np.int64)
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(n_steps)
+    F = np.ascontiguousarray(np.concatenate(sequences, axis=1))
+    dtype = np.result_type(F.dtype, np.float32)
+
+    # Fill each bucket from the longest song left, down to the shortest song
+    # that would not be padded by more than `bucket_ratio`.
+    buckets = []
+    order = np.argsort(-n_steps, kind="stable")
+    start = 0
+    while start < len(order):
+        longest = max(int(n_steps[order[start]]), length)
+        end = start + int(np.sum(n_steps[order[start:]] * bucket_ratio >= longest))
+        songs = np.sort(order[start : max(end, start + 1)])
+        start += len(songs)
+
+        # Only the windows that lie entirely within a song are valid, so the
+        # circular correlation needs no padding beyond the bucket's longest song.
+        n_fft = fft_length(longest)
+        spectra = np.stack(
+            [np.fft.rfft(sequences[j].astype(dtype), n=n_fft) for j in songs]
+        )
+        window_norms = np.full((len(songs), n_fft), np.inf, dtype=dtype)
+        for i, j in enumerate(songs):
+            seq = sequences[j]
+            n_windows = seq.shape[1] - length + 1
+            if n_windows <= 0:
+                continue
+            step_norms = np.concatenate(
+                [[0], np.cumsum(np.einsum("ij,ij->j", seq, seq))]
+            )
+            window_norms[i, :n_windows] = step_norms[length:] - step_norms[:n_windows]
+        buckets.append(
+            {
+                "songs": songs,
+                "n_fft": n_fft,
+                # Stored as (n_freqs, n_channels, n_songs) for a batched product.
+                "spectra": np.ascontiguousarray(spectra.transpose(2, 1, 0)),
+                "window_norms": window_norms,
+                "max_norms": np.max(
+                    window_norms, axis=1, where=np.isfinite(window_norms), initial=0
+                ),
+            }
+        )
+
+    return {
+        "F": F,
+        "offsets": offsets,
+        "buckets": buckets,
+        "song_ids": [sd["song_id"] for sd in data],
+        "length": length,
+    }
+
+
+def compute_sequence_scores(X, index, exclude=None, batch_size=32):
+    """Compute the scores between each query in `X` and every song in `index`.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        A (n_queries, n_features) array of query shingles, flattened in the
+        same way as `flatten_shingles`.
+    index : dict
+        The packed song sequences, as returned by `make_sequence_index`.
+    exclude : list
+        (Optional) For each query, the index of a song to leave out.
+    batch_size : int
+        (Default 32) The number of queries to score at once.
+
+    Returns
+    -------
+    list
+        For each query, a sorted list of (score, song_id, idx, shingle_idx)
+        tuples, one per song, as returned by `compute_scores`, where the
+        shingle_idx is the first step of the best window.
+    """
+    X = np.atleast_2d(X)
+    F = index["F"]
+    offsets = index["offsets"]
+    song_ids = index["song_ids"]
+    length = index["length"]
+    n_songs = len(song_ids)
+    windows = np.lib.stride_tricks.sliding_window_view(F, length, axis=1)
+    dtype = np.result_type(F.dtype, np.float32)
+    tolerance = 100 * np.finfo(dtype).eps
+
+    all_scores = []
+    for b in range(0, len(X), batch_size):
+        Q = X[b : b + batch_size].astype(dtype, copy=False)
+        Q3 = Q.reshape(len(Q), -1, length)
+        q_norms = np.einsum("ij,ij->i", Q, Q)
+
+        # Find the windows of each song within rounding error of its best.
+        candidates = []
+        for bucket in index["buckets"]:
+            n_fft = bucket["n_fft"]
+            window_norms = bucket["window_norms"]
+
+            # Correlate each query with every song of the bucket, and transform
+            # back along the last axis, as (queries, songs, steps).
+            Q_spectra = np.fft.rfft(Q3, n=n_fft).transpose(2, 0, 1).conj()
+            cross = np.matmul(Q_spectra, bucket["spectra"]).transpose(1, 2, 0)
+            sq_dists = np.fft.irfft(np.ascontiguousarray(cross), n=n_fft, axis=-1)
+            sq_dists *= -2
+            sq_dists += window_norms[None]
+            sq_dists += q_norms[:, None, None]
+
+            # The tolerance is taken from each song's largest window norm, which
+            # only adds candidates. Songs without any windows have none.
+            limits = sq_dists.min(axis=2, keepdims=True)
+            norms = q_norms[:, None] + bucket["max_norms"][None]
+            limits += tolerance * norms[..., None]
+            limits[np.isinf(limits)] = -np.inf
+            q_idx, songs, steps = np.nonzero(sq_dists <= limits)
+            candidates.append((q_idx, bucket["songs"][songs], steps))
+        q_idx, songs, steps = (np.concatenate(parts) for parts in zip(*candidates))
+
+        # Check the candidates against their directly computed distances.
+        diffs = windows[:, offsets[songs] + steps].transpose(1, 0, 2) - Q3[q_idx]
+        diffs = diffs.reshape(len(diffs), -1)
+        dists = np.sqrt(np.einsum("ij,ij->i", diffs, diffs))
+
+        # Keep the first of the closest windows of each song.
+        order = np.lexsort((steps, dists, songs, q_idx))
+        _, first = np.unique(q_idx[order] * n_songs + songs[order], return_index=True)
+        best = order[first]
+        best_scores = np.full((len(Q), n_songs), np.inf, dtype=dtype)
+        best_steps = np.zeros((len(Q), n_songs), dtype=np.int64)
+        best_scores[q_idx[best], songs[best]] = dists[best]
+        best_steps[q_idx[best], songs[best]] = steps[best]
+        skip = None if exclude is None else exclude[b : b + batch_size]
+        all_scores += rank_songs(best_scores, song_ids, best_steps, skip)
+    return all_scores
@@ -0,0 +1,518 @@
+"""A long-running query service over a corpus loaded once.
+
+The service loads the corpus and an embedding from experiments.py, then
+answers queries over HTTP on a local port or a Unix socket. Concurrent
+queries are coalesced into micro-batches, so that they are scored together
+by `compute_batch_scores`. Run it as a script:
+
+    python service.py --embedding f7 --socket /tmp/music.sock
+    python service.py --embedding f8 --port 8765
+
+It serves the following requests, all answered with JSON:
+
+    GET /health        Check that the service is up.
+    GET /metrics       The request counts, batch sizes, queue depth, and the
+                       latency percentiles of queuing, scoring and requests.
+    GET /sample?n=10   Random shingles from the corpus, to use as queries.
+    POST /query        Score {"shingles": [[...], ...], "k": 10} and return
+                       the top "k" matches of each shingle. An "exclude"
+                       list may give a song index to leave out of each.
+    POST /audio?sr=22050&k=10
+                       Score a snippet of raw mono float32 audio, returning
+                       the top matches of each of its shingles and overall.
+
+`QueryClient` is an asyncio client for the service, and loadgen.py uses it
+to measure throughput under concurrent load.
+"""
+__all__ = ['MicroBatcher', 'QueryService', 'QueryClient', 'build_service']
+
+import json
+import asyncio
+import argparse
+from time import perf_counter
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from music import make_score_index, compute_batch_scores, apply_embedding
+from streaming import StreamingMatcher
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    500: "Internal Server Error",
+}
+
+# The embeddings whose shingles can be made from audio by a `StreamingMatcher`,
+# and those of them which are then projected onto the f7 principal components.
+AUDIO_EMBEDDINGS = ["f7", "f8", "f9", "f10", "f11"]
+PROJECTED_EMBEDDINGS = ["f8", "f9", "f10", "f11"]
+
+
+def percentiles(values):
+    """Summarize a sequence of durations in seconds as millisecond percentiles."""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+    return {"p50": p50, "p95": p95, "p99": p99}
+
+
+class MicroBatcher:
+    """Coalesce concurrently submitted queries into batches for scoring.
+
+    The first query to arrive starts a batch, which then waits up to
+    `max_delay` seconds for more queries, up to `max_batch` shingles in all.
+    Each batch is scored by `score` in a worker thread, so the event loop
+    keeps accepting queries, which form the next batch, while it runs.
+
+    Parameters
+    ----------
+    score : callable
+        A function of a (n_queries, n_features) array and a list of the song
+        to exclude for each query, returning the sorted scores of each query,
+        such as `compute_batch_scores` with its index.
+    max_batch : int
+        (Default 64) The most shingles to score in one batch.
+    max_delay : float
+        (Default 0.002) The longest a batch waits for more queries, in seconds.
+    history : int
+        (Default 10000) The number of recent timings kept for the metrics.
+    """
+
+    def __init__(self, score, max_batch=64, max_delay=0.002, history=10000):
+        self.score = score
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.task = None
+
+        self.n_requests = 0
+        self.n_failed = 0
+        self.n_queries = 0
+        self.n_batches = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = deque(maxlen=history)
+        self.waits = deque(maxlen=history)
+        self.score_times = deque(maxlen=history)
+        self.latencies = deque(maxlen=history)
+
+    def start(self):
+        """Start forming and scoring batches on the running event loop."""
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, X, exclude=None):
+        """Score the queries in `X`, returning their sorted scores once batched."""
+        X = np.atleast_2d(X)
+        if exclude is None:
+            exclude = [None] * len(X)
+        future = asyncio.get_running_loop().create_future()
+        start = perf_counter()
+        self.queue_depth += len(X)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        await self.queue.put((X, list(exclude), future, start))
+        try:
+            return await future
+        except Exception:
+            self.n_failed += 1
+            raise
+        finally:
+            self.n_requests += 1
+            self.latencies.append(perf_counter() - start)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            n_queries = len(batch[0][0])
+            deadline = loop.time() + self.max_delay
+            while n_queries < self.max_batch:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self.queue.get_nowait()
+                batch.append(item)
+                n_queries += len(item[0])
+
+            start = perf_counter()
+            for _, _, _, submitted in batch:
+                self.waits.append(start - submitted)
+            self.queue_depth -= n_queries
+            X = np.concatenate([X for X, _, _, _ in batch])
+            exclude = [j for _, excl, _, _ in batch for j in excl]
+            try:
+                scores = await loop.run_in_executor(None, self.score, X, exclude)
+            except Exception:
+                # Score each request on its own, so that only the bad ones fail.
+                scores = None
+            self.score_times.append(perf_counter() - start)
+            self.n_batches += 1
+            self.n_queries += n_queries
+            self.batch_sizes.append(n_queries)
+
+            pos = 0
+            for X_i, excl, future, _ in batch:
+                if scores is not None:
+                    future.set_result(scores[pos : pos + len(X_i)])
+                    pos += len(X_i)
+                    continue
+                try:
+                    result = await loop.run_in_executor(None, self.score, X_i, excl)
+                except Exception as err:
+                    future.set_exception(err)
+                else:
+                    future.set_result(result)
+
+    def metrics(self):
+        """Get the counts, batch sizes, queue depth and latency percentiles so far."""
+        return {
+            "requests": self.n_requests,
+            "failed": self.n_failed,
+            "queries": self.n_queries,
+            "batches": self.n_batches,
+            "mean_batch_size": (
+                float(np.mean(self.batch_sizes)) if self.batch_sizes else None
+            ),
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "queue_wait_ms": percentiles(self.waits),
+            "score_ms": percentiles(self.score_times),
+            "latency_ms": percentiles(self.latencies),
+        }
+
+
+class ShingleStream(StreamingMatcher):
+    """Turn audio into shingles as a `StreamingMatcher` does, without scoring them."""
+
+    def match(self):
+        return self.shingle()
+
+
+def format_scores(scores):
+    """Convert a list of (score, song_id, idx, shingle_idx) tuples to JSON objects."""
+    return [
+        {
+            "score": float(score),
+            "song_id": list(song_id),
+            "idx": int(idx),
+            "shingle_idx": int(shingle_idx),
+        }
+        for score, song_id, idx, shingle_idx in scores
+    ]
+
+
+class QueryService:
+    """Serve queries against a packed corpus over HTTP, batching concurrent queries.
+
+    Parameters
+    ----------
+    index : dict
+        The packed corpus embedding, from `make_score_index`.
+    k : int
+        (Default 10) The number of top matches returned when a query does not
+        say.
+    transform : callable
+        (Optional) A function applied to the shingles made from audio, as in
+        `StreamingMatcher`.
+    audio : bool
+        (Default True) Whether audio queries can be answered, which requires
+        an embedding that `StreamingMatcher` can reproduce.
+    **batch_kwargs
+        Any other arguments are passed to `MicroBatcher`.
+    """
+
+    def __init__(self, index, k=10, transform=None, audio=True, **batch_kwargs):
+        self.index = index
+        self.k = k
+        self.transform = transform
+        self.audio = audio
+        self.batcher = MicroBatcher(self.score, **batch_kwargs)
+        self.rng = np.random.default_rng()
+
+    def score(self, X, exclude):
+        """Score a batch of queries against the index."""
+        return compute_batch_scores(X, self.index, exclude=exclude)
+
+    async def serve(self, host="127.0.0.1", port=8765, path=None):
+        """Serve requests on `host`:`port`, or on the Unix socket at `path`, forever."""
+        self.batcher.start()
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        """Answer the HTTP requests on one connection until it is closed."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                try:
+                    status, payload = await self.route(method, target, body)
+                except (ValueError, KeyError, TypeError) as err:
+                    status, payload = 400, {"error": str(err)}
+                except Exception as err:
+                    status, payload = 500, {"error": str(err)}
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode()
+                    + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, target, body):
+        """Answer a single request, returning its status and JSON payload."""
+        url = urlsplit(target)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if method == "GET" and url.path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and url.path == "/metrics":
+            return 200, self.batcher.metrics()
+        if method == "GET" and url.path == "/sample":
+            return 200, self.sample(int(params.get("n", 1)))
+        if method == "POST" and url.path == "/query":
+            request = json.loads(body)
+            X = np.asarray(request["shingles"], dtype=self.index["D"].dtype)
+            if X.ndim != 2 or X.shape[1] != self.index["D"].shape[1]:
+                raise ValueError(
+                    f"Expected shingles of {self.index['D'].shape[1]} features."
+                )
+            k = int(request.get("k", self.k))
+            exclude = self.check_exclude(request.get("exclude"), len(X))
+            scores = await self.batcher.submit(X, exclude)
+            return 200, {"matches": [format_scores(s[:k]) for s in scores]}
+        if method == "POST" and url.path == "/audio":
+            if not self.audio:
+                raise ValueError("This embedding cannot be made from audio.")
+            samples = np.frombuffer(body[: len(body) - len(body) % 4], dtype="<f4")
+            sr = int(params.get("sr", 22050))
+            k = int(params.get("k", self.k))
+            return 200, await self.match_audio(samples, sr, k)
+        return 404, {"error": f"No such request: {method} {url.path}"}
+
+    def check_exclude(self, exclude, n_queries):
+        """Check the song to leave out of each query's scores, raising ValueError."""
+        if exclude is None:
+            return None
+        n_songs = len(self.index["song_ids"])
+        if not isinstance(exclude, list) or len(exclude) != n_queries:
+            raise ValueError(f"Expected a list of {n_queries} songs to exclude.")
+        for j in exclude:
+            if j is not None and (
+                not isinstance(j, int) or isinstance(j, bool) or not 0 <= j < n_songs
+            ):
+                raise ValueError(f"Songs to exclude must be indices below {n_songs}.")
+        return exclude
+
+    def sample(self, n):
+        """Choose `n` random shingles from the corpus, with the songs they came from."""
+        rows = self.rng.integers(len(self.index["D"]), size=n)
+        songs = np.searchsorted(self.index["offsets"], rows, side="right") - 1
+        return {
+            "shingles": self.index["D"][rows].tolist(),
+            "idxs": songs.tolist(),
+            "shingle_idxs": (rows - self.index["offsets"][songs]).tolist(),
+        }
+
+    async def match_audio(self, samples, sr, k):
+        """Score each shingle of an audio snippet, and the snippet as a whole.
+
+        The snippet's overall matches are the songs with the lowest score for
+        any of its shingles.
+        """
+        loop = asyncio.get_running_loop()
+        updates = await loop.run_in_executor(None, self.audio_shingles, samples, sr)
+        if not updates:
+            raise ValueError("The audio is too short to make a shingle.")
+        times = [t for t, _ in updates]
+        scores = await self.batcher.submit(np.concatenate([x for _, x in updates]))
+
+        best = {}
+        for shingle_scores in scores:
+            for entry in shingle_scores:
+                if entry[2] not in best or entry < best[entry[2]]:
+                    best[entry[2]] = entry
+        return {
+            "updates": [
+                {"time": t, "matches": format_scores(s[:k])}
+                for t, s in zip(times, scores)
+            ],
+            "matches": format_scores(sorted(best.values())[:k]),
+        }
+
+    def audio_shingles(self, samples, sr):
+        """Make the shingles of an audio snippet, as (time, shingle) pairs."""
+        stream = ShingleStream(None, transform=self.transform, sr=sr)
+        return stream.feed(samples) + stream.flush()
+
+
+def build_service(embedding="f7", dtype=None, **kwargs):
+    """Load the corpus and the named embedding from experiments.py into a service.
+
+    `dtype` is the storage type of the packed index, as in `make_score_index`,
+    and any other arguments are passed to `QueryService`.
+    """
+    import experiments
+    from projection import project
+
+    f = getattr(experiments, embedding)
+    data = apply_embedding(experiments.get_song_data(), f)
+    index = make_score_index(data, dtype=dtype)
+
+    transform = None
+    if embedding in PROJECTED_EMBEDDINGS:
+        n_components = index["D"].shape[1]
+
+        def transform(x):
+            return project(x, experiments.get_f7_projection(), n_components)
+
+    return QueryService(
+        index, transform=transform, audio=embedding in AUDIO_EMBEDDINGS, **kwargs
+    )
+
+
+class QueryClient:
+    """An asyncio client for a `QueryService`, over one kept-alive connection.
+
+    Connect to `host`:`port`, or to the Unix socket at `path`. Use the client
+    as an async context manager to open and close the connection.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765, path=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        """Open the connection to the service."""
+        if self.path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+
+    async def close(self):
+        """Close the connection to the service."""
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def request(self, method, target, body=b"", content_type="application/json"):
+        """Make a request, returning its status and decoded JSON payload."""
+        async with self.lock:
+            self.writer.write(
+                f"{method} {target} HTTP/1.1\r\n"
+                f"Host: {self.host}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await self.writer.drain()
+
+            status = int((await self.reader.readline()).split()[1])
+            headers = {}
+            while True:
+                line = await self.reader.readline()
+                if not line.strip():
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            data = await self.reader.readexactly(int(headers["content-length"]))
+        return status, json.loads(data)
+
+    async def checked_request(self, *args, **kwargs):
+        """Make a request, raising an error unless it succeeds."""
+        status, payload = await self.request(*args, **kwargs)
+        if status != 200:
+            raise RuntimeError(f"Request failed ({status}): {payload.get('error')}")
+        return payload
+
+    async def query(self, shingles, k=10, exclude=None):
+        """Get the top `k` matches of each of the `shingles`."""
+        request = {"shingles": np.asarray(shingles).tolist(), "k": k}
+        if exclude is not None:
+            request["exclude"] = list(exclude)
+        payload = await self.checked_request(
+            "POST", "/query", json.dumps(request).encode()
+        )
+        return payload["matches"]
+
+    async def query_audio(self, samples, sr=22050, k=10):
+        """Get the top `k` matches of a snippet of mono audio sampled at `sr`."""
+        body = np.asarray(samples, dtype="<f4").tobytes()
+        return await self.checked_request(
+            "POST", f"/audio?sr={sr}&k={k}", body, "application/octet-stream"
+        )
+
+    async def sample(self, n=1):
+        """Get `n` random shingles from the corpus."""
+        return await self.checked_request("GET", f"/sample?n={n}")
+
+    async def metrics(self):
+        """Get the service's metrics."""
+        return await self.checked_request("GET", "/metrics")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve queries against the corpus.")
+    parser.add_argument("--embedding", default="f7", help="Which f in experiments.py.")
+    parser.add_argument("--dtype", help="Store the index as this type, e.g. float32.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", help="Serve on this Unix socket instead.")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-delay", type=float, default=0.002)
+    args = parser.parse_args()
+
+    service = build_service(
+        args.embedding,
+        args.dtype,
+        k=args.k,
+        max_batch=args.max_batch,
+        max_delay=args.max_delay,
+    )
+    where = args.socket or f"{args.host}:{args.port}"
+    print(f"Serving {args.embedding} queries on {where}...")
+    asyncio.run(service.serve(args.host, args.port, args.socket))
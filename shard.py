@@ -0,0 +1,229 @@
+"""Search a corpus partitioned by song across several worker processes.
+
+Each shard holds the packed shingles of a subset of the songs, and scores
+every query against its own songs only. A coordinator scatters each batch of
+queries to all the shards at once, and merges their sorted per-song scores
+into the same output as `compute_batch_scores` over the whole corpus.
+
+Shards are usually local processes started by `ShardedSearch.start`, but a
+shard can also be served on another machine and connected to by address.
+Connections exchange pickles, which can run arbitrary code when loaded, so a
+shard served over TCP requires a shared key, which every coordinator must
+present. Bind to the interface the coordinator reaches, and pass the key in
+the environment rather than on the command line:
+
+    SHARD_AUTHKEY=... python shard.py ./shards/0 10.0.0.5:6000
+"""
+__all__ = ['partition_songs', 'save_shards', 'serve_shard', 'ShardedSearch']
+
+import os
+import heapq
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from itertools import islice
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+from music import (
+    make_score_index,
+    save_score_index,
+    load_score_index,
+    compute_batch_scores,
+    shared_memory_dir,
+)
+
+
+def partition_songs(data, n_shards):
+    """Split the songs of `data` into `n_shards` groups of similar numbers of shingles.
+
+    Whole songs are assigned, largest first, to the shard with the fewest
+    shingles so far. Returns a sorted array of song indices for each shard.
+    """
+    loads = np.zeros(n_shards, dtype=np.int64)
+    shards = [[] for _ in range(n_shards)]
+    for j in sorted(range(len(data)), key=lambda j: -len(data[j]["D"])):
+        s = int(np.argmin(loads))
+        shards[s].append(j)
+        loads[s] += len(data[j]["D"])
+    return [np.array(sorted(shard), dtype=np.int64) for shard in shards]
+
+
+def save_shards(data, n_shards, path):
+    """Partition `data` by song and save each shard's score index under `path`.
+
+    Each shard is saved with `save_score_index` to a numbered directory, along
+    with "songs.npy", the indices of its songs in `data`. Returns the list of
+    shard directories.
+    """
+    shard_dirs = []
+    for s, songs in enumerate(partition_songs(data, n_shards)):
+        shard_dir = os.path.join(path, str(s))
+        save_score_index(make_score_index([data[j] for j in songs]), shard_dir)
+        np.save(os.path.join(shard_dir, "songs.npy"), songs)
+        shard_dirs.append(shard_dir)
+    return shard_dirs
+
+
+def run_shard(shard_dir, conn):
+    """Answer score requests for the shard in `shard_dir` on the connection `conn`.
+
+    Each request is a tuple of queries, the index of the song to exclude for
+    each query (in the whole corpus), and the number of songs to return. The
+    reply holds the sorted scores of the shard's songs for each query, with
+    the song indices translated back to the whole corpus. A request of None
+    ends the loop.
+    """
+    index = load_score_index(shard_dir)
+    songs = np.load(os.path.join(shard_dir, "songs.npy"))
+    local_idx = {int(j): i for i, j in enumerate(songs)}
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        X, exclude, k = request
+        if exclude is not None:
+            exclude = [local_idx.get(j) for j in exclude]
+        conn.send(
+            [
+                [
+                    (score, song_id, int(songs[i]), shingle_idx)
+                    for score, song_id, i, shingle_idx in scores[:k]
+                ]
+                for scores in compute_batch_scores(X, index, exclude)
+            ]
+        )
+
+
+def serve_shard(shard_dir, address, authkey=None):
+    """Serve the shard in `shard_dir` to a coordinator connecting to `address`.
+
+    `address` is a (host, port) tuple to listen on over TCP, or the path of a
+    Unix socket. A TCP address requires an `authkey`, since anyone who can
+    connect could otherwise send pickles that run code in the shard.
+    """
+    if isinstance(address, tuple) and not authkey:
+        raise ValueError("An authkey is required to serve a shard over TCP.")
+    with Listener(address, authkey=authkey) as listener:
+        with listener.accept() as conn:
+            run_shard(shard_dir, conn)
+
+
+class ShardedSearch:
+    """Score queries against a corpus split across several shard workers.
+
+    Use `ShardedSearch.start` to partition a corpus across local worker
+    processes, or `ShardedSearch.connect` to use shards served elsewhere by
+    `serve_shard`. Close the search, or use it as a context manager, to stop
+    the workers.
+    """
+
+    def __init__(self, connections, processes=(), tmp_dir=None):
+        self.connections = connections
+        self.processes = processes
+        self.tmp_dir = tmp_dir
+
+    @classmethod
+    def start(cls, data, n_shards=None):
+        """Partition `data` by song across `n_shards` local worker processes.
+
+        The shards are saved to a temporary directory (in shared memory where
+        available) which each worker memory-maps. Defaults to one shard per
+        CPU.
+        """
+        if n_shards is None:
+            n_shards = os.cpu_count()
+        n_shards = max(1, min(n_shards, len(data)))
+        tmp_dir = tempfile.mkdtemp(dir=shared_memory_dir())
+        connections = []
+        processes = []
+        for shard_dir in save_shards(data, n_shards, tmp_dir):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_shard, args=(shard_dir, child_conn), daemon=True
+            )
+            process.start()
+            child_conn.close()
+            connections.append(conn)
+            processes.append(process)
+        return cls(connections, processes, tmp_dir)
+
+    @classmethod
+    def connect(cls, addresses, authkey=None):
+        """Connect to shards served by `serve_shard` at each of `addresses`."""
+        return cls([Client(address, authkey=authkey) for address in addresses])
+
+    def search(self, X, exclude=None, k=None):
+        """Compute the scores between each query in `X` and every song.
+
+        Parameters
+        ----------
+        X : np.ndarray
+            A (n_queries, n_features) array of query shingles.
+        exclude : list
+            (Optional) For each query, the index of a song to leave out of its
+            scores, usually the song the query was taken from.
+        k : int
+            (Optional) The number of top songs to return for each query. By
+            default every song is returned.
+
+        Returns
+        -------
+        list
+            For each query, a sorted list of (score, song_id, idx,
+            shingle_idx) tuples, the same as from `compute_batch_scores` over
+            the whole corpus.
+        """
+        X = np.atleast_2d(X)
+        if exclude is not None:
+            exclude = [int(j) for j in exclude]
+
+        # Send the queries to every shard before waiting for any of them.
+        for conn in self.connections:
+            conn.send((X, exclude, k))
+        shard_scores = [conn.recv() for conn in self.connections]
+        return [
+            list(islice(heapq.merge(*scores), k))
+            for scores in zip(*shard_scores)
+        ]
+
+    def close(self):
+        """Stop the shard workers and remove any temporary shard files."""
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+        for process in self.processes:
+            process.join()
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.connections = []
+        self.processes = []
+        self.tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a shard saved by save_shards.")
+    parser.add_argument("shard_dir")
+    parser.add_argument("address", help="The host:port to listen on.")
+    parser.add_argument(
+        "--authkey",
+        default=os.environ.get("SHARD_AUTHKEY"),
+        help="The key coordinators must present (Default $SHARD_AUTHKEY).",
+    )
+    args = parser.parse_args()
+    if not args.authkey:
+        parser.error("an authkey is required, from --authkey or $SHARD_AUTHKEY")
+
+    host, port = args.address.rsplit(":", 1)
+    serve_shard(args.shard_dir, (host, int(port)), args.authkey.encode())
@@ -0,0 +1,148 @@
+__all__ = ['StreamingMatcher', 'read_audio_blocks', 'read_pcm_blocks', 'match_stream']
+
+from collections import deque
+
+import numpy as np
+
+from music import FeatureStream, compute_batch_scores, read_audio_blocks
+
+
+class StreamingMatcher:
+    """Match incoming audio against a corpus, updating the top matches every hop.
+
+    Audio chunks are turned into features by a `FeatureStream`, which are
+    downsampled and shingled the same way as f7 in experiments.py: the volume
+    is added as a channel above the chroma, each `pool_len` second window
+    (every `pool_hop` seconds) is averaged, and the latest `L` averages are
+    flattened into a shingle. Each new shingle is scored against the corpus,
+    so only the last `L` averages and a few seconds of audio are ever held.
+
+    Parameters
+    ----------
+    index : dict
+        The packed corpus embedding to match against, from `make_score_index`.
+    k : int
+        (Default 10) The number of top matching songs to report.
+    L : int
+        (Default 19) The length of a shingle, in pooled windows, which f7
+        uses for every song, however long it is.
+    pool_len : float
+        (Default 1.5) The length of each pooled window, in seconds.
+    pool_hop : float
+        (Default 1) The hop between pooled windows, in seconds.
+    transform : callable
+        (Optional) A function applied to each (1, n_features) shingle before
+        scoring, such as a PCA projection for f8-f11 style embeddings.
+    sr : int
+        (Default 22050) The sample rate of the audio.
+    hop_length : int
+        (Default 512) The number of samples between feature frames.
+    **stream_kwargs
+        Any other arguments are passed to `FeatureStream`.
+    """
+
+    def __init__(
+        self,
+        index,
+        k=10,
+        L=19,
+        pool_len=1.5,
+        pool_hop=1,
+        transform=None,
+        sr=22050,
+        hop_length=512,
+        **stream_kwargs,
+    ):
+        self.index = index
+        self.k = k
+        self.transform = transform
+        self.fps = sr / hop_length
+        self.pool_frames = int(pool_len * self.fps)
+        self.pool_step = int(pool_hop * self.fps)
+        self.features = FeatureStream(sr, hop_length, **stream_kwargs)
+
+        # The frames not yet pooled, and the index of the first of them.
+        self.frames = None
+        self.frames_start = 0
+        self.n_pooled = 0
+        self.pooled = deque(maxlen=L)
+
+    def feed(self, chunk):
+        """Add a chunk of audio, returning a list of (time, matches) updates.
+
+        Each update gives the time in the stream (in seconds) at which the
+        latest shingle ends, and the top matches as (score, song_id, idx,
+        shingle_idx) tuples, as from `compute_scores`.
+        """
+        return self._update(self.features.feed(chunk))
+
+    def flush(self):
+        """Process any remaining audio at the end of the stream."""
+        return self._update(self.features.flush())
+
+    def _update(self, new):
+        if new is None:
+            return []
+        F = np.block([[new["volume"]], [new["C"]]])
+        if self.frames is not None:
+            F = np.concatenate([self.frames, F], axis=1)
+        self.frames = F
+
+        updates = []
+        while True:
+            start = self.n_pooled * self.pool_step - self.frames_start
+            if start + self.pool_frames > self.frames.shape[1]:
+                break
+            window = self.frames[:, start : start + self.pool_frames]
+            self.pooled.append(window.mean(axis=1))
+            self.n_pooled += 1
+            if len(self.pooled) == self.pooled.maxlen:
+                end = (self.n_pooled - 1) * self.pool_step + self.pool_frames
+                updates.append((end / self.fps, self.match()))
+
+        # Drop the frames before the next pooled window.
+        drop = self.n_pooled * self.pool_step - self.frames_start
+        self.frames = self.frames[:, drop:]
+        self.frames_start += drop
+        return updates
+
+    def shingle(self):
+        """Get the latest shingle as a (1, n_features) array, after any `transform`."""
+        x = np.stack(self.pooled, axis=1).reshape(1, -1)
+        if self.transform is not None:
+            x = self.transform(x)
+        return x
+
+    def match(self):
+        """Score the latest shingle against the corpus, returning the top matches."""
+        return compute_batch_scores(self.shingle(), self.index)[0][: self.k]
+
+
+def read_pcm_blocks(fh, block_duration=0.5, sr=22050):
+    """Read raw mono float32 samples at `sr` from a binary stream such as a pipe.
+
+    A pipe may return fewer bytes than asked for, splitting a sample between
+    two reads, so the bytes of any partial sample are kept for the next block.
+    """
+    block_bytes = 4 * int(block_duration * sr)
+    leftover = b""
+    while True:
+        data = fh.read(block_bytes)
+        if not data:
+            break
+        data = leftover + data
+        n_bytes = len(data) - len(data) % 4
+        leftover = data[n_bytes:]
+        if n_bytes:
+            yield np.frombuffer(data[:n_bytes], dtype=np.float32)
+
+
+def match_stream(blocks, index, **kwargs):
+    """Match a stream of audio blocks, yielding each (time, matches) update.
+
+    The keyword arguments are passed to `StreamingMatcher`.
+    """
+    matcher = StreamingMatcher(index, **kwargs)
+    for block in blocks:
+        yield from matcher.feed(block)
+    yield from matcher.flush()
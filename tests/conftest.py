@@ -0,0 +1,32 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music import apply_embedding  # noqa: E402
+from benchmark import make_synthetic_corpus, embed_mean  # noqa: E402
+
+
+DURATION = 60
+
+
+@pytest.fixture(scope="session")
+def song_data():
+    """A small synthetic corpus of 6 pieces with 3 performances each."""
+    return make_synthetic_corpus(6, 3, duration=DURATION)
+
+
+@pytest.fixture(scope="session")
+def data(song_data):
+    """The f7 embedding of every song in `song_data`."""
+    return apply_embedding(song_data, embed_mean)
+
+
+def sample_rows(index, n, seed=0):
+    """Pick `n` random shingles of `index` as queries, with their own songs."""
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(index["offsets"][-1], size=n)
+    own = np.searchsorted(index["offsets"], rows, side="right") - 1
+    return index["D"][rows], own
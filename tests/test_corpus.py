@@ -0,0 +1,69 @@
+import pickle
+
+import numpy as np
+import soundfile
+
+from music import iter_song_data
+from corpus import write_corpus, open_corpus, corpus_stages, convert_pickles
+from instrument import span
+
+
+def assert_same_songs(expected, actual):
+    assert [sd["song_file"] for sd in actual] == [sd["song_file"] for sd in expected]
+    for exp, act in zip(expected, actual):
+        for feat in ["C", "volume", "rms"]:
+            assert isinstance(act[feat], np.memmap)
+            np.testing.assert_array_equal(act[feat], exp[feat])
+
+
+def test_corpus_round_trip(song_data, tmp_path):
+    path = tmp_path / "corpus"
+
+    def parsed():
+        for sd in song_data:
+            with span("parse"):
+                yield sd
+
+    write_corpus(parsed(), path)
+    assert_same_songs(song_data, open_corpus(path))
+
+    # The parsing done while writing is recorded within the ingest span.
+    stages = [stage["stage"] for stage in corpus_stages(path)]
+    assert stages[0] == "ingest"
+    assert "ingest/parse" in stages
+
+
+def test_convert_pickles(song_data, tmp_path):
+    pickle_dir = tmp_path / "data"
+    pickle_dir.mkdir()
+    for i, sd in enumerate(song_data[:4]):
+        with open(pickle_dir / f"{i}.pkl", "wb") as pf:
+            pickle.dump({**sd, "Y": np.ones(10)}, pf)
+
+    convert_pickles(pickle_dir, tmp_path / "corpus")
+    actual = sorted(open_corpus(tmp_path / "corpus"), key=lambda sd: sd["song_file"])
+    expected = sorted(song_data[:4], key=lambda sd: sd["song_file"])
+    assert_same_songs(expected, actual)
+    assert all("Y" not in sd for sd in actual)
+
+
+def test_empty_corpus(tmp_path):
+    write_corpus([], tmp_path)
+    assert open_corpus(tmp_path) == []
+
+
+def test_ingest_records_worker_spans(tmp_path):
+    wav_dir = tmp_path / "wavs"
+    wav_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for name in ["A_Piece0_P0", "A_Piece0_P1"]:
+        x = 0.1 * rng.standard_normal(22050 * 3).astype(np.float32)
+        soundfile.write(wav_dir / f"{name}.wav", x, 22050)
+
+    write_corpus(iter_song_data(wav_dir, n_workers=1), tmp_path / "corpus")
+    assert len(open_corpus(tmp_path / "corpus")) == 2
+
+    # Each song is extracted in a worker process, whose span is kept.
+    stages = {stage["stage"]: stage for stage in corpus_stages(tmp_path / "corpus")}
+    assert stages["ingest/parse/extract"]["calls"] == 2
+    assert stages["ingest/parse/extract"]["total_time"] > 0
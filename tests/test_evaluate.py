@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from music import (
+    make_score_index,
+    compute_batch_scores,
+    batch_song_scores,
+    score_batch_size,
+    song_blocks,
+    score_metrics,
+    song_tie_order,
+    rank_metrics,
+    evaluate_all_shingles,
+    match,
+)
+
+
+def test_rank_metrics_match_score_metrics(data):
+    index = make_score_index(data)
+    song_ids = index["song_ids"]
+    rng = np.random.default_rng(0)
+    own = rng.integers(len(data), size=50)
+    rows = index["offsets"][own] + rng.integers(10, size=50)
+    X = index["D"][rows]
+
+    scores, _ = batch_song_scores(X, index)
+    scores[np.arange(len(own)), own] = np.inf
+    matches = np.array([[match(s, song_ids[j]) for s in song_ids] for j in own])
+    metrics = rank_metrics(scores, matches, song_tie_order(song_ids))
+
+    expected = compute_batch_scores(X, index, exclude=own)
+    for i, j in enumerate(own):
+        tf, nit, ave = score_metrics(song_ids[j], expected[i])
+        assert metrics["top_found"][i] == tf
+        assert metrics["num_in_top"][i] == nit
+        assert metrics["ave_dist"][i] == ave
+        assert metrics["top_song"][i] == expected[i][0][2]
+
+
+def test_rank_metrics_break_ties_as_score_metrics():
+    # Few distinct scores, so that most songs tie with another.
+    song_ids = [f"{p}_{q}" for p in "CABD" for q in "yxz"]
+    rng = np.random.default_rng(1)
+    scores = rng.integers(3, size=(40, len(song_ids))).astype(float)
+    own = rng.integers(len(song_ids), size=40)
+    scores[np.arange(40), own] = np.inf
+    matches = np.array([[match(s, song_ids[j]) for s in song_ids] for j in own])
+    metrics = rank_metrics(scores, matches, song_tie_order(song_ids))
+
+    for i, j in enumerate(own):
+        ranking = sorted(
+            (scores[i, k], song_ids[k], k) for k in range(len(song_ids)) if k != j
+        )
+        tf, nit, ave = score_metrics(song_ids[j], ranking)
+        assert metrics["top_found"][i] == tf
+        assert metrics["num_in_top"][i] == nit
+        assert metrics["ave_dist"][i] == ave
+        assert metrics["top_song"][i] == ranking[0][2]
+
+
+def test_evaluate_all_shingles_matches_score_metrics(data):
+    index = make_score_index(data)
+    song_ids = index["song_ids"]
+    metrics = evaluate_all_shingles(index, batch_size=100)
+
+    rows = np.arange(0, index["offsets"][-1], 7)
+    own = metrics["song_idxs"][rows]
+    expected = compute_batch_scores(index["D"][rows], index, exclude=own)
+    for i, row in enumerate(rows):
+        tf, nit, ave = score_metrics(song_ids[own[i]], expected[i])
+        assert metrics["top_found"][row] == tf
+        assert metrics["num_in_top"][row] == nit
+        assert metrics["ave_dist"][row] == ave
+
+
+@pytest.mark.parametrize("block_size", [1, 150, 500])
+def test_song_blocks_hold_whole_songs(data, block_size):
+    offsets = make_score_index(data)["offsets"]
+    blocks = song_blocks(offsets, block_size)
+    assert [start for start, _ in blocks[1:]] == [end for _, end in blocks[:-1]]
+    assert blocks[0][0] == 0 and blocks[-1][1] == len(data)
+    for start, end in blocks:
+        assert end - start == 1 or offsets[end] - offsets[start] <= block_size
+
+
+@pytest.mark.parametrize("dtype", [None, np.float16])
+def test_scores_do_not_depend_on_blocks_or_batches(data, dtype):
+    index = make_score_index(data, dtype=dtype)
+    X = index["D"][::5]
+    expected = compute_batch_scores(X, index, batch_size=len(X))
+    assert compute_batch_scores(X, index, block_size=150, batch_size=7) == expected
+
+    # A budget of about 3 queries against the longest block of songs.
+    max_memory = 3 * 150 * (3 * 4 + 1 + 2)
+    assert score_batch_size(index, max_memory, block_size=150) >= 3
+    actual = compute_batch_scores(X, index, block_size=150, max_memory=max_memory)
+    assert actual == expected
+
+    metrics = evaluate_all_shingles(index, block_size=150, max_memory=max_memory)
+    expected = evaluate_all_shingles(index, batch_size=index["offsets"][-1])
+    for key in metrics:
+        np.testing.assert_array_equal(metrics[key], expected[key])
+
+
+def test_evaluate_strided_shingles_match_all(data):
+    index = make_score_index(data)
+    expected = evaluate_all_shingles(index)
+    metrics = evaluate_all_shingles(index, stride=19)
+    queries = np.flatnonzero(expected["shingle_idxs"] % 19 == 0)
+    assert len(np.unique(metrics["song_idxs"])) == len(data)
+    for key in metrics:
+        np.testing.assert_array_equal(metrics[key], expected[key][queries])
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from music import apply_embedding, make_score_index
+from benchmark import make_synthetic_corpus
+
+
+@pytest.fixture(scope="module")
+def experiments(tmp_path_factory):
+    """The experiments module, with its embedding cache in a temporary directory."""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path_factory.mktemp("experiments"))
+        import experiments
+
+        yield experiments
+
+
+@pytest.fixture(scope="module")
+def mixed_lengths():
+    """A 180 s and an 1800 s song."""
+    return [
+        make_synthetic_corpus(1, 1, duration=180)[0],
+        make_synthetic_corpus(1, 1, duration=1800, seed=1)[0],
+    ]
+
+
+@pytest.mark.parametrize("name", ["f2", "f3", "f6", "f7"])
+def test_shingle_width_does_not_depend_on_duration(experiments, mixed_lengths, name):
+    data = apply_embedding(mixed_lengths, getattr(experiments, name))
+    assert data[0]["D"].shape[1] == data[1]["D"].shape[1]
+    assert len(data[1]["D"]) > 9 * len(data[0]["D"])
+    index = make_score_index(data)
+    assert index["offsets"][-1] == sum(len(sd["D"]) for sd in data)
+
+
+def test_f7_shingles_are_19_pooled_windows(experiments, mixed_lengths):
+    from streaming import StreamingMatcher
+
+    D = experiments.f7(mixed_lengths[0])
+    assert D.shape[1] == 13 * 19
+    assert StreamingMatcher(None).pooled.maxlen == 19
+    np.testing.assert_array_equal(D, experiments.f7(mixed_lengths[0]))
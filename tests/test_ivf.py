@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from music import make_score_index, compute_batch_scores
+from ivf import build_ivf_index, save_ivf_index, load_ivf_index, query_ivf_index
+from conftest import sample_rows
+
+
+@pytest.fixture(scope="module")
+def ivf_index(data):
+    return build_ivf_index(data, n_lists=16)
+
+
+def test_ivf_lists_hold_every_shingle_once(ivf_index):
+    n_shingles = ivf_index["offsets"][-1]
+    assert ivf_index["list_offsets"][-1] == n_shingles
+    assert sorted(ivf_index["list_items"].tolist()) == list(range(n_shingles))
+
+
+@pytest.mark.parametrize("exclude_own", [False, True])
+def test_ivf_probing_every_list_matches_brute_force(data, ivf_index, exclude_own):
+    index = make_score_index(data)
+    X, own = sample_rows(index, 40)
+    exclude = own if exclude_own else None
+    expected = compute_batch_scores(X, index, exclude=exclude)
+    actual = query_ivf_index(X, ivf_index, k=5, n_probe=16, exclude=exclude)
+    assert actual == [scores[:5] for scores in expected]
+
+
+def test_ivf_index_round_trip(ivf_index, tmp_path):
+    save_ivf_index(ivf_index, tmp_path / "ivf.npz")
+    loaded = load_ivf_index(tmp_path / "ivf.npz")
+    assert loaded.keys() == ivf_index.keys()
+    assert loaded["song_ids"] == ivf_index["song_ids"]
+    for key in ivf_index:
+        if key != "song_ids":
+            np.testing.assert_array_equal(loaded[key], ivf_index[key])
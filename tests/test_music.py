@@ -0,0 +1,194 @@
+import numpy as np
+import pytest
+
+from music import (
+    make_shingles,
+    flatten_shingles,
+    shingle_params,
+    pool_mean,
+    pool_median,
+    pool_max,
+    decimate,
+    make_score_index,
+    write_score_index,
+    score_index_songs,
+    compute_batch_scores,
+    compute_parallel_scores,
+    EmbeddingCache,
+    atomic_write,
+    make_song_table,
+    song_mask,
+    group_songs,
+    song_labels,
+)
+
+
+# The f4-f7 embeddings as they were written before the pooling functions, with
+# the downsampled features built one window at a time.
+def old_f4(F):
+    F_ds = np.stack(
+        [np.median(F_bit, axis=1) for F_bit in make_shingles(F, 1, 180, 1, view=True)]
+    )
+    return flatten_shingles(make_shingles(F_ds, 20, 180, view=True))
+
+
+def old_f5(F):
+    F_ds = np.stack(
+        [np.mean(F_bit, axis=1) for F_bit in make_shingles(F, 1, 180, 1, view=True)]
+    )
+    return flatten_shingles(make_shingles(F_ds, 20, 180, view=True))
+
+
+def old_f6(F):
+    F_ds = np.stack(
+        [np.median(F_bit, axis=1) for F_bit in make_shingles(F, 1.5, 180, 1, view=True)]
+    ).T
+    return flatten_shingles(make_shingles(F_ds, 20, 180, view=True))
+
+
+def old_f7(F):
+    F_ds = np.stack(
+        [np.mean(F_bit, axis=1) for F_bit in make_shingles(F, 1.5, 180, 1, view=True)]
+    ).T
+    return flatten_shingles(make_shingles(F_ds, 20, 180, view=True))
+
+
+# The same embeddings as they are now written in experiments.py.
+def new_f4(F):
+    F_ds = pool_median(F, 1, 180, 1).T
+    return flatten_shingles(make_shingles(F_ds, 20, 180, view=True))
+
+
+def new_f5(F):
+    F_ds = pool_mean(F, 1, 180, 1).T
+    return flatten_shingles(make_shingles(F_ds, 20, 180, view=True))
+
+
+def new_f6(F):
+    F_ds = pool_median(F, 1.5, 180, 1)
+    return flatten_shingles(make_shingles(F_ds, 20, 180, view=True))
+
+
+def new_f7(F):
+    F_ds = pool_mean(F, 1.5, 180, 1)
+    return flatten_shingles(make_shingles(F_ds, 20, 180, view=True))
+
+
+# Lengths for which the hop does and does not evenly divide the frames left
+# after the first window, for the windows of both f4/f5 and f6/f7.
+LENGTHS = [1000, 1008, 7740, 7753]
+
+
+@pytest.mark.parametrize("L", [1, 1.5])
+def test_lengths_include_uneven_hops(L):
+    uneven = []
+    for N in LENGTHS:
+        LL, H = shingle_params(N, L, 180, 1)
+        uneven.append((N - LL) % H != 0)
+    assert any(uneven) and not all(uneven)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("N", LENGTHS)
+@pytest.mark.parametrize(
+    "old, new", [(old_f4, new_f4), (old_f5, new_f5), (old_f6, new_f6), (old_f7, new_f7)]
+)
+def test_pooled_embeddings_match_old(old, new, N, dtype):
+    F = np.random.default_rng(N).random((13, N)).astype(dtype)
+    expected, actual = old(F), new(F)
+    assert actual.shape == expected.shape
+    assert actual.dtype == expected.dtype
+    np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize("N", LENGTHS)
+def test_pool_max_and_decimate_match_old(N):
+    F = np.random.default_rng(N).random((13, N))
+    expected = np.stack(
+        [np.max(F_bit, axis=1) for F_bit in make_shingles(F, 1.5, 180, 1, view=True)]
+    ).T
+    np.testing.assert_array_equal(pool_max(F, 1.5, 180, 1), expected)
+    np.testing.assert_array_equal(decimate(F, 43), F[:, ::43])
+
+
+def test_write_score_index_matches_make_score_index(data, tmp_path):
+    expected = make_score_index(data)
+    index = write_score_index(data, tmp_path)
+    assert index["path"] == tmp_path
+    for key in ["D", "norms", "offsets"]:
+        np.testing.assert_array_equal(index[key], expected[key])
+        assert index[key].dtype == expected[key].dtype
+    assert index["song_ids"] == expected["song_ids"]
+    for sd, song in zip(data, score_index_songs(index)):
+        assert song["song_id"] == sd["song_id"]
+        np.testing.assert_array_equal(song["D"], sd["D"])
+
+
+@pytest.mark.parametrize("n_rows", [8, 40])
+@pytest.mark.parametrize("saved", [False, True])
+def test_parallel_scores_match_batch_scores(data, tmp_path, n_rows, saved):
+    index = write_score_index(data, tmp_path) if saved else make_score_index(data)
+    rows = np.random.default_rng(0).integers(index["offsets"][-1], size=n_rows)
+    own = np.searchsorted(index["offsets"], rows, side="right") - 1
+    expected = compute_batch_scores(index["D"][rows], index, exclude=own)
+    actual = compute_parallel_scores(rows, own, index, n_workers=2, chunk_size=16)
+    assert actual == expected
+
+
+def test_embedding_cache_evicts_least_recent_from_disk(tmp_path):
+    arrays = {key: np.full(100, i, dtype=np.float64) for i, key in enumerate("abcd")}
+    entry_size = 928  # The 800 bytes of data, and the .npy header.
+    cache = EmbeddingCache(max_memory=0, cache_dir=tmp_path, max_disk=3 * entry_size)
+    for key in "abc":
+        cache.put(key, arrays[key])
+    assert cache.get("a") is not None
+    cache.put("d", arrays["d"])
+
+    # "b" was the least recently used once "a" was read back.
+    assert sorted(p.stem for p in tmp_path.glob("*.npy")) == ["a", "c", "d"]
+    assert cache._disk_size == sum(p.stat().st_size for p in tmp_path.glob("*.npy"))
+
+    # A new cache picks up the entries, and their sizes, from the directory.
+    reopened = EmbeddingCache(cache_dir=tmp_path, max_disk=3 * entry_size)
+    assert reopened._disk_size == cache._disk_size
+    np.testing.assert_array_equal(reopened.get("c"), arrays["c"])
+    assert reopened.get("b") is None
+
+
+def test_atomic_write_keeps_old_file_on_failure(tmp_path):
+    path = tmp_path / "entry.npy"
+    with atomic_write(path) as fh:
+        np.save(fh, np.arange(3))
+    with pytest.raises(RuntimeError):
+        with atomic_write(path) as fh:
+            fh.write(b"partial")
+            raise RuntimeError
+    np.testing.assert_array_equal(np.load(path), np.arange(3))
+    assert [p.name for p in tmp_path.iterdir()] == ["entry.npy"]
+
+
+def test_song_table_masks_and_groups():
+    song_ids = [
+        ["Chopin", "Op10", "Pollini"],
+        ["Bach", "BWV1", "Gould"],
+        ["Chopin", "Op25", "Pollini"],
+        ["Chopin", "Op10", "Ashkenazy"],
+        ["Liszt", "S139"],
+    ]
+    table = make_song_table(song_ids)
+
+    np.testing.assert_array_equal(
+        song_mask(table, composer="Chopin"), [True, False, True, True, False]
+    )
+    np.testing.assert_array_equal(
+        song_mask(table, composer=["Bach", "Liszt"], performer=""),
+        [False, False, False, False, True],
+    )
+
+    # Songs are grouped by the values of the fields, in sorted order.
+    groups, inverse = group_songs(table, ["composer", "piece"])
+    assert len(groups) == 4
+    np.testing.assert_array_equal(inverse, [1, 0, 2, 1, 3])
+    labels = song_labels(table, ["composer", "piece"])
+    for g in range(len(groups)):
+        assert len(set(labels[inverse == g])) == 1
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from projection import (
+    fit_projection,
+    save_projection,
+    load_projection,
+    get_projection,
+    project,
+    explained_variance_ratio,
+)
+
+decomposition = pytest.importorskip("sklearn.decomposition")
+
+
+@pytest.fixture(scope="module")
+def shingles(data):
+    return np.concatenate([sd["D"] for sd in data]).astype(np.float64)
+
+
+def test_projection_matches_sklearn_pca(data, shingles):
+    n_components = 36
+    proj = fit_projection(sd["D"] for sd in data)
+    pca = decomposition.PCA(n_components, svd_solver="full").fit(shingles)
+
+    np.testing.assert_allclose(proj["mean"], pca.mean_, atol=1e-6)
+    np.testing.assert_allclose(
+        proj["explained_variance"][:n_components], pca.explained_variance_, rtol=1e-5
+    )
+    np.testing.assert_allclose(
+        explained_variance_ratio(proj, n_components),
+        pca.explained_variance_ratio_.sum(),
+        rtol=1e-5,
+    )
+
+    # Components are only defined up to their sign.
+    components = proj["components"][:n_components]
+    signs = np.sign(np.sum(components * pca.components_, axis=1))
+    np.testing.assert_allclose(components * signs[:, None], pca.components_, atol=1e-4)
+    np.testing.assert_allclose(
+        project(shingles, proj, n_components) * signs,
+        pca.transform(shingles),
+        atol=1e-4,
+    )
+
+
+def test_projection_does_not_depend_on_batches(data, shingles):
+    whole = fit_projection([shingles])
+    batched = fit_projection(sd["D"] for sd in data)
+    np.testing.assert_allclose(batched["mean"], whole["mean"], atol=1e-12)
+    np.testing.assert_allclose(
+        batched["explained_variance"], whole["explained_variance"], atol=1e-10
+    )
+
+
+def test_get_projection_fits_once(data, tmp_path):
+    calls = []
+
+    def batches():
+        calls.append(1)
+        return (sd["D"] for sd in data)
+
+    proj = get_projection("f7", batches, tmp_path)
+    again = get_projection("f7", batches, tmp_path)
+    assert len(calls) == 1
+    for key in proj:
+        np.testing.assert_array_equal(again[key], proj[key])
+
+    save_projection(proj, tmp_path / "copy.npz")
+    loaded = load_projection(tmp_path / "copy.npz")
+    for key in proj:
+        np.testing.assert_array_equal(loaded[key], proj[key])
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from music import make_score_index
+from quantize import (
+    split_subspaces,
+    build_pq_index,
+    save_pq_index,
+    load_pq_index,
+    query_pq_index,
+    evaluate_compression,
+)
+from conftest import sample_rows
+
+
+@pytest.fixture(scope="module")
+def pq_index(data):
+    return build_pq_index(data, n_subspaces=16, n_centroids=64)
+
+
+def test_pq_scores_are_distances_to_decoded_shingles(data, pq_index):
+    index = make_score_index(data)
+    X, own = sample_rows(index, 20)
+    codebooks = pq_index["codebooks"]
+    decoded = codebooks[np.arange(16), pq_index["codes"]].reshape(len(index["D"]), -1)
+    padded = split_subspaces(X, 16).reshape(len(X), -1)
+
+    for x, scores in zip(padded, query_pq_index(X, pq_index, exclude=own)):
+        for score, _, j, shingle_idx in scores:
+            song = decoded[index["offsets"][j] : index["offsets"][j + 1]]
+            dists = np.linalg.norm(song - x, axis=1)
+            np.testing.assert_allclose(score, dists.min(), rtol=1e-4, atol=1e-5)
+            assert dists[shingle_idx] <= dists.min() * (1 + 1e-4) + 1e-5
+
+
+def test_pq_keeps_the_accuracy_of_exact_scores(data):
+    # With 16 bytes per shingle the top song agreed with exact scoring in 87% of
+    # these trials, and the metrics were within 0.01 of the exact ones.
+    summaries = evaluate_compression(
+        data, 200, seed=0, pq_params=({"n_subspaces": 16, "n_centroids": 64},)
+    )
+    exact, float32, float16, pq = summaries
+    assert float32["agreement"] == float16["agreement"] == 1
+    assert pq["bytes"] < float16["bytes"] / 4
+    assert pq["agreement"] >= 0.8
+    assert abs(pq["P_f"] - exact["P_f"]) <= 0.05
+    assert abs(pq["<n>"] - exact["<n>"]) <= 0.05
+
+
+def test_pq_index_round_trip(pq_index, tmp_path):
+    save_pq_index(pq_index, tmp_path / "pq.npz")
+    loaded = load_pq_index(tmp_path / "pq.npz")
+    assert loaded.keys() == pq_index.keys()
+    assert loaded["song_ids"] == pq_index["song_ids"]
+    for key in pq_index:
+        if key != "song_ids":
+            np.testing.assert_array_equal(loaded[key], pq_index[key])
@@ -0,0 +1,68 @@
+import numpy as np
+
+from music import make_score_index, compute_batch_scores
+from rerank import to_sequences, lb_envelope, lb_keogh, dtw_distances, rerank_scores
+from conftest import sample_rows
+
+
+def reference_dtw(q, c, window):
+    """The squared DTW distance of two sequences, one step at a time."""
+    length = len(q)
+    acc = np.full((length + 1, length + 1), np.inf)
+    acc[0, 0] = 0
+    for i in range(length):
+        for j in range(max(0, i - window), min(length, i + window + 1)):
+            step = np.sum((q[i] - c[j]) ** 2)
+            acc[i + 1, j + 1] = step + min(acc[i, j], acc[i, j + 1], acc[i + 1, j])
+    return acc[length, length]
+
+
+def test_dtw_distances_match_reference_and_bound(data):
+    index = make_score_index(data)
+    X, _ = sample_rows(index, 11)
+    q, C = to_sequences(X[0], 13)[0], to_sequences(X[1:], 13)
+    lower, upper = lb_envelope(q, 3)
+    expected = [reference_dtw(q, c, 3) for c in C]
+    np.testing.assert_allclose(dtw_distances(q, C, 3), expected, rtol=1e-6)
+    assert np.all(lb_keogh(C, lower, upper) <= np.array(expected) * (1 + 1e-6))
+    assert np.all(np.array(expected) <= np.sum((q - C) ** 2, axis=(1, 2)) * (1 + 1e-6))
+
+
+def test_rerank_matches_brute_force_dtw(data):
+    index = make_score_index(data)
+    X, own = sample_rows(index, 4)
+    offsets = index["offsets"]
+    candidates = compute_batch_scores(X, index, exclude=own)
+
+    # Align the query with every shingle of each of its candidate songs.
+    expected = []
+    for x, first_stage in zip(X, candidates):
+        q = to_sequences(x, 13)[0]
+        songs = []
+        for _, _, j, _ in first_stage[:6]:
+            C = to_sequences(index["D"][offsets[j] : offsets[j + 1]], 13)
+            dists = [reference_dtw(q, c, 3) for c in C]
+            songs.append((np.sqrt(min(dists)), j, dists))
+        songs.sort(key=lambda song: song[0])
+        expected.append(songs[:3])
+
+    for batch_size in [1, 32]:
+        stats = {}
+        actual = rerank_scores(
+            X,
+            index,
+            k=3,
+            n_candidates=6,
+            max_dtw=None,
+            batch_size=batch_size,
+            exclude=own,
+            stats=stats,
+        )
+        assert stats["dtw"] + stats["lb_pruned"] == stats["shingles"]
+        for scores, songs in zip(actual, expected):
+            assert [s[2] for s in scores] == [j for _, j, _ in songs]
+
+            # The shingles are single precision, and so are their step distances.
+            for (score, _, _, shingle_idx), (exp, _, dists) in zip(scores, songs):
+                np.testing.assert_allclose(score, exp, rtol=1e-6)
+                np.testing.assert_allclose(np.sqrt(dists[shingle_idx]), exp, rtol=1e-6)
@@ -0,0 +1,95 @@
+import json
+
+import numpy as np
+
+from music import (
+    make_score_index,
+    compute_batch_scores,
+    save_run_scores,
+    load_run_scores,
+    append_results,
+    append_run_record,
+    iter_results,
+    print_report,
+    convert_results_json,
+)
+from conftest import sample_rows
+
+
+def assert_same_rankings(expected, actual):
+    assert len(actual) == len(expected)
+    for exp, act in zip(expected, actual):
+        assert [list(s[1:]) for s in act] == [list(s[1:]) for s in exp]
+        np.testing.assert_allclose([s[0] for s in act], [s[0] for s in exp], rtol=1e-6)
+
+
+def score_orders(data, n=5):
+    index = make_score_index(data)
+    X, own = sample_rows(index, n)
+    return index, own, compute_batch_scores(X, index, exclude=own)
+
+
+def test_run_scores_round_trip(data, tmp_path):
+    index, _, expected = score_orders(data)
+    run_id = save_run_scores(expected, index["song_ids"], tmp_path)
+    assert_same_rankings(expected, load_run_scores(run_id, tmp_path))
+
+    append_results({"method": "f7"}, expected, index["song_ids"], tmp_path)
+    (record,) = iter_results(tmp_path)
+    assert record["method"] == "f7"
+    assert_same_rankings(expected, load_run_scores(record["run_id"], tmp_path))
+
+
+def test_convert_results_json(data, tmp_path):
+    index, own, expected = score_orders(data)
+    song_ids = index["song_ids"]
+
+    # A run in the old format, with the scores stored in each of its results.
+    results = [
+        {
+            "query": [song_ids[j], int(j), 0],
+            "top_found": bool(scores[0][1][:2] == song_ids[j][:2]),
+            "scores": [[float(s[0]), s[1], s[2], s[3]] for s in scores],
+        }
+        for j, scores in zip(own, expected)
+    ]
+    json_path = tmp_path / "RESULTS.json"
+    with open(json_path, "w") as fh:
+        json.dump([{"method": "f7", "results": results}], fh)
+
+    convert_results_json(json_path, tmp_path / "results")
+    (record,) = iter_results(tmp_path / "results")
+    assert record["method"] == "f7"
+    assert all("scores" not in res for res in record["results"])
+    misses = sum(not res["top_found"] for res in results)
+    assert sum(miss[-1] for miss in record["misses"]) == misses
+
+    # The song table is rebuilt from the first result, so the indices and ids
+    # of the loaded rankings are those of the index.
+    actual = load_run_scores(record["run_id"], tmp_path / "results")
+    assert_same_rankings(expected, actual)
+
+
+def test_report_separates_latency_and_amortized_time(tmp_path, monkeypatch):
+    record = {"method": "f7", "method_func": "def f7(sd): ...", "misses": []}
+    summary = {
+        "fraction_found": 0.5,
+        "average_first_match": 0.4,
+        "average_average_distance": 5.0,
+    }
+    old = {**record, "sample_size": 500, "summary": {**summary, "average_time": 0.2}}
+    new = {
+        **record,
+        "sample_size": 500,
+        "summary": {**summary, "amortized_time": 0.003},
+        "batch_time": 1.5,
+    }
+    for run_id, run in [("old", old), ("new", new)]:
+        append_run_record(run_id, run, tmp_path)
+
+    monkeypatch.chdir(tmp_path)
+    print_report(tmp_path)
+    with open("RESULTS.md") as fh:
+        rows = [line for line in fh if line.startswith("| f7")]
+    cells = [[cell.strip() for cell in row.split("|")[1:-1]] for row in rows]
+    assert [row[-2:] for row in cells] == [["0.2", ""], ["", "0.003"]]
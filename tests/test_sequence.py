@@ -0,0 +1,77 @@
+import numpy as np
+
+from music import (
+    make_shingles,
+    flatten_shingles,
+    song_duration,
+    pool_mean,
+    make_score_index,
+    compute_batch_scores,
+    apply_embedding,
+)
+from benchmark import make_synthetic_corpus
+from sequence import make_sequence_index, compute_sequence_scores, fft_length
+from conftest import sample_rows
+
+
+def sequence_features(sd):
+    """The f7 features before they are shingled."""
+    F = np.block([[sd["volume"]], [sd["C"]]])
+    return pool_mean(F, 1.5, song_duration(sd), 1)
+
+
+def shingle_data(sequences, length):
+    """The f7 embedding of every song, from its `sequence_features`."""
+    data = []
+    for sq in sequences:
+        shingles = make_shingles(sq["D"], length, sq["D"].shape[1], view=True)
+        data.append({**sq, "D": flatten_shingles(shingles)})
+    return data
+
+
+def assert_same_scores(expected, actual):
+    for exp, act in zip(expected, actual):
+        assert [s[1:] for s in act] == [s[1:] for s in exp]
+        np.testing.assert_allclose([s[0] for s in act], [s[0] for s in exp])
+
+
+def test_sequence_search_matches_brute_force(song_data, data):
+    sequences = apply_embedding(song_data, sequence_features)
+    length = 19
+    for sq, sd in zip(sequences, data):
+        shingles = make_shingles(sq["D"], length, sq["D"].shape[1], view=True)
+        assert shingles.shape[2] == length
+        np.testing.assert_array_equal(flatten_shingles(shingles), sd["D"])
+
+    index = make_score_index(data)
+    X, own = sample_rows(index, 40)
+    expected = compute_batch_scores(X, index, exclude=own)
+    actual = compute_sequence_scores(
+        X, make_sequence_index(sequences, length), exclude=own, batch_size=16
+    )
+    assert_same_scores(expected, actual)
+
+
+def test_sequence_search_buckets_mixed_lengths():
+    song_data = []
+    for i, duration in enumerate([60, 70, 100, 240, 250, 600]):
+        song_data += make_synthetic_corpus(1, 1, duration=duration, seed=i)
+    sequences = apply_embedding(song_data, sequence_features)
+    length = 19
+    sequence_index = make_sequence_index(sequences, length, bucket_ratio=1.25)
+
+    # Every song is in one bucket, padded by no more than the bucket ratio.
+    buckets = sequence_index["buckets"]
+    assert len(buckets) == 4
+    songs = np.concatenate([bucket["songs"] for bucket in buckets])
+    assert sorted(songs.tolist()) == list(range(len(song_data)))
+    for bucket in buckets:
+        shortest = min(sequences[j]["D"].shape[1] for j in bucket["songs"])
+        assert bucket["n_fft"] <= fft_length(int(np.ceil(1.25 * shortest)))
+
+    index = make_score_index(shingle_data(sequences, length))
+    X, own = sample_rows(index, 40)
+    for exclude in [None, own]:
+        expected = compute_batch_scores(X, index, exclude=exclude)
+        actual = compute_sequence_scores(X, sequence_index, exclude=exclude)
+        assert_same_scores(expected, actual)
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from music import make_score_index, compute_batch_scores
+from shard import ShardedSearch, partition_songs, save_shards, serve_shard
+from conftest import sample_rows
+
+
+def test_partition_songs_covers_every_song(data):
+    shards = partition_songs(data, 4)
+    assert sorted(np.concatenate(shards).tolist()) == list(range(len(data)))
+
+
+def test_serve_shard_requires_authkey_over_tcp(data, tmp_path):
+    shard_dir = save_shards(data, 1, tmp_path)[0]
+    with pytest.raises(ValueError):
+        serve_shard(shard_dir, ("127.0.0.1", 0))
+
+
+@pytest.mark.parametrize("k", [None, 5])
+def test_sharded_search_matches_brute_force(data, k):
+    index = make_score_index(data)
+    X, own = sample_rows(index, 40)
+    expected = compute_batch_scores(X, index, exclude=own)
+    with ShardedSearch.start(data, n_shards=3) as search:
+        actual = search.search(X, exclude=own, k=k)
+    assert actual == [scores[:k] for scores in expected]
@@ -0,0 +1,67 @@
+import io
+
+import numpy as np
+import soundfile
+
+from music import FeatureStream, signal_features, stream_song_features
+from streaming import read_pcm_blocks
+
+SR = 22050
+
+
+def synthetic_audio(duration=40, seed=0):
+    """A tone that changes pitch every second, with a little noise."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(duration * SR) / SR
+    pitches = rng.choice([220, 261.6, 329.6, 392, 440], size=duration)
+    x = 0.3 * np.sin(2 * np.pi * np.repeat(pitches, SR) * t)
+    return (x + 0.01 * rng.standard_normal(len(t))).astype(np.float32)
+
+
+def assert_same_features(expected, actual):
+    for feat in ["C", "rms", "volume"]:
+        assert actual[feat].shape == expected[feat].shape
+        np.testing.assert_allclose(actual[feat], expected[feat], rtol=1e-6, atol=1e-6)
+
+
+def test_feature_stream_matches_whole_signal():
+    x = synthetic_audio()
+    expected = signal_features(x, SR, tuning=0.0)
+
+    # Chunks that do not line up with the frames or the step.
+    stream = FeatureStream(SR, lookahead=2, step=5, tuning=0.0)
+    parts = [stream.feed(x[i : i + 7001]) for i in range(0, len(x), 7001)]
+    parts = [part for part in parts + [stream.flush()] if part is not None]
+    actual = {
+        feat: np.concatenate([part[feat] for part in parts], axis=-1)
+        for feat in ["C", "rms", "volume"]
+    }
+    assert_same_features(expected, actual)
+
+
+def test_stream_song_features_matches_whole_file(tmp_path):
+    x = synthetic_audio()
+    path = tmp_path / "song.wav"
+    soundfile.write(path, x, SR, subtype="FLOAT")
+
+    expected = signal_features(x, SR, tuning=0.0)
+    actual = stream_song_features(str(path), block_duration=10, tuning=0.0)
+    assert_same_features(expected, actual)
+
+
+class ShortReads(io.RawIOBase):
+    """A binary stream returning at most `chunk` bytes per read, like a pipe."""
+
+    def __init__(self, data, chunk):
+        self.buffer = io.BytesIO(data)
+        self.chunk = chunk
+
+    def read(self, size=-1):
+        return self.buffer.read(min(size, self.chunk))
+
+
+def test_read_pcm_blocks_keeps_split_samples():
+    x = synthetic_audio(duration=1)
+    for chunk in [1, 7, 4097]:
+        blocks = list(read_pcm_blocks(ShortReads(x.tobytes(), chunk), 0.1, SR))
+        np.testing.assert_array_equal(np.concatenate(blocks), x)
@@ -0,0 +1,47 @@
+import numpy as np
+
+from music import make_score_index
+from transposition import (
+    make_transposed_index,
+    transposed_shingles,
+    roll_chroma,
+    compute_transposed_scores,
+    chroma_spectra,
+    chroma_cross_terms,
+    shift_matrix,
+)
+from conftest import sample_rows
+
+
+def test_shift_matrix_gives_dots_under_every_shift():
+    rng = np.random.default_rng(0)
+    Q, D = rng.random((3, 13, 5)), rng.random((4, 13, 5))
+    terms = chroma_cross_terms(chroma_spectra(Q, 1))
+    cross = np.matmul(terms, chroma_spectra(D, 1).transpose(0, 2, 1))
+    dots = (shift_matrix() @ cross.reshape(12, -1)).reshape(12, 3, 4)
+    for shift in range(12):
+        rolled = roll_chroma(Q.reshape(3, -1), shift).reshape(3, 13, 5)
+        expected = rolled[:, 1:].reshape(3, -1) @ D[:, 1:].reshape(4, -1).T
+        np.testing.assert_allclose(dots[shift], expected, atol=1e-12)
+
+
+def test_transposed_search_finds_shifted_queries(data):
+    index = make_score_index(data)
+    transposed = make_transposed_index(data)
+    assert "D" not in transposed
+    # The real spectra take as much memory as the chroma they replace.
+    stored = transposed["spectra"].nbytes + transposed["fixed"].nbytes
+    assert stored == index["D"].nbytes
+    rows = np.arange(0, index["offsets"][-1], 97)
+    # The chroma is rebuilt from its single precision spectrum.
+    np.testing.assert_allclose(
+        transposed_shingles(transposed, rows), index["D"][rows], atol=1e-6
+    )
+
+    # A query transposed up by 5 semitones is found when shifted up by 7 more.
+    X, own = sample_rows(index, 12)
+    all_scores = compute_transposed_scores(roll_chroma(X, 5), transposed)
+    for scores, x, j in zip(all_scores, X, own):
+        score, _, idx, shingle_idx, shift = scores[0]
+        assert (idx, shift) == (j, 7) and score < 1e-5
+        np.testing.assert_array_equal(index["D"][index["offsets"][j] + shingle_idx], x)
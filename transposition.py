@@ -0,0 +1,231 @@
+"""Score shingles under every transposition of their chroma at once.
+
+A performance at a different tuning pitch, or from a transposed edition,
+has its chroma rows circularly shifted. Since a circular shift leaves the
+norm of a shingle unchanged, the distance under each of the 12 shifts only
+differs in the dot product term, which is a circular cross-correlation along
+the chroma axis. Storing the Fourier transform of each shingle's chroma lets
+a single matrix product give the dot products under all 12 shifts. Any
+channels before the chroma, such as the volume of f1 and f3-f7, are not
+shifted.
+
+The spectrum of real chroma is stored as 12 real numbers per step: the real
+parts of frequencies 0 and 6, and the real and imaginary parts of 1 to 5.
+These are kept in 6 pairs, so the cross-correlation is one batched real
+matrix product, giving 12 real terms for each query and shingle, and the
+size-12 inverse transform is then a 12 x 12 real matrix product over those
+terms. The index keeps only these spectra and the unshifted channels, the
+same size as the index of `make_score_index`, and rebuilds the shingles that
+win from them.
+
+Scoring under every shift is a known cost, which `benchmark.py` reports as a
+ratio to `compute_batch_scores`: on the f7 shingles of 160 songs it takes
+about 4 times as long. The product of the spectra does about twice the
+arithmetic of a plain scan, the inverse transform adds 144 operations for
+each shingle to the 247 of the scan, and rebuilding the winning shingles
+from their spectra adds about a quarter.
+"""
+__all__ = ['make_transposed_index', 'transposed_shingles', 'roll_chroma',
+           'compute_transposed_scores']
+
+import numpy as np
+
+from music import make_score_index, segment_min, rank_songs
+
+N_CHROMA = 12
+
+# The real Fourier basis of the chroma, with rows in the order the spectra are
+# stored: the real parts of frequencies 0 and 6, then the real and imaginary
+# parts of frequencies 1 to 5, with its inverse to rebuild the chroma.
+_dft = np.fft.rfft(np.eye(N_CHROMA), axis=0)
+CHROMA_BASIS = np.concatenate(
+    [_dft[[0, 6]].real, np.stack([_dft[1:6].real, _dft[1:6].imag], 1).reshape(10, -1)]
+)
+CHROMA_INVERSE = np.linalg.inv(CHROMA_BASIS)
+del _dft
+
+
+def shift_matrix():
+    """Get the (12, 12) matrix from the cross terms of two spectra to their dots.
+
+    The cross terms are those of `chroma_cross_terms`, and row `s` of the
+    result gives the dot product of the shingle with the query transposed up
+    by `s` semitones, as by `roll_chroma`, as the size-12 inverse transform
+    of their cross-correlation.
+    """
+    k = np.arange(1, 6)
+    angles = 2 * np.pi * np.outer(np.arange(N_CHROMA), k) / N_CHROMA
+    W = np.empty((N_CHROMA, N_CHROMA))
+    W[:, 0] = 1
+    W[:, 1] = (-1.0) ** np.arange(N_CHROMA)
+    W[:, 2::2] = 2 * np.cos(angles)
+    W[:, 3::2] = -2 * np.sin(angles)
+    return W / N_CHROMA
+
+
+def chroma_spectra(X3, n_fixed):
+    """Get the real chroma spectra of (n, n_channels, length) shingles.
+
+    Returns an array of shape (6, n, 2 * length), with each pair of basis rows
+    of `CHROMA_BASIS` side by side along the last axis.
+    """
+    spectra = np.einsum("fc,ncl->fnl", CHROMA_BASIS, X3[:, n_fixed:])
+    n, length = spectra.shape[1:]
+    return spectra.reshape(6, 2, n, length).transpose(0, 2, 1, 3).reshape(6, n, -1)
+
+
+def chroma_cross_terms(Q_spectra):
+    """Stack the query spectra so that a product with shingle spectra gives cross terms.
+
+    `Q_spectra` is from `chroma_spectra`, of shape (6, n_queries, 2 * length).
+    Returns an array of shape (6, 2 * n_queries, 2 * length), whose product
+    with the shingle spectra gives each pair of cross terms, for all of the
+    queries and then all again: for frequencies 0 and 6, their own dot
+    products, and for the others, the real and imaginary parts of the product
+    of the query's conjugate spectrum with the shingle's.
+    """
+    length = Q_spectra.shape[2] // 2
+    re, im = Q_spectra[..., :length], Q_spectra[..., length:]
+    terms = np.empty((6, 2) + Q_spectra.shape[1:], dtype=Q_spectra.dtype)
+    terms[:, 0] = Q_spectra
+    terms[:, 1, :, :length] = -im
+    terms[:, 1, :, length:] = re
+
+    # Frequencies 0 and 6 are both real, so give each its own dot product.
+    terms[0, 0, :, length:] = 0
+    terms[0, 1, :, :length] = 0
+    terms[0, 1, :, length:] = im[0]
+    return terms.reshape(6, -1, 2 * length)
+
+
+def make_transposed_index(data, n_channels=13, dtype=None):
+    """Pack the shingles of every song for transposition-invariant scoring.
+
+    Replaces the shingles "D" of the index from `make_score_index` with the
+    real Fourier "spectra" of each shingle's chroma and the "fixed" channels
+    which are not shifted, along with the number of "n_channels" each shingle
+    was flattened from. Use `transposed_shingles` to get shingles back. The
+    last 12 channels must be the chroma, so the PCA embeddings of f8-f11
+    cannot be used.
+    """
+    index = make_score_index(data, dtype=dtype)
+    D = index.pop("D")
+    n_fixed = n_channels - N_CHROMA
+    D3 = D.reshape(len(D), n_channels, -1)
+    real_dtype = np.result_type(D.dtype, np.float32)
+
+    # Stored as (6, 2 * length, n_shingles) for a batched matrix product.
+    spectra = chroma_spectra(D3.astype(real_dtype, copy=False), n_fixed)
+    index["spectra"] = np.ascontiguousarray(
+        spectra.astype(real_dtype, copy=False).transpose(0, 2, 1)
+    )
+    index["fixed"] = np.ascontiguousarray(D3[:, :n_fixed].reshape(len(D), -1))
+    index["n_channels"] = n_channels
+    return index
+
+
+def transposed_shingles(index, rows):
+    """Rebuild the flattened shingles at `rows` of a transposed index.
+
+    `rows` may be an array of any shape, which the shingles are returned in.
+    The chroma is rebuilt from its spectrum, so it is only equal to that of
+    the original shingles to within rounding.
+    """
+    rows = np.asarray(rows)
+    flat_rows = rows.ravel()
+    n_fixed = index["n_channels"] - N_CHROMA
+
+    # Undo the pairing of `chroma_spectra`, then the basis.
+    spectra = np.take(index["spectra"], flat_rows, axis=2)
+    length = spectra.shape[1] // 2
+    spectra = spectra.reshape(6, 2, length, -1).reshape(N_CHROMA, length, -1)
+    chroma = (CHROMA_INVERSE @ spectra.reshape(N_CHROMA, -1)).reshape(
+        N_CHROMA, length, -1
+    ).transpose(2, 0, 1)
+    fixed = index["fixed"][flat_rows].reshape(len(flat_rows), n_fixed, -1)
+    shingles = np.concatenate([fixed, chroma.astype(fixed.dtype)], axis=1)
+    return shingles.reshape(rows.shape + (-1,))
+
+
+def roll_chroma(X, shift, n_channels=13):
+    """Transpose flattened shingles up by `shift` semitones, leaving other channels."""
+    X = np.atleast_2d(X)
+    X3 = X.reshape(len(X), n_channels, -1)
+    n_fixed = n_channels - N_CHROMA
+    rolled = np.concatenate(
+        [X3[:, :n_fixed], np.roll(X3[:, n_fixed:], shift, axis=1)], axis=1
+    )
+    return rolled.reshape(X.shape)
+
+
+def compute_transposed_scores(X, index, exclude=None, batch_size=16, block_size=256):
+    """Compute the scores between each query and every song, under any transposition.
+
+    Each song's score is the smallest distance between any of its shingles
+    and the query transposed by any number of semitones.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        A (n_queries, n_features) array of query shingles.
+    index : dict
+        The packed song shingles, as returned by `make_transposed_index`.
+    exclude : list
+        (Optional) For each query, the index of a song to leave out.
+    batch_size : int
+        (Default 16) The number of queries to score at once.
+    block_size : int
+        (Default 256) The number of shingles to correlate each batch with at
+        once. The dot products under all 12 shifts are only kept for one block,
+        small enough to stay in cache until their maximum is taken.
+
+    Returns
+    -------
+    list
+        For each query, a sorted list of (score, song_id, idx, shingle_idx,
+        shift) tuples, one per song, where the query matched best when
+        transposed up by `shift` semitones.
+    """
+    X = np.atleast_2d(X)
+    offsets = index["offsets"]
+    song_ids = index["song_ids"]
+    n_channels = index["n_channels"]
+    n_fixed = n_channels - N_CHROMA
+    spectra = index["spectra"]
+    n_shingles = spectra.shape[2]
+    dtype = spectra.dtype
+    W = shift_matrix().astype(dtype)
+
+    all_scores = []
+    for b in range(0, len(X), batch_size):
+        Q = X[b : b + batch_size].astype(dtype, copy=False)
+        Q3 = Q.reshape(len(Q), n_channels, -1)
+
+        # Correlate the chroma under every shift from the 12 real cross terms of
+        # each query and shingle, as (shifts, queries, shingles). The norms are
+        # the same under every shift, so the nearest shift has the largest dot
+        # product, and only the winning shingle's shift is needed.
+        terms = chroma_cross_terms(chroma_spectra(Q3, n_fixed))
+        best_dots = np.empty((len(Q), n_shingles), dtype=dtype)
+        for c in range(0, n_shingles, block_size):
+            cross = np.matmul(terms, spectra[:, :, c : c + block_size])
+            dots = (W @ cross.reshape(N_CHROMA, -1)).reshape(N_CHROMA, len(Q), -1)
+            np.max(dots, axis=0, out=best_dots[:, c : c + block_size])
+
+        # The unshifted channels add the same to every shift.
+        best_dots += Q3[:, :n_fixed].reshape(len(Q), -1) @ index["fixed"].T
+        sq_dists = np.einsum("ij,ij->i", Q, Q)[:, None] + index["norms"][None, :]
+        sq_dists -= 2 * best_dots
+        _, min_idxs = segment_min(sq_dists, offsets)
+
+        # Find the best shift for each winning shingle, and recompute its
+        # distance directly to avoid cancellation error.
+        rows = offsets[:-1] + min_idxs
+        rolled = np.stack([roll_chroma(Q, s, n_channels) for s in range(N_CHROMA)])
+        winners = transposed_shingles(index, rows).astype(dtype, copy=False)
+        best_shifts = np.matmul(winners, rolled.transpose(1, 2, 0)).argmax(axis=2)
+        best = winners - rolled[best_shifts, np.arange(len(Q))[:, None]]
+        best_scores = np.sqrt(np.einsum("ijk,ijk->ij", best, best))
+        skip = None if exclude is None else exclude[b : b + batch_size]
+        all_scores += rank_songs(best_scores, song_ids, min_idxs, skip, best_shifts)
+    return all_scores